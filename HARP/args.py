@@ -214,6 +214,12 @@ def parse_args():
         default=True,
         help="Dynamic HW-Loss regularization",
     )
+    parser.add_argument(
+        "--latency_lut",
+        type=str,
+        default=None,
+        help="Measured layer latency LUT (build_latency_lut.py): channel pruning optimizes CPU latency instead of FLOPs",
+    )
     parser.add_argument(
         "--epochs", type=int, default=100, metavar="N", help="number of epochs to train"
     )
@@ -259,6 +265,12 @@ def parse_args():
     )
 
     # Adversarial attacks
+    parser.add_argument(
+        "--fat_tau",
+        type=int,
+        default=None,
+        help="Early-stopped (FAT) PGD in pgd/trades training: stop perturbing a sample after it is misclassified for fat_tau more steps",
+    )
     parser.add_argument("--attack_eval", default="pgd", type=str, help="whitebox attack for evaluation", choices=("pgd", "fgsm", "cw"))
     parser.add_argument("--epsilon", default=8.0 / 255, type=float, help="perturbation")
     parser.add_argument(
@@ -294,6 +306,20 @@ def parse_args():
         "--evaluate", action="store_true", default=False, help="Evaluate model"
     )
 
+    parser.add_argument(
+        "--cascade-eval",
+        action="store_true",
+        default=False,
+        help="Evaluate attacks as a cheap-to-expensive cascade, each one only on the surviving samples",
+    )
+
+    parser.add_argument(
+        "--robustness-db",
+        type=str,
+        default="",
+        help="SQLite file of per-sample attack outcomes; only missing (sample, attack) pairs are evaluated",
+    )
+
     parser.add_argument(
         "--val_method",
         type=str,
@@ -10,6 +10,60 @@ from HARP.utils.utils import rate_act_func
 conv_nr = 0
 linear_nr = 0
 
+# Mask engine of GetSubnet: 'sort' (full sort, the reference), 'kthvalue' (exact threshold by
+# selection) or 'histogram' (approximate threshold from a score histogram, only for layers with
+# more than `histogram_numel` scores; smaller layers use kthvalue)
+mask_engine = {'engine': 'kthvalue', 'histogram_numel': 1 << 20, 'bins': 4096}
+
+
+def set_mask_engine(engine='kthvalue', histogram_numel=1 << 20, bins=4096):
+    assert engine in ('sort', 'kthvalue', 'histogram'), f'Unknown mask engine "{engine}"'
+    mask_engine.update(engine=engine, histogram_numel=histogram_numel, bins=bins)
+
+
+def _stable_threshold_mask(flat, threshold, keep):
+    """Keeps the scores above threshold and, of the ones equal to it, the last in index order up
+    to `keep` kept in total: the mask of a stable sort, without the sort"""
+    mask = flat > threshold
+    missing = keep - int(mask.sum())
+    if missing > 0:
+        tied = (flat == threshold).nonzero().squeeze(1)
+        mask[tied[-missing:]] = True
+    return mask
+
+
+def topk_mask(scores, k):
+    """0/1 mask of the same shape as scores keeping its top k fraction"""
+    flat = scores.flatten()
+    j = int((1 - k) * scores.numel())
+
+    if mask_engine['engine'] == 'sort':
+        out = scores.clone()
+        _, idx = flat.sort()
+        # flat_out and out access the same memory.
+        flat_out = out.flatten()
+        flat_out[idx[:j]] = 0
+        flat_out[idx[j:]] = 1
+        return out
+
+    if j <= 0:
+        return torch.ones_like(scores)
+    if j >= flat.numel():
+        return torch.zeros_like(scores)
+
+    if mask_engine['engine'] == 'histogram' and flat.numel() > mask_engine['histogram_numel']:
+        # Upper edge of the histogram bin holding the j-th smallest score
+        lo, hi = flat.min(), flat.max()
+        counts = torch.histc(flat.float(), bins=mask_engine['bins'], min=lo.item(), max=hi.item())
+        bin_idx = torch.searchsorted(counts.cumsum(0), torch.tensor([float(j)], device=flat.device))
+        threshold = lo + (hi - lo) * (bin_idx.float() + 1) / mask_engine['bins']
+        # Scores above the bin are kept: up to one bin fewer than the exact top k
+        return (scores > threshold).to(scores.dtype)
+
+    threshold = flat.kthvalue(j).values
+    return _stable_threshold_mask(flat, threshold, flat.numel() - j).view_as(scores).to(scores.dtype)
+
+
 # Borrow from https://github.com/allenai/hidden-networks
 class GetSubnet(autograd.Function):
     @staticmethod
@@ -17,16 +71,8 @@ class GetSubnet(autograd.Function):
         # Get the subnetwork by sorting the scores and using the top k%
 
         if prune_reg == 'weight':
-            # """ Weight pruning
-            out = scores.clone()
-            _, idx = scores.flatten().sort()
-            j = int((1 - k) * scores.numel())
-
-            # flat_out and out access the same memory.
-            flat_out = out.flatten()
-            flat_out[idx[:j]] = 0
-            flat_out[idx[j:]] = 1
-            # """
+            # Weight pruning
+            out = topk_mask(scores, k)
 
         elif prune_reg == 'channel':
             out = scores.clone()
@@ -53,7 +99,36 @@ class GetSubnet(autograd.Function):
         return g, g_r, None
 
 
-class SubnetConv(nn.Conv2d):
+class FrozenMask:
+    """
+        Inference mode for the subnet layers: the masked weight is built once and reused until
+        popup_scores, k_score or weight change (tracked by storage pointer and in-place version
+        counter), skipping GetSubnet and its autograd graph on every forward.
+        In-place writes through `.data` bypass the version counter: call reset_frozen_mask after them.
+    """
+    frozen_mask = False
+    _frozen_key = None
+    _frozen_w = None
+
+    def freeze_mask(self, frozen=True):
+        self.frozen_mask = frozen
+        self.reset_frozen_mask()
+
+    def reset_frozen_mask(self):
+        self._frozen_key, self._frozen_w = None, None
+
+    def _frozen_weight(self):
+        tensors = [self.popup_scores, getattr(self, 'k_score', None), self.weight]
+        key = tuple((t.data_ptr(), t._version) for t in tensors if t is not None) + \
+            (getattr(self, 'k', None), getattr(self, 'k_min', None))
+        if key != self._frozen_key:
+            with torch.no_grad():
+                self._frozen_w = self._masked_weight()
+            self._frozen_key = key
+        return self._frozen_w
+
+
+class SubnetConv(FrozenMask, nn.Conv2d):
 
     def __init__(
             self,
@@ -108,8 +183,7 @@ class SubnetConv(nn.Conv2d):
         self.k = k if self.task_mode != 'pretrain' else 1.0
         self.k_min = global_k * alpha if self.task_mode != 'pretrain' else 0.0
 
-    def forward(self, x):
-
+    def _masked_weight(self):
         if self.task_mode == 'pretrain':
             k = 1.0
         else:
@@ -117,14 +191,18 @@ class SubnetConv(nn.Conv2d):
 
         adj = GetSubnet.apply(self.popup_scores.abs(), k, self.prune_reg)
 
-        self.w = self.weight * adj
+        return self.weight * adj
+
+    def forward(self, x):
+
+        self.w = self._frozen_weight() if self.frozen_mask else self._masked_weight()
         x = F.conv2d(
             x, self.w, self.bias, self.stride, self.padding, self.dilation, self.groups
         )
         return x
 
 
-class SubnetLinear(nn.Linear):
+class SubnetLinear(FrozenMask, nn.Linear):
     # self.k is the % of weights remaining, a real number in [0,1]
     # self.popup_scores is a Parameter which has the same shape as self.weight
     # Gradients to self.weight, self.bias have been turned off.
@@ -161,8 +239,7 @@ class SubnetLinear(nn.Linear):
         self.k = k if self.task_mode != 'pretrain' else 1.0
         self.k_min = global_k * alpha if self.task_mode != 'pretrain' else 0.0
 
-    def forward(self, x):
-
+    def _masked_weight(self):
         if self.task_mode == 'pretrain':
             k = 1.0
         else:
@@ -170,8 +247,12 @@ class SubnetLinear(nn.Linear):
 
         adj = GetSubnet.apply(self.popup_scores.abs(), k, self.prune_reg)
 
+        return self.weight * adj
+
+    def forward(self, x):
+
         # Use only the subnetwork in the forward pass.
-        self.w = self.weight * adj
+        self.w = self._frozen_weight() if self.frozen_mask else self._masked_weight()
         x = F.linear(x, self.w, self.bias)
 
         return x
@@ -11,13 +11,8 @@ from pathlib import Path
 from args import parse_args
 from utils.model import display_loadrate
 from utils.logging import parse_configs_file
-from utils.adv import (
-    pgd_whitebox,
-    fgsm_whitebox,
-    cw_whitebox,
-    autopgd_whitebox,
-    autoattack_whitebox
-)
+from utils.eval import whitebox_attacker, cascade, incremental
+from utils.robustness_db import RobustnessDB
 from utils.logging import (
     AverageMeter,
     ProgressMeter,
@@ -50,6 +45,8 @@ from utils.model import (
 )
 
 ATTACK_LIST = ['fgsm', 'pgd10', 'cw', 'autopgd', 'autoattack']
+# Cheapest first: with --cascade-eval each attack only runs on the samples surviving the previous ones
+CASCADE_LIST = ['fgsm', 'pgd10', 'cw', 'autopgd', 'fmn', 'autoattack']
 RUN_BACC = False
 
 # TODO: update wrn, resnet models. Save both subnet and dense version.
@@ -207,6 +204,19 @@ def main():
 
     display_loadrate(model, logger, args)
 
+    if args.cascade_eval:
+        logger.info(f'>>Cascade evaluation on {CASCADE_LIST}')
+        cascade(model, device, test_loader, CASCADE_LIST, args, logger)
+        return
+
+    if args.robustness_db:
+        logger.info(f'>>Evaluate on {ATTACK_LIST}, missing samples only (robustness db: {args.robustness_db})')
+        db = RobustnessDB(args.robustness_db)
+        incremental(model, device, test_loader, ATTACK_LIST, args, db, RobustnessDB.checkpoint_hash(args.source_net),
+                    logger)
+        db.close()
+        return
+
     # Run attack
     logger.info(f'>>Evaluate on {ATTACK_LIST}')
     for attack in ATTACK_LIST:
@@ -263,28 +273,7 @@ def main():
                 output_nat = model(images)
 
                 # adversarial images
-                if attack == 'pgd10':
-                    attacker = pgd_whitebox
-                    args.num_steps = 10
-                elif attack == 'pgd20':
-                    attacker = pgd_whitebox
-                    args.num_steps = 20
-                elif attack == 'pgd50':
-                    attacker = pgd_whitebox
-                    args.num_steps = 50
-                    args.step_size = 2.5*args.epsilon/args.num_steps
-                elif attack == 'fgsm':
-                    attacker = fgsm_whitebox
-                elif attack == 'cw':
-                    attacker = cw_whitebox
-                    args.num_steps = 20
-                elif attack == 'autopgd':
-                    attacker = autopgd_whitebox
-                    args.num_steps = 50
-                elif attack == 'autoattack':
-                    attacker = autoattack_whitebox
-                else:
-                    raise NameError(f'{attack} is not supported for white-box attack!')
+                attacker, num_steps, step_size = whitebox_attacker(attack, args)
 
                 images = attacker(
                     model,
@@ -292,8 +281,8 @@ def main():
                     target,
                     device,
                     args.epsilon,
-                    args.num_steps,
-                    args.step_size,
+                    num_steps,
+                    step_size,
                     args.clip_min,
                     args.clip_max,
                     is_random=not args.const_init,
@@ -11,7 +11,7 @@ from pathlib import Path
 
 from args import parse_args
 from utils.logging import parse_configs_file
-from utils.hw import hw_loss, hw_flops_loss
+from utils.hw import get_hw_loss_func
 from utils.model import map_shortcut_rate
 
 args = parse_args()
@@ -221,10 +221,7 @@ def main():
 
     show_gradients(model, logger)
 
-    if args.prune_reg == 'channel':
-        _, _, start_rate = hw_flops_loss(model, device, optimizer, args, print_target=True)
-    else:
-        _, _, start_rate = hw_loss(model, device, optimizer, args, print_target=True)
+    _, _, start_rate = get_hw_loss_func(args)(model, device, optimizer, args, print_target=True)
 
     logger.info(f'\nStarting from: Prune-rate = {start_rate}\n')
 
@@ -279,10 +276,7 @@ def main():
         # Check current compression rate
         hw_info = ''
         if args.exp_mode != 'pretrain':
-            if args.prune_reg == 'channel':
-                loss_hw_func = hw_flops_loss
-            else:
-                loss_hw_func = hw_loss
+            loss_hw_func = get_hw_loss_func(args)
             gamma, loss_hw, current_rate = loss_hw_func(model, device, optimizer, args, epoch=epoch, frozen_gamma=frozen_gamma)
 
             if np.round(loss_hw.cpu().data, 4) == 0.0:
@@ -7,7 +7,7 @@ import math
 
 from utils.logging import AverageMeter, ProgressMeter
 from utils.eval import accuracy
-from utils.hw import hw_loss, hw_flops_loss
+from utils.hw import get_hw_loss_func
 from utils.model import map_shortcut_rate
 from utils.utils import rate_act_func
 
@@ -56,15 +56,19 @@ def train(
             )
             print(f"Training images range: {[torch.min(images), torch.max(images)]}")
 
-        output = model(images)
-
         # calculate robust loss
         if epoch < warmup_epochs:
             adv_loss = getattr(importlib.import_module("utils.adv"), args.warmup_loss+'_loss')
         else:
             adv_loss = getattr(importlib.import_module("utils.adv"), args.adv_loss+'_loss')
 
-        loss = adv_loss(
+        # FAT early stop is only supported by the PGD-based losses
+        fat_kwargs = {}
+        if args.fat_tau is not None and adv_loss.__name__ in ('pgd_loss', 'trades_loss'):
+            fat_kwargs['fat_tau'] = args.fat_tau
+
+        # The losses also return the clean logits, for the accuracy meters
+        loss, output = adv_loss(
             model=model,
             x_natural=images,
             y=target,
@@ -77,14 +81,12 @@ def train(
             clip_min=args.clip_min,
             clip_max=args.clip_max,
             distance=args.distance,
+            return_logits=True,
+            **fat_kwargs,
         )
 
         if args.soft_hw:
-            if args.prune_reg == 'channel':
-                hw_loss_func = hw_flops_loss
-            else:
-                hw_loss_func = hw_loss
-            gamma, loss_hw, _ = hw_loss_func(
+            gamma, loss_hw, _ = get_hw_loss_func(args)(
                 model=model,
                 device=device,
                 optimizer=optimizer,
@@ -6,7 +6,7 @@ import torch
 import torch.nn as nn
 import torchvision
 from torch.autograd import Variable
-from utils.hw import hw_loss, hw_flops_loss
+from utils.hw import get_hw_loss_func
 from utils.logging import AverageMeter, ProgressMeter
 from utils.eval import accuracy
 from utils.adv import fgsm
@@ -73,7 +73,7 @@ def train(
             loss = criterion(output, target)
 
             if args.soft_hw:
-                gamma, loss_hw, _ = hw_loss(
+                gamma, loss_hw, _ = get_hw_loss_func(args)(
                     model=model,
                     device=device,
                     optimizer=optimizer,
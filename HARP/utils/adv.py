@@ -3,7 +3,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 import torch.optim as optim
+from torch.utils.data import TensorDataset
 import torchattacks
+from attacks import whitebox
+from attacks.fmn_opt import FMNOpt
 from HARP.models import SubnetConv, SubnetLinear
 from utils.flops import count_flops_conv, count_flops_dense
 
@@ -17,6 +20,45 @@ def l2_norm(x):
     return squared_l2_norm(x).sqrt()
 
 
+def clean_logits(model, x_natural):
+    """Logits of the clean batch without an autograd graph, for losses that do not use them"""
+    model.train()
+    with torch.no_grad():
+        return model(x_natural)
+
+
+def early_stop_pgd(model, x_natural, y, x_adv, loss_fn, step_size, epsilon, perturb_steps, clip_min, clip_max,
+                   fat_tau):
+    """
+        FAT-style l_inf PGD (https://arxiv.org/abs/2002.11242): a sample stops being perturbed once it
+        has been misclassified at fat_tau + 1 steps and leaves the later forwards.
+        loss_fn(logits, index) is the attack loss of the samples `index` of the batch.
+    """
+    x_adv = x_adv.detach().clone()
+    active = torch.arange(len(x_natural), device=x_natural.device)
+    wrong_steps = torch.zeros(len(x_natural), dtype=torch.long, device=x_natural.device)
+
+    for _ in range(perturb_steps):
+        x_active = x_adv[active].requires_grad_()
+        with torch.enable_grad():
+            logits = model(x_active)
+            loss = loss_fn(logits, active)
+        grad = torch.autograd.grad(loss, [x_active])[0]
+
+        wrong = logits.argmax(dim=1) != y[active]
+        keep = ~(wrong & (wrong_steps[active] >= fat_tau))
+        wrong_steps[active] += wrong.long()
+
+        x_step = x_active.detach() + step_size * torch.sign(grad.detach())
+        x_step = torch.min(torch.max(x_step, x_natural[active] - epsilon), x_natural[active] + epsilon)
+        x_adv[active[keep]] = torch.clamp(x_step[keep], clip_min, clip_max)
+
+        active = active[keep]
+        if len(active) == 0:
+            break
+    return x_adv
+
+
 # ref: https://github.com/yaodongyu/TRADES
 def trades_loss(
     model,
@@ -32,23 +74,31 @@ def trades_loss(
     clip_max,
     distance="l_inf",
     natural_criterion=nn.CrossEntropyLoss(),
+    return_logits=False,
+    fat_tau=None,
 ):
     # define KL-loss
     criterion_kl = nn.KLDivLoss(size_average=False)
     model.eval()
     batch_size = len(x_natural)
+    # KL target of the attack, the same at every step
+    with torch.no_grad():
+        nat_probs = F.softmax(model(x_natural), dim=1)
     # generate adversarial example
     x_adv = (
         x_natural.detach() + 0.001 * torch.randn(x_natural.shape).to(device).detach()
     )
-    if distance == "l_inf":
+    if distance == "l_inf" and fat_tau is not None:
+        x_adv = early_stop_pgd(
+            model, x_natural, y, x_adv,
+            lambda logits, index: criterion_kl(F.log_softmax(logits, dim=1), nat_probs[index]),
+            step_size, epsilon, perturb_steps, clip_min, clip_max, fat_tau
+        )
+    elif distance == "l_inf":
         for _ in range(perturb_steps):
             x_adv.requires_grad_()
             with torch.enable_grad():
-                loss_kl = criterion_kl(
-                    F.log_softmax(model(x_adv), dim=1),
-                    F.softmax(model(x_natural), dim=1),
-                )
+                loss_kl = criterion_kl(F.log_softmax(model(x_adv), dim=1), nat_probs)
             grad = torch.autograd.grad(loss_kl, [x_adv])[0]
             x_adv = x_adv.detach() + step_size * torch.sign(grad.detach())
             x_adv = torch.min(
@@ -68,9 +118,7 @@ def trades_loss(
             # optimize
             optimizer_delta.zero_grad()
             with torch.enable_grad():
-                loss = (-1) * criterion_kl(
-                    F.log_softmax(model(adv), dim=1), F.softmax(model(x_natural), dim=1)
-                )
+                loss = (-1) * criterion_kl(F.log_softmax(model(adv), dim=1), nat_probs)
             loss.backward()
             # renorming gradient
             grad_norms = delta.grad.view(batch_size, -1).norm(p=2, dim=1)
@@ -98,10 +146,10 @@ def trades_loss(
     logits = model(x_natural)
     loss_natural = natural_criterion(logits, y)
     loss_robust = (1.0 / batch_size) * criterion_kl(
-        F.log_softmax(model(x_adv), dim=1), F.softmax(model(x_natural), dim=1)
+        F.log_softmax(model(x_adv), dim=1), F.softmax(logits, dim=1)
     )
     loss = loss_natural + beta * loss_robust
-    return loss
+    return (loss, logits) if return_logits else loss
 
 
 def mart_loss(
@@ -117,6 +165,7 @@ def mart_loss(
         clip_min,
         clip_max,
         distance='l_inf',
+        return_logits=False,
     ):
 
     kl = nn.KLDivLoss(reduction='none')
@@ -162,23 +211,14 @@ def mart_loss(
         torch.sum(kl(torch.log(adv_probs + 1e-12), nat_probs), dim=1) * (1.0000001 - true_probs))
     loss_mart = loss_adv + float(beta) * loss_robust
 
-    return loss_mart
+    return (loss_mart, logits) if return_logits else loss_mart
 
 
-def cw_loss(output, target, confidence=50):
+def cw_loss(output, target, confidence=50, num_classes=None):
     # Compute the probability of the label class versus the maximum other
     # The same implementation as in repo CAT https://github.com/sunblaze-ucb/curriculum-adversarial-training-CAT
-    num_classes = output.shape[1]
-    target = target.data
-    target_onehot = torch.zeros(target.size() + (num_classes,))
-    target_onehot = target_onehot.cuda()
-    target_onehot.scatter_(1, target.unsqueeze(1), 1.)
-    target_var = Variable(target_onehot, requires_grad=False)
-    real = (target_var * output).sum(1)
-    other = ((1. - target_var) * output - target_var * 10000.).max(1)[0]
-    loss = -torch.clamp(real - other + confidence, min=0.)  # equiv to max(..., 0.)
-    loss = torch.sum(loss)
-    return loss
+    # (num_classes is read from the logits, the argument is kept for the callers passing it)
+    return whitebox.cw_loss(output, target, confidence)
 
 
 def pgd_loss(
@@ -195,14 +235,24 @@ def pgd_loss(
     clip_max,
     distance="l_inf",
     natural_criterion=nn.CrossEntropyLoss(),
+    return_logits=False,
+    fat_tau=None,
 ):
+    # Clean logits for the accuracy meters only, computed in train mode as the trainer used to
+    logits_nat = clean_logits(model, x_natural) if return_logits else None
     model.eval()
     # generate adversarial example
     random_noise = (
         torch.FloatTensor(x_natural.shape).uniform_(-epsilon, epsilon).to(device)
     )
     x_adv = x_natural.detach() + random_noise
-    if distance == "l_inf":
+    if distance == "l_inf" and fat_tau is not None:
+        x_adv = early_stop_pgd(
+            model, x_natural, y, x_adv,
+            lambda logits, index: F.cross_entropy(logits, y[index], reduction='sum'),
+            step_size, epsilon, perturb_steps, clip_min, clip_max, fat_tau
+        )
+    elif distance == "l_inf":
         for _ in range(perturb_steps):
             x_adv.requires_grad_()
             with torch.enable_grad():
@@ -223,7 +273,7 @@ def pgd_loss(
     # calculate robust loss
     logits = model(x_adv)
     loss_pgd = natural_criterion(logits, y)
-    return loss_pgd
+    return (loss_pgd, logits_nat) if return_logits else loss_pgd
 
 
 def fgsm_loss(
@@ -240,7 +290,10 @@ def fgsm_loss(
     clip_max,
     distance="l_inf",
     natural_criterion=nn.CrossEntropyLoss(),
+    return_logits=False,
 ):
+    # Clean logits for the accuracy meters only, computed in train mode as the trainer used to
+    logits_nat = clean_logits(model, x_natural) if return_logits else None
     model.eval()
     # generate adversarial example
     # random_noise = (
@@ -267,7 +320,7 @@ def fgsm_loss(
     logits = model(x_adv)
     loss_fgsm = natural_criterion(logits, y)
 
-    return loss_fgsm
+    return (loss_fgsm, logits_nat) if return_logits else loss_fgsm
 
 
 def nat_loss(
@@ -284,6 +337,7 @@ def nat_loss(
     clip_max,
     distance="l_inf",
     natural_criterion=nn.CrossEntropyLoss(),
+    return_logits=False,
 ):
     model.train()
     x_nat = Variable(x_natural, requires_grad=False)
@@ -293,7 +347,7 @@ def nat_loss(
     logits = model(x_nat)
     loss_nat = natural_criterion(logits, y)
 
-    return loss_nat
+    return (loss_nat, logits) if return_logits else loss_nat
 
 
 # TODO: support L-2 attacks too.
@@ -309,28 +363,7 @@ def pgd_whitebox(
     clip_max,
     is_random=True,
 ):
-
-    x_adv = Variable(x.data, requires_grad=True)
-    if is_random:
-        random_noise = (
-            torch.FloatTensor(x_adv.shape).uniform_(-epsilon, epsilon).to(device)
-        )
-        x_adv = Variable(x_adv.data + random_noise, requires_grad=True)
-
-    for _ in range(num_steps):
-        opt = optim.SGD([x_adv], lr=1e-3)
-        opt.zero_grad()
-
-        with torch.enable_grad():
-            loss = nn.CrossEntropyLoss()(model(x_adv), y)
-        loss.backward()
-        eta = step_size * x_adv.grad.data.sign()
-        x_adv = Variable(x_adv.data + eta, requires_grad=True)
-        eta = torch.clamp(x_adv.data - x.data, -epsilon, epsilon)
-        x_adv = Variable(x.data + eta, requires_grad=True)
-        x_adv = Variable(torch.clamp(x_adv, clip_min, clip_max), requires_grad=True)
-
-    return x_adv
+    return whitebox.pgd(model, x, y, epsilon, num_steps, step_size, clip_min, clip_max, is_random)
 
 
 def cw_whitebox(
@@ -345,28 +378,7 @@ def cw_whitebox(
     clip_max,
     is_random=True,
 ):
-
-    x_adv = Variable(x.data, requires_grad=True)
-    if is_random:
-        random_noise = (
-            torch.FloatTensor(x_adv.shape).uniform_(-epsilon, epsilon).to(device)
-        )
-        x_adv = Variable(x_adv.data + random_noise, requires_grad=True)
-
-    for _ in range(num_steps):
-        opt = optim.SGD([x_adv], lr=1e-3)
-        opt.zero_grad()
-
-        with torch.enable_grad():
-            loss = cw_loss(model(x_adv), y)
-        loss.backward()
-        eta = step_size * x_adv.grad.data.sign()
-        x_adv = Variable(x_adv.data + eta, requires_grad=True)
-        eta = torch.clamp(x_adv.data - x.data, -epsilon, epsilon)
-        x_adv = Variable(x.data + eta, requires_grad=True)
-        x_adv = Variable(torch.clamp(x_adv, clip_min, clip_max), requires_grad=True)
-
-    return x_adv
+    return whitebox.cw(model, x, y, epsilon, num_steps, step_size, clip_min, clip_max, is_random)
 
 
 def fgsm_whitebox(
@@ -381,22 +393,7 @@ def fgsm_whitebox(
     clip_max,
     is_random=True,
 ):
-
-    x_adv = Variable(x.data, requires_grad=True)
-
-    opt = optim.SGD([x_adv], lr=1e-3)
-    opt.zero_grad()
-
-    with torch.enable_grad():
-        loss = nn.CrossEntropyLoss()(model(x_adv), y)
-    loss.backward()
-    eta = epsilon * x_adv.grad.data.sign()
-    x_adv = Variable(x_adv.data + eta, requires_grad=True)
-    eta = torch.clamp(x_adv.data - x.data, -epsilon, epsilon)
-    x_adv = Variable(x.data + eta, requires_grad=True)
-    x_adv = Variable(torch.clamp(x_adv, clip_min, clip_max), requires_grad=True)
-
-    return x_adv
+    return whitebox.fgsm(model, x, y, epsilon, clip_min, clip_max)
 
 
 def fgsm(gradz, step_size):
@@ -436,4 +433,29 @@ def autoattack_whitebox(
     attacker = torchattacks.AutoAttack(model=model, eps=epsilon)
     x_adv = attacker(x, y)
     x_adv = torch.clamp(x_adv, clip_min, clip_max)
-    return x_adv
\ No newline at end of file
+    return x_adv
+
+
+def fmn_whitebox(
+    model,
+    x,
+    y,
+    device,
+    epsilon,
+    num_steps,
+    step_size,
+    clip_min,
+    clip_max,
+    is_random=True
+ ):
+    # Minimum-norm attack: the adversarial counts only if its linf norm is within epsilon
+    attacker = FMNOpt(model=model, dataset=TensorDataset(x, y), norm='inf', steps=num_steps,
+                      batch_size=len(x), batch_number=1, optimizer='SGD', scheduler='CosineAnnealingLR',
+                      optimizer_config={'lr': 10, 'momentum': 0.9}, scheduler_config={'T_max': num_steps},
+                      device=device)
+    attacker.run_batch(0, x, y)
+    best_adv = attacker.load_batch(0)['best_adv']
+    best_norm = (best_adv - x).flatten(1).norm(p=float('inf'), dim=1)
+    x_adv = torch.where((best_norm <= epsilon).view(-1, *[1] * (x.dim() - 1)), best_adv, x)
+    x_adv = torch.clamp(x_adv, clip_min, clip_max)
+    return x_adv
@@ -4,7 +4,16 @@ import torchvision
 from torch.autograd import Variable
 
 from utils.logging import AverageMeter, ProgressMeter
-from utils.adv import pgd_whitebox, fgsm, fgsm_whitebox, cw_whitebox, cw_loss
+from utils.adv import (
+    pgd_whitebox,
+    fgsm,
+    fgsm_whitebox,
+    cw_whitebox,
+    cw_loss,
+    autopgd_whitebox,
+    autoattack_whitebox,
+    fmn_whitebox
+)
 
 import numpy as np
 import time
@@ -339,3 +348,164 @@ def nat_imagenet(model, args, device, test_loader):
         progress.display(i)  # print final results
 
     return top1.avg, top5.avg
+
+
+def whitebox_attacker(attack, args):
+    """Returns (attacker, num_steps, step_size) of a named white-box attack"""
+    num_steps, step_size = args.num_steps, args.step_size
+    if attack == 'pgd10':
+        attacker, num_steps = pgd_whitebox, 10
+    elif attack == 'pgd20':
+        attacker, num_steps = pgd_whitebox, 20
+    elif attack == 'pgd50':
+        attacker, num_steps = pgd_whitebox, 50
+        step_size = 2.5 * args.epsilon / num_steps
+    elif attack == 'fgsm':
+        attacker = fgsm_whitebox
+    elif attack == 'cw':
+        attacker, num_steps = cw_whitebox, 20
+    elif attack == 'autopgd':
+        attacker, num_steps = autopgd_whitebox, 50
+    elif attack == 'fmn':
+        attacker, num_steps = fmn_whitebox, 100
+    elif attack == 'autoattack':
+        attacker = autoattack_whitebox
+    else:
+        raise NameError(f'{attack} is not supported for white-box attack!')
+    return attacker, num_steps, step_size
+
+
+def cascade(model, device, test_loader, attacks, args, logger):
+    """
+        Evaluate a cascade of white-box attacks, ordered from the cheapest to the most expensive.
+        Each stage only attacks the samples that are still robust (correctly classified and not
+        broken by any earlier stage), so the robust accuracy after stage k is exact for the
+        union of attacks[:k + 1] and the last stage gives the exact worst-case robust accuracy.
+    """
+    model.eval()
+
+    total = 0
+    nat_correct = 0
+    robust_after = [0] * len(attacks)
+    attacked = [0] * len(attacks)
+    stage_time = [0.0] * len(attacks)
+
+    for i, data in enumerate(test_loader):
+        images, target = data[0].to(device), data[1].to(device)
+
+        # Clean logits are computed once and decide the first set of survivors
+        with torch.no_grad():
+            robust = model(images).argmax(dim=1) == target
+        total += len(target)
+        nat_correct += robust.sum().item()
+
+        for stage, attack in enumerate(attacks):
+            survivors = robust.nonzero(as_tuple=True)[0]
+            if len(survivors) > 0:
+                attacker, num_steps, step_size = whitebox_attacker(attack, args)
+
+                end = time.time()
+                x_adv = attacker(
+                    model,
+                    images[survivors],
+                    target[survivors],
+                    device,
+                    args.epsilon,
+                    num_steps,
+                    step_size,
+                    args.clip_min,
+                    args.clip_max,
+                    is_random=not args.const_init,
+                )
+                with torch.no_grad():
+                    robust[survivors] = model(x_adv).argmax(dim=1) == target[survivors]
+                stage_time[stage] += time.time() - end
+                attacked[stage] += len(survivors)
+
+            robust_after[stage] += robust.sum().item()
+
+        if (i + 1) % args.print_freq == 0:
+            logger.info(f"[{i + 1}/{len(test_loader)}] worst-case robust accuracy: "
+                        f"{100.0 * robust_after[-1] / total:.2f}")
+
+    nat_acc = 100.0 * nat_correct / total
+    robust_acc = [100.0 * count / total for count in robust_after]
+
+    logger.info(f"CASCADE: Benign validation accuracy: {nat_acc}")
+    for stage, attack in enumerate(attacks):
+        logger.info(f"CASCADE: robust accuracy up to {attack.upper()}: {robust_acc[stage]} "
+                    f"(attacked {attacked[stage]}/{total} samples in {stage_time[stage]:.1f}s)")
+    logger.info(f"CASCADE: worst-case robust accuracy: {robust_acc[-1]}")
+
+    return nat_acc, dict(zip(attacks, robust_acc))
+
+
+def incremental(model, device, test_loader, attacks, args, db, checkpoint, logger):
+    """
+        Evaluate white-box attacks per sample against a RobustnessDB: only the (sample, attack) pairs
+        missing for this checkpoint are attacked, then per-attack and worst-case robust accuracy are
+        computed from the stored outcomes. The test loader must not shuffle (sample = dataset index).
+    """
+    model.eval()
+
+    keys = {}
+    for attack in attacks:
+        _, num_steps, step_size = whitebox_attacker(attack, args)
+        keys[attack] = db.attack_key(attack, {
+            'dataset': args.dataset,
+            'epsilon': args.epsilon,
+            'num_steps': num_steps,
+            'step_size': step_size,
+            'clip': [args.clip_min, args.clip_max],
+            'random_init': not args.const_init,
+        })
+
+    offset = 0
+    for i, data in enumerate(test_loader):
+        images, target = data[0].to(device), data[1].to(device)
+        samples = list(range(offset, offset + len(target)))
+        offset += len(target)
+
+        for attack in attacks:
+            missing = db.missing(checkpoint, keys[attack], samples)
+            if not missing:
+                continue
+
+            attacker, num_steps, step_size = whitebox_attacker(attack, args)
+            rows = torch.tensor([sample - samples[0] for sample in missing], device=device)
+
+            end = time.time()
+            x_adv = attacker(
+                model,
+                images[rows],
+                target[rows],
+                device,
+                args.epsilon,
+                num_steps,
+                step_size,
+                args.clip_min,
+                args.clip_max,
+                is_random=not args.const_init,
+            )
+            with torch.no_grad():
+                success = model(x_adv).argmax(dim=1) != target[rows]
+            runtime = (time.time() - end) / len(missing)
+
+            norms = (x_adv.detach() - images[rows]).flatten(1).norm(p=float('inf'), dim=1)
+            queries = None if attack in ('autopgd', 'autoattack') else (1 if attack == 'fgsm' else num_steps)
+            db.record(checkpoint, keys[attack], missing, success.cpu().tolist(), norms.cpu().tolist(),
+                      queries=queries, runtime=runtime)
+
+        if (i + 1) % args.print_freq == 0:
+            logger.info(f"[{i + 1}/{len(test_loader)}] evaluated")
+
+    robust_acc = {}
+    for attack in attacks:
+        acc, count = db.robust_accuracy(checkpoint, keys[attack])
+        robust_acc[attack] = 100.0 * acc
+        logger.info(f"DB: robust accuracy by {attack.upper()}: {robust_acc[attack]} ({count} samples)")
+
+    worst_acc, count = db.worst_case(checkpoint, list(keys.values()))
+    logger.info(f"DB: worst-case robust accuracy: {100.0 * worst_acc} ({count} samples)")
+
+    return robust_acc, 100.0 * worst_acc
@@ -0,0 +1,166 @@
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from HARP.models.layers import GetSubnet, SubnetConv, SubnetLinear
+from HARP.models.vgg_cifar import VGG
+from HARP.models.resnet_cifar import BasicBlock as ResNetBasicBlock, Bottleneck
+from HARP.models.wrn_cifar import BasicBlock as WRNBasicBlock
+from HARP.utils.utils import rate_act_func
+
+
+class ChannelSelect(nn.Module):
+    """
+        Keeps the given input channels. Used in front of layers reading the residual stream,
+        whose channels are shared with other layers and cannot be removed at the producer.
+    """
+
+    def __init__(self, index):
+        super(ChannelSelect, self).__init__()
+        self.register_buffer("index", index)
+
+    def forward(self, x):
+        return x.index_select(1, self.index)
+
+
+def kept_channels(layer):
+    """Indices of the input channels (features) kept by a channel-pruned subnet layer"""
+    assert layer.popup_scores.shape[0] == 1, \
+        "Only input-channel masks (channel pruning in finetune mode) can be exported"
+
+    with torch.no_grad():
+        if layer.task_mode == 'pretrain':
+            k = 1.0
+        else:
+            k = rate_act_func(layer.k_score, layer.k_min)
+        mask = GetSubnet.apply(layer.popup_scores.abs(), k, 'channel')
+    return mask.flatten().nonzero(as_tuple=True)[0]
+
+
+def producer_chains(model):
+    """
+        (producer, batch_norm, consumer, features_per_channel) tuples where the output channels of
+        `producer` only feed `consumer`: channels dropped by the consumer mask can be removed from
+        the producer and its batch norm. Layers reading the residual stream are not in any chain.
+    """
+    chains = []
+    if isinstance(model, VGG):
+        convs = [m for m in model.features if isinstance(m, SubnetConv)]
+        bns = [m for m in model.features if isinstance(m, nn.BatchNorm2d)]
+        bns = bns if len(bns) == len(convs) else [None] * len(convs)
+        for i in range(len(convs) - 1):
+            chains.append((convs[i], bns[i], convs[i + 1], 1))
+
+        linears = [m for m in model.classifier if isinstance(m, SubnetLinear)]
+        # features -> 2x2 average pool -> flatten: 4 classifier inputs per channel
+        chains.append((convs[-1], bns[-1], linears[0], 4))
+        for i in range(len(linears) - 1):
+            chains.append((linears[i], None, linears[i + 1], 1))
+        return chains
+
+    for m in model.modules():
+        if isinstance(m, ResNetBasicBlock):
+            chains.append((m.conv1, m.bn1, m.conv2, 1))
+        elif isinstance(m, Bottleneck):
+            chains.append((m.conv1, m.bn1, m.conv2, 1))
+            chains.append((m.conv2, m.bn2, m.conv3, 1))
+        elif isinstance(m, WRNBasicBlock):
+            chains.append((m.conv1, m.bn2, m.conv2, 1))
+    return chains
+
+
+def dense_layer(layer, in_index, out_index):
+    """Dense Conv2d/Linear with the masked weights of a subnet layer, sliced to the given channels"""
+    with torch.no_grad():
+        weight = layer._masked_weight()[out_index][:, in_index]
+        bias = None if layer.bias is None else layer.bias[out_index]
+
+    if isinstance(layer, nn.Conv2d):
+        dense = nn.Conv2d(len(in_index), len(out_index), layer.kernel_size, layer.stride, layer.padding,
+                          layer.dilation, layer.groups, bias=bias is not None)
+    else:
+        dense = nn.Linear(len(in_index), len(out_index), bias=bias is not None)
+
+    dense.weight.data.copy_(weight)
+    if bias is not None:
+        dense.bias.data.copy_(bias)
+    return dense.to(layer.weight.device)
+
+
+def slice_bn(bn, index):
+    sliced = nn.BatchNorm2d(len(index), eps=bn.eps, momentum=bn.momentum, affine=bn.affine,
+                            track_running_stats=bn.track_running_stats).to(bn.running_mean.device)
+    with torch.no_grad():
+        if bn.affine:
+            sliced.weight.copy_(bn.weight[index])
+            sliced.bias.copy_(bn.bias[index])
+        sliced.running_mean.copy_(bn.running_mean[index])
+        sliced.running_var.copy_(bn.running_var[index])
+        sliced.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return sliced
+
+
+def _replace(model, target, new_module):
+    # The new module runs in the mode of the one it replaces (eval for an exported model)
+    new_module.train(target.training)
+    for name, module in model.named_modules():
+        for child_name, child in module.named_children():
+            if child is target:
+                setattr(module, child_name, new_module)
+                return
+    raise ValueError("Module to replace not found in the model")
+
+
+def export_channel_pruned(model):
+    """
+        Turns a channel-pruned HARP model (prune_reg='channel') into a smaller dense network:
+        - channels masked by a layer whose producer only feeds it are physically removed from the
+          producer conv/linear, its batch norm and the layer itself (VGG chains, inner block convs);
+        - layers reading the residual stream (or the image) keep the stream at full width and
+          gather their kept channels with ChannelSelect.
+        Outputs are the same as the masked model, up to floating point.
+    """
+    model = copy.deepcopy(model).eval()
+    layers = [m for m in model.modules() if isinstance(m, (SubnetConv, SubnetLinear))]
+    assert all(m.prune_reg == 'channel' for m in layers), "Only channel-pruned models can be exported"
+
+    in_index = {m: kept_channels(m) for m in layers}
+    out_index = {m: torch.arange(m.weight.shape[0], device=m.weight.device) for m in layers}
+    absorbed, bn_index = set(), {}
+
+    for producer, bn, consumer, factor in producer_chains(model):
+        channels = torch.unique(in_index[consumer] // factor)
+        out_index[producer] = channels
+        if bn is not None:
+            bn_index[bn] = channels
+        # The consumer now reads every feature of the kept channels (masked ones have zero weight)
+        in_index[consumer] = (channels.unsqueeze(1) * factor + torch.arange(factor, device=channels.device)).flatten()
+        absorbed.add(consumer)
+
+    for bn, index in bn_index.items():
+        _replace(model, bn, slice_bn(bn, index))
+
+    for layer in layers:
+        dense = dense_layer(layer, in_index[layer], out_index[layer])
+        if layer not in absorbed and len(in_index[layer]) < layer.weight.shape[1]:
+            dense = nn.Sequential(ChannelSelect(in_index[layer]), dense)
+        _replace(model, layer, dense)
+
+    return model
+
+
+def measure_latency(model, input_size, repeats=50, warmup=10):
+    """Median CPU forward latency in ms for a batch of `input_size`"""
+    model = model.eval().cpu()
+    x = torch.rand(input_size)
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            model(x)
+            if i >= warmup:
+                times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
@@ -23,8 +23,8 @@ def count_flops_conv(height,
     kernel_size = [kernel_size] * 2
   n = kernel_size[0] * kernel_size[1] * in_channels
   flops_per_instance = 2 * n - 1
-  out_height = (height - kernel_size[0] + 2 * padding) / stride + 1
-  out_width = (width - kernel_size[1] + 2 * padding) / stride + 1
+  out_height = (height - kernel_size[0] + 2 * padding) // stride + 1
+  out_width = (width - kernel_size[1] + 2 * padding) // stride + 1
   num_instances_per_channel = out_height * out_width
   flops_per_channel = num_instances_per_channel * flops_per_instance
   total_flops = out_channels * flops_per_channel
@@ -49,8 +49,8 @@ def count_flops_max_pool(height,
   if isinstance(stride, int):
     stride = [stride] * 2
   flops_per_instance = kernel_size[0] * kernel_size[1]
-  out_height = (height - kernel_size[0] + 2 * padding) / stride[0] + 1
-  out_width = (width - kernel_size[1] + 2 * padding) / stride[1] + 1
+  out_height = (height - kernel_size[0] + 2 * padding) // stride[0] + 1
+  out_width = (width - kernel_size[1] + 2 * padding) // stride[1] + 1
   num_instances_per_channel = out_height * out_width
   flops_per_channel = num_instances_per_channel * flops_per_instance
   total_flops = channels * flops_per_channel
@@ -1,7 +1,11 @@
+import weakref
+
 import numpy as np
 import torch
 from HARP.models.layers import SubnetConv, SubnetLinear
 from HARP.utils.utils import rate_act_func
+from HARP.utils.profiler import trace, profile, dummy_input_size
+from HARP.utils.latency import load_latency_lut, interpolate
 
 
 def count_flops_dense(in_features, out_features, bias=True, activation=True):
@@ -27,8 +31,8 @@ def count_flops_conv(height,
     kernel_size = [kernel_size] * 2
   n = kernel_size[0] * kernel_size[1] * in_channels
   flops_per_instance = 2 * n - 1
-  out_height = (height - kernel_size[0] + 2 * padding) / stride + 1
-  out_width = (width - kernel_size[1] + 2 * padding) / stride + 1
+  out_height = (height - kernel_size[0] + 2 * padding) // stride + 1
+  out_width = (width - kernel_size[1] + 2 * padding) // stride + 1
   num_instances_per_channel = out_height * out_width
   flops_per_channel = num_instances_per_channel * flops_per_instance
   total_flops = out_channels * flops_per_channel
@@ -53,8 +57,8 @@ def count_flops_max_pool(height,
   if isinstance(stride, int):
     stride = [stride] * 2
   flops_per_instance = kernel_size[0] * kernel_size[1]
-  out_height = (height - kernel_size[0] + 2 * padding) / stride[0] + 1
-  out_width = (width - kernel_size[1] + 2 * padding) / stride[1] + 1
+  out_height = (height - kernel_size[0] + 2 * padding) // stride[0] + 1
+  out_width = (width - kernel_size[1] + 2 * padding) // stride[1] + 1
   num_instances_per_channel = out_height * out_width
   flops_per_channel = num_instances_per_channel * flops_per_instance
   total_flops = channels * flops_per_channel
@@ -129,6 +133,129 @@ def resnet18_flops(num_units, n_classes):
   return flops
 
 
+class HWCost:
+    """
+        HW cost of a model compiled once: the k_score of every subnet layer is gathered into one rate
+        vector (plus a constant 1 slot) and every traced layer costs a * r[in] * r[density] * r[out] + b * r[out]
+        FLOPs (conv: a = 2 * kk * C_in / groups * P * C_out, b = P * C_out; linear: P = kk = 1; pool: a = 0),
+        the same count as profiler.profile, so the survived FLOPs/params ratios are a few batched tensor ops.
+        With args.latency_lut, the measured latency of every conv/linear layer is interpolated in the LUT
+        at its (r[in], r[out]) instead.
+    """
+
+    def __init__(self, model, args):
+        net = model.module if isinstance(model, torch.nn.DataParallel) else model
+        named = [(name, m) for name, m in net.named_modules() if hasattr(m, "k_score")]
+        self.k_scores = [m.k_score for _, m in named]
+        device = self.k_scores[0].device
+        self.k_min = torch.tensor([m.k_min for _, m in named], dtype=torch.float32, device=device)
+
+        self.numel = torch.tensor([m.weight.numel() for _, m in named], dtype=torch.float32, device=device)
+
+        if args.prune_reg == 'channel':
+            index = {name: i for i, (name, _) in enumerate(named)}
+            self._compile_flops(net, args, index, device)
+            if getattr(args, 'latency_lut', None):
+                self._compile_latency(net, args, index, device)
+
+    @staticmethod
+    def _rate_rows(net, records, index):
+        """Rate vector slots of the input, density and output rates of every traced conv/linear layer"""
+        modules = dict(net.named_modules())
+        one = len(index)
+
+        layers = [r for r in records if r['type'] != 'pool']
+        in_idx, dens_idx = {}, {}
+        for r in layers:
+            channel = getattr(modules[r['name']], 'prune_reg', None) == 'channel'
+            in_idx[r['name']] = index[r['name']] if channel and r['name'] in index else one
+            dens_idx[r['name']] = index[r['name']] if not channel and r['name'] in index else one
+        out_idx = {r['name']: in_idx[layers[i + 1]['name']] if i + 1 < len(layers) else one
+                   for i, r in enumerate(layers)}
+        return layers, in_idx, dens_idx, out_idx
+
+    def _compile_flops(self, net, args, index, device):
+        size = dummy_input_size(args)
+        records = trace(net, size, args.arch)
+        one = len(index)
+        _, in_idx, dens_idx, out_idx = self._rate_rows(net, records, index)
+
+        a, b, rows_in, rows_dens, rows_out = [], [], [], [], []
+        for r in records:
+            if r['type'] == 'pool':
+                a.append(0.0)
+                b.append(r['channels'] * r['positions'] * r['kernel'])
+                rows_in.append(one)
+                rows_dens.append(one)
+                rows_out.append(out_idx.get(r['source'], one))
+            else:
+                a.append(2 * r['kernel'] * r['in_channels'] / r['groups'] * r['positions'] * r['out_channels'])
+                b.append(r['positions'] * r['out_channels'])
+                rows_in.append(in_idx[r['name']])
+                rows_dens.append(dens_idx[r['name']])
+                rows_out.append(out_idx[r['name']])
+
+        self.a = torch.tensor(a, dtype=torch.float32, device=device)
+        self.b = torch.tensor(b, dtype=torch.float32, device=device)
+        self.rows_in = torch.tensor(rows_in, device=device)
+        self.rows_dens = torch.tensor(rows_dens, device=device)
+        self.rows_out = torch.tensor(rows_out, device=device)
+
+        self.total_flops = (self.a + self.b).sum().item()
+        target = {name: args.k for name in index}
+        self.target_flops = float(profile(net, size, args.arch, rates=target, out_rates=target,
+                                          round_channels=True)['flops'])
+
+    def _compile_latency(self, net, args, index, device):
+        lut = load_latency_lut(args.latency_lut)
+        assert tuple(lut['input_size']) == dummy_input_size(args), \
+            f"Latency LUT measured for input {lut['input_size']}, not {dummy_input_size(args)}"
+
+        records = trace(net, dummy_input_size(args), args.arch)
+        layers, in_idx, _, out_idx = self._rate_rows(net, records, index)
+        missing = [r['name'] for r in layers if r['name'] not in lut['layers']]
+        assert not missing, f"Latency LUT of {lut['arch']} has no entry for {missing}"
+
+        self.lut_rates = lut['rates']
+        self.lut = torch.tensor([lut['layers'][r['name']] for r in layers], dtype=torch.float32, device=device)
+        self.lut_in = torch.tensor([in_idx[r['name']] for r in layers], device=device)
+        self.lut_out = torch.tensor([out_idx[r['name']] for r in layers], device=device)
+
+        full = torch.ones(len(layers), device=device)
+        self.total_latency = interpolate(self.lut, self.lut_rates, full, full).sum().item()
+        target = torch.full((len(layers),), args.k, device=device)
+        self.target_latency = interpolate(self.lut, self.lut_rates, torch.where(self.lut_in < len(index), target, full),
+                                          torch.where(self.lut_out < len(index), target, full)).sum().item()
+
+    def rates(self):
+        return rate_act_func(torch.stack(self.k_scores), self.k_min)
+
+    def param_rate(self):
+        return (self.numel * self.rates()).sum() / self.numel.sum()
+
+    def flops_rate(self):
+        rates = self.rates()
+        r = torch.cat([rates, rates.new_ones(1)])
+        r_out = r[self.rows_out]
+        return (self.a * r[self.rows_in] * r[self.rows_dens] * r_out + self.b * r_out).sum() / self.total_flops
+
+    def latency_rate(self):
+        rates = self.rates()
+        r = torch.cat([rates, rates.new_ones(1)])
+        return interpolate(self.lut, self.lut_rates, r[self.lut_in], r[self.lut_out]).sum() / self.total_latency
+
+
+_hw_costs = weakref.WeakKeyDictionary()
+
+
+def hw_cost(model, args):
+    """HWCost of `model`, compiled at the first call (the prune rates must be set)"""
+    cost = _hw_costs.get(model)
+    if cost is None:
+        cost = _hw_costs[model] = HWCost(model, args)
+    return cost
+
+
 def hw_loss(
     model,
     device,
@@ -146,20 +273,7 @@ def hw_loss(
     if print_target:
         print(f'\n>> Target Rate for Weight-Prune = {target_rate:.3f}')
 
-    # Starting count parameters with newly founded strategy
-
-    total_params = torch.tensor(0, dtype=torch.float32, device=device)
-    surv_params = None
-
-    for m_name, m in model.named_modules():
-        if hasattr(m, "k_score"):
-            layer_params = torch.tensor(m.weight.shape.numel(), device=device)
-            total_params += layer_params
-
-            w_survs = m.weight.shape.numel() * (rate_act_func(m.k_score, m.k_min))
-            surv_params = w_survs if not surv_params else surv_params + w_survs
-
-    current_rate = surv_params/total_params
+    current_rate = hw_cost(model, args).param_rate()
     loss_hw = torch.maximum(current_rate / target_rate-1.0, torch.tensor(0.0))
 
     if args.gamma_dynamic:
@@ -183,81 +297,51 @@ def hw_flops_loss(
     print_target=False
 ):
 
-    fmap_dict={
-        'vgg16_bn': [32, 32, 16, 16, 8, 8, 8, 4, 4, 4, 2, 2, 2, 1, 1, 1],
-        'resnet18': [32, 32, 32, 32, 32, 32, 16, 32, 16, 16, 16, 8, 16, 8, 8, 8, 4, 8, 4, 4, 1]
-    }
-
-    fmap_list = fmap_dict[args.arch]
-
-    total_flops = torch.tensor(0, dtype=torch.float32, device=device)
-
     assert args.prune_reg == 'channel'
 
-    exp_surv_params = None
-    idx = 0
-    for m in model.modules():
-        if hasattr(m, "k_score"):
-            if isinstance(m, SubnetConv):
-                layer_flops = count_flops_conv(fmap_list[idx], fmap_list[idx], m.weight.shape[1], m.weight.shape[0],
-                                               kernel_size=m.kernel_size, stride=m.stride[0], padding=m.padding[0])
-                l_target_flops = count_flops_conv(fmap_list[idx], fmap_list[idx], round(m.weight.shape[1]*args.k), round(m.weight.shape[0]*args.k),
-                                               kernel_size=m.kernel_size, stride=m.stride[0], padding=m.padding[0])
-
-            if isinstance(m, SubnetLinear):
-                layer_flops = count_flops_dense(m.weight.shape[1], m.weight.shape[0])
-                l_target_flops = count_flops_dense(round(m.weight.shape[1]*args.k), round(m.weight.shape[0]*args.k))
-
-            total_flops += layer_flops
-            exp_surv_params = l_target_flops if exp_surv_params is None else l_target_flops + exp_surv_params
-
-            idx += 1
-
-    target_rate = exp_surv_params / total_flops
+    cost = hw_cost(model, args)
+    target_rate = cost.target_flops / cost.total_flops
 
     if print_target:
-        print(f'\n>> Considering CHANNEL pruning, real target rate (FLOPs) = {int(exp_surv_params)}/{int(total_flops)} = {target_rate:.3f}')
-
-    # Starting count parameters with newly founded strategy
+        print(f'\n>> Considering CHANNEL pruning, real target rate (FLOPs) = {int(cost.target_flops)}/{int(cost.total_flops)} = {target_rate:.3f}')
 
-    surv_flops = None
-    m_pre = None
-    idx = 0
-    for m_name, m in model.named_modules():
-        if hasattr(m, "k_score"):
-            if m_pre is not None:
-                k_in_pre = rate_act_func(m_pre.k_score, m_pre.k_min)
-
-                k_in = rate_act_func(m.k_score, m.k_min)
+    optimizer.zero_grad()
 
-                # if m_name_pre.find('shorcut') == -1:
-                pre_num_ch = m_pre.weight.shape[1] * k_in_pre
-                pre_num_fi = m_pre.weight.shape[0] * k_in
+    current_rate = cost.flops_rate()
+    loss_hw = torch.maximum(current_rate / target_rate-1.0, torch.tensor(0.0))
+    # loss_hw = torch.maximum(torch.log(current_rate / target_rate), torch.tensor(0.0))
 
-                if isinstance(m_pre, SubnetConv):
-                    l_pre_flops = count_flops_conv(fmap_list[idx - 1], fmap_list[idx - 1], pre_num_ch, pre_num_fi,
-                                                   kernel_size=m_pre.kernel_size, stride=m_pre.stride[0], padding=m_pre.padding[0])
+    if args.gamma_dynamic:
+        if frozen_gamma is not None:
+            gamma = frozen_gamma
+        else:
+            gamma = (epoch + 1) * args.gamma
+    else:
+        gamma = torch.tensor(args.gamma)
 
-                if isinstance(m_pre, SubnetLinear):
-                    l_pre_flops = count_flops_dense(pre_num_ch, pre_num_fi)
+    return gamma, loss_hw, current_rate
 
-                # On the last FC layer
-                if m.weight.shape[0] == args.num_classes:
-                    num_ch = m.weight.shape[1] * k_in
-                    assert isinstance(m, SubnetLinear), 'Last layer in HW loss should be Dense Layer!'
-                    l_pre_flops += count_flops_dense(num_ch, m.weight.shape[0])
 
-                surv_flops = l_pre_flops if not surv_flops else l_pre_flops + surv_flops
+def hw_latency_loss(
+    model,
+    device,
+    optimizer,
+    args,
+    epoch=0,
+    frozen_gamma=None,
+    print_target=False
+):
 
-            m_pre = m
+    assert args.prune_reg == 'channel' and args.latency_lut, 'Latency loss needs channel pruning and a --latency_lut'
 
-            idx += 1
+    cost = hw_cost(model, args)
+    target_rate = cost.target_latency / cost.total_latency
 
-    optimizer.zero_grad()
+    if print_target:
+        print(f'\n>> Considering CHANNEL pruning, target rate (CPU latency) = {cost.target_latency:.3f}/{cost.total_latency:.3f} ms = {target_rate:.3f}')
 
-    current_rate = surv_flops/total_flops
+    current_rate = cost.latency_rate()
     loss_hw = torch.maximum(current_rate / target_rate-1.0, torch.tensor(0.0))
-    # loss_hw = torch.maximum(torch.log(current_rate / target_rate), torch.tensor(0.0))
 
     if args.gamma_dynamic:
         if frozen_gamma is not None:
@@ -270,6 +354,12 @@ def hw_flops_loss(
     return gamma, loss_hw, current_rate
 
 
+def get_hw_loss_func(args):
+    if args.prune_reg == 'channel':
+        return hw_latency_loss if args.latency_lut else hw_flops_loss
+    return hw_loss
+
+
 ###########################################
 #              Test Flops                 #
 ###########################################
@@ -0,0 +1,84 @@
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from HARP.utils.profiler import trace
+from HARP.utils.export import measure_latency
+
+
+def rate_grid(points=10, min_rate=0.05):
+    """Uniform grid of kept-channel rates the LUT is measured on, up to 1.0"""
+    return [float(r) for r in np.linspace(min_rate, 1.0, points)]
+
+
+def _scaled_layer(module, record, in_rate, out_rate):
+    """Dense layer with the shape of `module` keeping the given fractions of its channels"""
+    in_channels = max(1, round(record['in_channels'] * in_rate))
+    out_channels = max(1, round(record['out_channels'] * out_rate))
+    if record['type'] == 'conv':
+        full_width = (in_channels, out_channels) == (record['in_channels'], record['out_channels'])
+        layer = nn.Conv2d(in_channels, out_channels, module.kernel_size, module.stride, module.padding,
+                          module.dilation, groups=module.groups if full_width else 1, bias=module.bias is not None)
+        return layer, (1, in_channels) + tuple(record['in_shape'][2:])
+    return nn.Linear(in_channels, out_channels, bias=module.bias is not None), (1, in_channels)
+
+
+def build_latency_lut(model, input_size=(1, 3, 32, 32), arch=None, points=10, min_rate=0.05, repeats=20):
+    """
+        Measures the CPU latency (ms, batch of one) of every conv/linear layer of `model` at each
+        (kept input channels, kept output channels) rate pair of the grid. Grouped convolutions are
+        measured at full width.
+    """
+    records = trace(model, input_size, arch)
+    net = model.module if isinstance(model, nn.DataParallel) else model
+    modules = dict(net.named_modules())
+    rates = rate_grid(points, min_rate)
+
+    lut = {'arch': arch or net._get_name(), 'input_size': list(input_size), 'rates': rates, 'layers': {}}
+    for r in records:
+        if r['type'] == 'pool':
+            continue
+        module = modules[r['name']]
+        table = []
+        for in_rate in rates:
+            row = []
+            for out_rate in rates:
+                if r['groups'] == 1:
+                    layer, layer_input = _scaled_layer(module, r, in_rate, out_rate)
+                else:
+                    layer, layer_input = _scaled_layer(module, r, 1.0, 1.0)
+                row.append(measure_latency(layer, layer_input, repeats=repeats, warmup=repeats // 4))
+            table.append(row)
+        lut['layers'][r['name']] = table
+    return lut
+
+
+def save_latency_lut(lut, path):
+    with open(path, 'w') as f:
+        json.dump(lut, f)
+
+
+def load_latency_lut(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def interpolate(tables, rates, r_in, r_out):
+    """
+        Bilinear interpolation of per-layer latency tables [L, G, G] at the rates (r_in, r_out) of
+        each layer, on the uniform grid `rates`. Differentiable w.r.t. r_in and r_out.
+    """
+    last = len(rates) - 1
+    lo, step = rates[0], (rates[-1] - rates[0]) / last
+
+    x = ((r_in - lo) / step).clamp(0, last)
+    y = ((r_out - lo) / step).clamp(0, last)
+    x0 = x.detach().floor().clamp(max=last - 1).long()
+    y0 = y.detach().floor().clamp(max=last - 1).long()
+    fx, fy = x - x0, y - y0
+
+    layers = torch.arange(tables.shape[0], device=tables.device)
+    return tables[layers, x0, y0] * (1 - fx) * (1 - fy) + tables[layers, x0 + 1, y0] * fx * (1 - fy) + \
+        tables[layers, x0, y0 + 1] * (1 - fx) * fy + tables[layers, x0 + 1, y0 + 1] * fx * fy
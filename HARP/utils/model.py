@@ -4,8 +4,8 @@ import torch.nn as nn
 import os
 import math
 import numpy as np
-from HARP.utils.hw import vgg16_bn_flops, resnet18_flops
-from HARP.models.layers import SubnetConv, SubnetLinear
+from HARP.utils.profiler import profile, dummy_input_size
+from HARP.models.layers import SubnetConv, SubnetLinear, topk_mask
 from HARP.utils.utils import rate_act_func, rate_init_func
 
 # TODO: avoid freezing bn_params
@@ -129,6 +129,7 @@ def initialize_scaled_score(model, prune_reg='weight'):
                 # """
             else:
                 raise NameError('Please check prune_reg, current "{}" is not in [weight, channel] !'.format(prune_reg))
+            m.reset_frozen_mask()
 
 
 def initialize_stg_rate(model, args, device, logger):
@@ -141,6 +142,7 @@ def initialize_stg_rate(model, args, device, logger):
             else:
                 # Update k_score
                 m.k_score.data = rate_init_func(m.k, m.k_min, device)
+                m.reset_frozen_mask()
 
                 # Display real prune rate
                 k = rate_act_func(m.k_score.data, m.k_min)
@@ -163,17 +165,10 @@ def display_loadrate(model, logger, args):
                 ch_list.append(round(m.weight.shape[1]*k.detach().cpu().numpy()))
 
     if args.prune_reg == "channel":
-        model_name = model.module._get_name() if args.gpu.find(',') != -1 and not args.no_cuda else model._get_name()
-        if model_name == 'VGG':
-            flops_counter = vgg16_bn_flops
-        elif model_name == 'ResNet':
-            if model.num_classes == 10:
-                flops_counter = resnet18_flops
-        else:
-            raise NameError(f'{model_name} has no FLOPs counter yet.')
-
-        orig_flops = flops_counter(orig_list, 10)
-        net_flops = flops_counter(ch_list, 10)
+        with torch.no_grad():
+            orig_flops = profile(model, dummy_input_size(args), args.arch, rates={})['flops']
+            net_flops = profile(model, dummy_input_size(args), args.arch, round_channels=True)['flops']
+        orig_flops, net_flops = int(orig_flops), int(net_flops)
         logger.info(f"Original channel shape: {orig_list}")
         logger.info(f"Strategy after pruning: {ch_list}")
         logger.info(f"Network FLOPs: {net_flops}/{orig_flops}")
@@ -197,6 +192,7 @@ def map_shortcut_rate(model, args, verbose=False):
                     for v in l.modules():
                         if hasattr(v, "k_score"):
                             v.k_score.data = conv_rate
+                            v.reset_frozen_mask()
 
                             if verbose:
                                 k = rate_act_func(v.k_score.data, v.k_min)
@@ -283,6 +279,17 @@ def prepare_model(model, args, device='cpu'):
     initialize_scores(model, args.scores_init_type)
 
 
+def freeze_masks(model, frozen=True):
+    """
+        Toggle the cached frozen-mask inference mode of every subnet layer (see FrozenMask):
+        the masked weights are computed once and only rebuilt when the scores or weights change.
+        Either call drops the cached weights, e.g. after writing the scores through `.data`.
+    """
+    for m in model.modules():
+        if hasattr(m, "freeze_mask"):
+            m.freeze_mask(frozen)
+
+
 def subnet_to_dense(subnet_dict, p):
     """
         Convert a subnet state dict (with subnet layers) to dense i.e., which can be directly 
@@ -300,13 +307,7 @@ def subnet_to_dense(subnet_dict, p):
         if "popup_scores" in k:
             s = torch.abs(subnet_dict[k])
 
-            out = s.clone()
-            _, idx = s.flatten().sort()
-            j = int((1 - p) * s.numel())
-
-            flat_out = out.flatten()
-            flat_out[idx[:j]] = 0
-            flat_out[idx[j:]] = 1
+            out = topk_mask(s, p)
             dense[k.replace("popup_scores", "weight")] = (
                 subnet_dict[k.replace("popup_scores", "weight")] * out
             )
@@ -0,0 +1,136 @@
+import torch
+import torch.nn as nn
+
+from HARP.utils.utils import rate_act_func
+
+# Traced layers per (arch, input size): layer shapes do not depend on the weights or the masks
+_trace_cache = {}
+
+
+def dummy_input_size(args):
+    """Dummy input size (batch of one) of the dataset of `args`"""
+    if args.dataset == 'imagenet':
+        return (1, 3, 224, 224)
+    if args.dataset == 'MNIST':
+        return (1, 1, 28, 28)
+    return (1, 3, 32, 32)
+
+
+def _unwrap(model):
+    return model.module if isinstance(model, nn.DataParallel) else model
+
+
+def trace(model, input_size=(1, 3, 32, 32), arch=None):
+    """
+        Runs one dummy forward with hooks on every Conv2d/Linear/pooling module and returns, in
+        execution order, a record of their real shapes. Functional pooling (F.avg_pool2d) is not
+        traced. Cached per (arch, input size), arch defaults to the model class name.
+    """
+    net = _unwrap(model)
+    key = (arch or net._get_name(), tuple(input_size))
+    if key in _trace_cache:
+        return _trace_cache[key]
+
+    records, hooks, last_layer = [], [], [None]
+
+    def hook(name):
+        def record(m, inputs, output):
+            x = inputs[0]
+            rec = {'name': name, 'in_shape': tuple(x.shape), 'out_shape': tuple(output.shape)}
+            if isinstance(m, nn.Conv2d):
+                rec.update(type='conv', in_channels=m.in_channels, out_channels=m.out_channels,
+                           kernel=m.kernel_size[0] * m.kernel_size[1], groups=m.groups,
+                           positions=output.shape[2] * output.shape[3], bias=m.bias is not None)
+                last_layer[0] = name
+            elif isinstance(m, nn.Linear):
+                rec.update(type='linear', in_channels=m.in_features, out_channels=m.out_features,
+                           kernel=1, groups=1, positions=1, bias=m.bias is not None)
+                last_layer[0] = name
+            else:
+                positions = output.shape[2] * output.shape[3]
+                # Pooling window, from the shapes to cover the adaptive pools as well
+                rec.update(type='pool', channels=x.shape[1], positions=positions,
+                           kernel=max(x.shape[2] * x.shape[3] // positions, 1), source=last_layer[0])
+            records.append(rec)
+        return record
+
+    for name, m in net.named_modules():
+        if isinstance(m, (nn.Conv2d, nn.Linear, nn.MaxPool2d, nn.AvgPool2d, nn.AdaptiveAvgPool2d)):
+            hooks.append(m.register_forward_hook(hook(name)))
+
+    training = net.training
+    net.eval()
+    try:
+        with torch.no_grad():
+            net(torch.zeros(input_size, device=next(net.parameters()).device))
+    finally:
+        for h in hooks:
+            h.remove()
+        net.train(training)
+
+    _trace_cache[key] = records
+    return records
+
+
+def layer_flops(record, in_rate=1.0, out_rate=1.0, density=1.0):
+    """
+        FLOPs of one traced layer, with the conventions of utils.hw.count_flops_conv/dense
+        (multiply-adds, bias and activation per output). Rates may be tensors.
+    """
+    if record['type'] == 'pool':
+        return record['channels'] * out_rate * record['positions'] * record['kernel']
+    n = record['kernel'] * record['in_channels'] * in_rate / record['groups'] * density
+    return (2 * n + 1) * record['positions'] * record['out_channels'] * out_rate
+
+
+def layer_params(record, in_rate=1.0, out_rate=1.0, density=1.0):
+    if record['type'] == 'pool':
+        return 0
+    out_channels = record['out_channels'] * out_rate
+    params = record['kernel'] * record['in_channels'] * in_rate / record['groups'] * density * out_channels
+    return params + out_channels if record['bias'] else params
+
+
+def profile(model, input_size=(1, 3, 32, 32), arch=None, rates=None, out_rates=None, round_channels=False):
+    """
+        FLOPs and params (per sample) of `model` under the kept fractions `rates` (layer name -> rate,
+        default rate_act_func(k_score, k_min) of every subnet layer; {} for the dense model).
+        A channel-pruned layer keeps its rate of input channels and, unless given in `out_rates`, the
+        input rate of the next traced layer of output channels; a weight-pruned layer keeps its rate
+        of weights. Pools follow the output channels of the layer before them.
+    """
+    records = trace(model, input_size, arch)
+    modules = dict(_unwrap(model).named_modules())
+    if rates is None:
+        rates = {name: rate_act_func(m.k_score, m.k_min) for name, m in modules.items() if hasattr(m, 'k_score')}
+    out_rates = out_rates or {}
+
+    layers = [r for r in records if r['type'] != 'pool']
+    in_rate, density = {}, {}
+    for r in layers:
+        channel = getattr(modules[r['name']], 'prune_reg', None) == 'channel'
+        in_rate[r['name']] = rates.get(r['name'], 1.0) if channel else 1.0
+        density[r['name']] = 1.0 if channel else rates.get(r['name'], 1.0)
+
+    out_rate = {}
+    for i, r in enumerate(layers):
+        following = in_rate[layers[i + 1]['name']] if i + 1 < len(layers) else 1.0
+        out_rate[r['name']] = out_rates.get(r['name'], following)
+
+    if round_channels:
+        for r in layers:
+            in_rate[r['name']] = round(r['in_channels'] * float(in_rate[r['name']])) / r['in_channels']
+            out_rate[r['name']] = round(r['out_channels'] * float(out_rate[r['name']])) / r['out_channels']
+
+    result = {'flops': 0, 'params': 0, 'layers': []}
+    for r in records:
+        if r['type'] == 'pool':
+            flops = layer_flops(r, out_rate=out_rate.get(r['source'], 1.0))
+            params = 0
+        else:
+            layer_rates = (in_rate[r['name']], out_rate[r['name']], density[r['name']])
+            flops, params = layer_flops(r, *layer_rates), layer_params(r, *layer_rates)
+        result['flops'] = result['flops'] + flops
+        result['params'] = result['params'] + params
+        result['layers'].append({'name': r['name'], 'type': r['type'], 'flops': flops, 'params': params})
+    return result
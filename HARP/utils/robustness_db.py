@@ -0,0 +1,99 @@
+import json
+import sqlite3
+import hashlib
+
+
+class RobustnessDB:
+    """
+        Local SQLite store of per-sample attack outcomes.
+        Each row is keyed by (checkpoint content hash, test sample index, attack key) and records
+        whether the attack succeeded, the perturbation norm, the queries used and the runtime.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS attacks (
+                key TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                config TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outcomes (
+                checkpoint TEXT NOT NULL,
+                sample INTEGER NOT NULL,
+                attack TEXT NOT NULL REFERENCES attacks(key),
+                success INTEGER NOT NULL,
+                norm REAL,
+                queries INTEGER,
+                runtime REAL,
+                PRIMARY KEY (checkpoint, attack, sample)
+            );
+            """
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def checkpoint_hash(path):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def attack_key(self, name, config):
+        """Registers an attack configuration and returns its key"""
+        config = json.dumps(config, sort_keys=True, default=str)
+        key = hashlib.sha256(f'{name}:{config}'.encode()).hexdigest()
+        self.conn.execute("INSERT OR IGNORE INTO attacks (key, name, config) VALUES (?, ?, ?)", (key, name, config))
+        self.conn.commit()
+        return key
+
+    def missing(self, checkpoint, attack, samples):
+        """Returns the sample indices in `samples` without an outcome for (checkpoint, attack)"""
+        done = {row[0] for row in self.conn.execute(
+            "SELECT sample FROM outcomes WHERE checkpoint = ? AND attack = ?", (checkpoint, attack))}
+        return [sample for sample in samples if sample not in done]
+
+    def record(self, checkpoint, attack, samples, success, norms=None, queries=None, runtime=None):
+        """Records the outcomes of one attack on a list of samples; runtime is per sample"""
+        rows = []
+        for i, sample in enumerate(samples):
+            rows.append((
+                checkpoint,
+                int(sample),
+                attack,
+                int(success[i]),
+                None if norms is None else float(norms[i]),
+                queries,
+                runtime
+            ))
+        self.conn.executemany("INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+
+    def robust_accuracy(self, checkpoint, attack):
+        """Fraction of the recorded samples on which the attack failed"""
+        row = self.conn.execute(
+            "SELECT AVG(1 - success), COUNT(*) FROM outcomes WHERE checkpoint = ? AND attack = ?",
+            (checkpoint, attack)).fetchone()
+        return row[0], row[1]
+
+    def worst_case(self, checkpoint, attacks):
+        """Fraction of samples robust to every attack in `attacks`, over the samples evaluated by all of them"""
+        placeholders = ', '.join('?' * len(attacks))
+        row = self.conn.execute(
+            f"""
+            SELECT AVG(robust), COUNT(*) FROM (
+                SELECT MAX(success) = 0 AS robust
+                FROM outcomes
+                WHERE checkpoint = ? AND attack IN ({placeholders})
+                GROUP BY sample
+                HAVING COUNT(DISTINCT attack) = ?
+            )
+            """,
+            (checkpoint, *attacks, len(attacks))).fetchone()
+        return row[0], row[1]
+
+    def close(self):
+        self.conn.close()
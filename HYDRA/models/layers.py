@@ -5,29 +5,103 @@ from torch.nn.parameter import Parameter
 import torch.nn.functional as F
 import math
 
-# https://github.com/allenai/hidden-networks
-class GetSubnet(autograd.Function):
-    @staticmethod
-    def forward(ctx, scores, k):
-        # Get the subnetwork by sorting the scores and using the top k%
-        out = scores.clone()
-        _, idx = scores.flatten().sort()
-        j = int((1 - k) * scores.numel())
+# Mask engine of GetSubnet: 'sort' (full sort, the reference), 'kthvalue' (exact threshold by
+# selection) or 'histogram' (approximate threshold from a score histogram, only for layers with
+# more than `histogram_numel` scores; smaller layers use kthvalue)
+mask_engine = {'engine': 'kthvalue', 'histogram_numel': 1 << 20, 'bins': 4096}
+
+
+def set_mask_engine(engine='kthvalue', histogram_numel=1 << 20, bins=4096):
+    assert engine in ('sort', 'kthvalue', 'histogram'), f'Unknown mask engine "{engine}"'
+    mask_engine.update(engine=engine, histogram_numel=histogram_numel, bins=bins)
 
+
+def _stable_threshold_mask(flat, threshold, keep):
+    """Keeps the scores above threshold and, of the ones equal to it, the last in index order up
+    to `keep` kept in total: the mask of a stable sort, without the sort"""
+    mask = flat > threshold
+    missing = keep - int(mask.sum())
+    if missing > 0:
+        tied = (flat == threshold).nonzero().squeeze(1)
+        mask[tied[-missing:]] = True
+    return mask
+
+
+def topk_mask(scores, k):
+    """0/1 mask of the same shape as scores keeping its top k fraction"""
+    flat = scores.flatten()
+    j = int((1 - k) * scores.numel())
+
+    if mask_engine['engine'] == 'sort':
+        out = scores.clone()
+        _, idx = flat.sort()
         # flat_out and out access the same memory.
         flat_out = out.flatten()
         flat_out[idx[:j]] = 0
         flat_out[idx[j:]] = 1
-
         return out
 
+    if j <= 0:
+        return torch.ones_like(scores)
+    if j >= flat.numel():
+        return torch.zeros_like(scores)
+
+    if mask_engine['engine'] == 'histogram' and flat.numel() > mask_engine['histogram_numel']:
+        # Upper edge of the histogram bin holding the j-th smallest score
+        lo, hi = flat.min(), flat.max()
+        counts = torch.histc(flat.float(), bins=mask_engine['bins'], min=lo.item(), max=hi.item())
+        bin_idx = torch.searchsorted(counts.cumsum(0), torch.tensor([float(j)], device=flat.device))
+        threshold = lo + (hi - lo) * (bin_idx.float() + 1) / mask_engine['bins']
+        # Scores above the bin are kept: up to one bin fewer than the exact top k
+        return (scores > threshold).to(scores.dtype)
+
+    threshold = flat.kthvalue(j).values
+    return _stable_threshold_mask(flat, threshold, flat.numel() - j).view_as(scores).to(scores.dtype)
+
+
+# https://github.com/allenai/hidden-networks
+class GetSubnet(autograd.Function):
+    @staticmethod
+    def forward(ctx, scores, k):
+        # Get the subnetwork by thresholding the scores and using the top k%
+        return topk_mask(scores, k)
+
     @staticmethod
     def backward(ctx, g):
         # send the gradient g straight-through on the backward pass.
         return g, None
 
 
-class SubnetConv(nn.Conv2d):
+class FrozenMask:
+    """
+        Inference mode for the subnet layers: the masked weight is built once and reused until
+        popup_scores, weight or k change (tracked by storage pointer and in-place version
+        counter), skipping GetSubnet and its autograd graph on every forward.
+        In-place writes through `.data` bypass the version counter: call reset_frozen_mask after them.
+    """
+    frozen_mask = False
+    _frozen_key = None
+    _frozen_w = None
+
+    def freeze_mask(self, frozen=True):
+        self.frozen_mask = frozen
+        self.reset_frozen_mask()
+
+    def reset_frozen_mask(self):
+        self._frozen_key, self._frozen_w = None, None
+
+    def _frozen_weight(self):
+        tensors = [self.popup_scores, getattr(self, 'k_score', None), self.weight]
+        key = tuple((t.data_ptr(), t._version) for t in tensors if t is not None) + \
+            (getattr(self, 'k', None), getattr(self, 'k_min', None))
+        if key != self._frozen_key:
+            with torch.no_grad():
+                self._frozen_w = self._masked_weight()
+            self._frozen_key = key
+        return self._frozen_w
+
+
+class SubnetConv(FrozenMask, nn.Conv2d):
     # self.k is the % of weights remaining, a real number in [0,1]
     # self.popup_scores is a Parameter which has the same shape as self.weight
     # Gradients to self.weight, self.bias have been turned off by default.
@@ -64,19 +138,21 @@ class SubnetConv(nn.Conv2d):
     def set_prune_rate(self, k):
         self.k = k
 
-    def forward(self, x):
+    def _masked_weight(self):
         # Get the subnetwork by sorting the scores.
         adj = GetSubnet.apply(self.popup_scores.abs(), self.k)
+        return self.weight * adj
 
+    def forward(self, x):
         # Use only the subnetwork in the forward pass.
-        self.w = self.weight * adj
+        self.w = self._frozen_weight() if self.frozen_mask else self._masked_weight()
         x = F.conv2d(
             x, self.w, self.bias, self.stride, self.padding, self.dilation, self.groups
         )
         return x
 
 
-class SubnetLinear(nn.Linear):
+class SubnetLinear(FrozenMask, nn.Linear):
     # self.k is the % of weights remaining, a real number in [0,1]
     # self.popup_scores is a Parameter which has the same shape as self.weight
     # Gradients to self.weight, self.bias have been turned off.
@@ -93,12 +169,14 @@ class SubnetLinear(nn.Linear):
     def set_prune_rate(self, k):
         self.k = k
 
-    def forward(self, x):
+    def _masked_weight(self):
         # Get the subnetwork by sorting the scores.
         adj = GetSubnet.apply(self.popup_scores.abs(), self.k)
+        return self.weight * adj
 
+    def forward(self, x):
         # Use only the subnetwork in the forward pass.
-        self.w = self.weight * adj
+        self.w = self._frozen_weight() if self.frozen_mask else self._masked_weight()
         x = F.linear(x, self.w, self.bias)
 
         return x
@@ -7,6 +7,7 @@ import math
 import numpy as np
 
 from HYDRA.models import SubnetConv, SubnetLinear
+from HYDRA.models.layers import topk_mask
 
 # TODO: avoid freezing bn_params
 # Some utils are borrowed from https://github.com/allenai/hidden-networks
@@ -81,6 +82,7 @@ def snip_init(model, criterion, optimizer, train_loader, device, args):
         if hasattr(m, "popup_scores"):
             print(m.popup_scores.data)
             m.popup_scores.data = m.popup_scores.grad.data.abs()
+            m.reset_frozen_mask()
             print(m.popup_scores.data)
 
     # update k back to args.k.
@@ -117,6 +119,7 @@ def initialize_scaled_score(model):
             m.popup_scores.data = (
                 math.sqrt(6 / n) * m.weight.data / torch.max(torch.abs(m.weight.data))
             )
+            m.reset_frozen_mask()
 
 
 def scale_rand_init(model, k):
@@ -127,6 +130,8 @@ def scale_rand_init(model, k):
         if isinstance(m, (nn.Conv2d, nn.Linear)):
             # print(f"previous std = {torch.std(m.weight.data)}")
             m.weight.data = 1 / math.sqrt(k) * m.weight.data
+            if hasattr(m, "reset_frozen_mask"):
+                m.reset_frozen_mask()
             # print(f"new std = {torch.std(m.weight.data)}")
 
 
@@ -168,6 +173,17 @@ def prepare_model(model, args):
     # initialize_scores(model, args.scores_init_type)
 
 
+def freeze_masks(model, frozen=True):
+    """
+        Toggle the cached frozen-mask inference mode of every subnet layer (see FrozenMask):
+        the masked weights are computed once and only rebuilt when the scores or weights change.
+        Either call drops the cached weights, e.g. after writing the scores through `.data`.
+    """
+    for m in model.modules():
+        if hasattr(m, "freeze_mask"):
+            m.freeze_mask(frozen)
+
+
 def subnet_to_dense(subnet_dict, p):
     """
         Convert a subnet state dict (with subnet layers) to dense i.e., which can be directly 
@@ -185,13 +201,7 @@ def subnet_to_dense(subnet_dict, p):
         if "popup_scores" in k:
             s = torch.abs(subnet_dict[k])
 
-            out = s.clone()
-            _, idx = s.flatten().sort()
-            j = int((1 - p) * s.numel())
-
-            flat_out = out.flatten()
-            flat_out[idx[:j]] = 0
-            flat_out[idx[j:]] = 1
+            out = topk_mask(s, p)
             dense[k.replace("popup_scores", "weight")] = (
                 subnet_dict[k.replace("popup_scores", "weight")] * out
             )
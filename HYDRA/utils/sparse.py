@@ -0,0 +1,140 @@
+import copy
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import autograd
+
+
+class SparseMatmul(autograd.Function):
+    """
+        weight @ x with a CSR weight. The transposed weight is built once with the layer, so the
+        backward (gradient w.r.t. x only, the weights are frozen) is another CSR matmul.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, weight_t):
+        ctx.weight_t = weight_t
+        return torch.sparse.mm(weight, x.contiguous())
+
+    @staticmethod
+    def backward(ctx, g):
+        return torch.sparse.mm(ctx.weight_t, g.contiguous()), None, None
+
+
+def _csr(weight):
+    weight = weight.detach().flatten(1)
+    return weight.to_sparse_csr(), weight.t().contiguous().to_sparse_csr()
+
+
+class SparseLinear(nn.Module):
+    def __init__(self, layer):
+        super(SparseLinear, self).__init__()
+        weight = layer._masked_weight() if hasattr(layer, '_masked_weight') else layer.weight
+        self.weight, self.weight_t = _csr(weight)
+        self.bias = None if layer.bias is None else nn.Parameter(layer.bias.detach().clone(), requires_grad=False)
+        self.density = (weight != 0).float().mean().item()
+
+    def forward(self, x):
+        out = SparseMatmul.apply(x.t(), self.weight, self.weight_t).t()
+        return out if self.bias is None else out + self.bias
+
+
+class SparseConv2d(nn.Module):
+    """Sparse im2col convolution: unfold the input and multiply the patches by the CSR weight"""
+
+    def __init__(self, layer):
+        super(SparseConv2d, self).__init__()
+        assert layer.groups == 1, "Grouped convolutions are not supported"
+        weight = layer._masked_weight() if hasattr(layer, '_masked_weight') else layer.weight
+        self.weight, self.weight_t = _csr(weight)
+        self.bias = None if layer.bias is None else nn.Parameter(layer.bias.detach().clone(), requires_grad=False)
+        self.density = (weight != 0).float().mean().item()
+        self.out_channels = layer.out_channels
+        self.kernel_size, self.stride = layer.kernel_size, layer.stride
+        self.padding, self.dilation = layer.padding, layer.dilation
+
+    def forward(self, x):
+        batch, _, height, width = x.shape
+        out_h = (height + 2 * self.padding[0] - self.dilation[0] * (self.kernel_size[0] - 1) - 1) // self.stride[0] + 1
+        out_w = (width + 2 * self.padding[1] - self.dilation[1] * (self.kernel_size[1] - 1) - 1) // self.stride[1] + 1
+
+        # (B, C*kh*kw, L) -> (C*kh*kw, B*L)
+        cols = F.unfold(x, self.kernel_size, self.dilation, self.padding, self.stride)
+        cols = cols.transpose(0, 1).reshape(cols.shape[1], -1)
+        out = SparseMatmul.apply(cols, self.weight, self.weight_t)
+        out = out.view(self.out_channels, batch, out_h, out_w).transpose(0, 1)
+        if self.bias is not None:
+            out = out + self.bias.view(1, -1, 1, 1)
+        return out.contiguous()
+
+
+def _time_layer(layer, x, repeats):
+    """Median forward+backward (w.r.t. the input, as in an attack step) time in ms"""
+    times = []
+    for i in range(repeats + 1):
+        x_grad = x.detach().requires_grad_()
+        start = time.perf_counter()
+        layer(x_grad).sum().backward()
+        if i > 0:
+            times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times))
+
+
+def _replace(model, target, new_module):
+    for module in model.modules():
+        for child_name, child in module.named_children():
+            if child is target:
+                setattr(module, child_name, new_module)
+                return
+
+
+def sparsify(model, input_size=(1, 3, 32, 32), threshold=0.9, repeats=10, verbose=True):
+    """
+        CPU inference copy of `model` where every Conv2d/Linear (dense or subnet) with at least
+        `threshold` sparsity is swapped for its CSR version, if the measured forward+backward on
+        the layer's actual input shape is faster than the dense one. Returns (model, report).
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for p in model.parameters():
+        p.requires_grad = False
+
+    layers = [m for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+    inputs = {}
+
+    def record_input(m, inp, out):
+        # A forward hook returning a value would replace the layer output
+        inputs.setdefault(m, inp[0].detach())
+
+    hooks = [m.register_forward_hook(record_input) for m in layers]
+    with torch.no_grad():
+        model(torch.rand(input_size))
+    for hook in hooks:
+        hook.remove()
+
+    report = []
+    for layer in layers:
+        if layer not in inputs or (isinstance(layer, nn.Conv2d) and layer.groups != 1):
+            continue
+        with torch.no_grad():
+            weight = layer._masked_weight() if hasattr(layer, '_masked_weight') else layer.weight
+            sparsity = 1 - (weight != 0).float().mean().item()
+        if sparsity < threshold:
+            continue
+
+        sparse_layer = SparseConv2d(layer) if isinstance(layer, nn.Conv2d) else SparseLinear(layer)
+        dense_ms = _time_layer(layer, inputs[layer], repeats)
+        sparse_ms = _time_layer(sparse_layer, inputs[layer], repeats)
+        if sparse_ms < dense_ms:
+            _replace(model, layer, sparse_layer)
+        report.append({'layer': layer, 'sparsity': sparsity, 'dense ms': dense_ms, 'sparse ms': sparse_ms,
+                       'sparse': sparse_ms < dense_ms})
+
+    if verbose:
+        for row in report:
+            print(f"{row['layer'].__class__.__name__:14s} sparsity {row['sparsity'] * 100:6.2f}%  "
+                  f"dense {row['dense ms']:7.3f} ms  sparse {row['sparse ms']:7.3f} ms  "
+                  f"-> {'sparse' if row['sparse'] else 'dense'}")
+    return model, report
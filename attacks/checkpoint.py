@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+
+import torch
+
+
+class AttackCheckpoint:
+    """On-disk checkpoint of an attack run, so that a restarted run can resume.
+
+    Finished batches are saved as `<root>/batch_<idx>.pt` (the entry kept in
+    `attack_data`, which is only a pointer when a store or spill directory is used),
+    and the state of the batch being attacked as `<root>/state.pt`. The directory is
+    tied to the hash of the attack configuration (including the model weights, see
+    `hash_model`), stored in `<root>/config.json`: resuming with a different
+    configuration raises an error instead of mixing runs. When results go to a store,
+    `<root>/store.json` records its row count before each batch is appended, so that
+    rows of a batch whose marker was never written can be dropped on resume.
+    """
+
+    CONFIG_FILE = 'config.json'
+    STATE_FILE = 'state.pt'
+    STORE_FILE = 'store.json'
+
+    def __init__(self, root, config):
+        self.root = root
+        self.config_hash = self.hash_config(config)
+
+        config_path = os.path.join(root, self.CONFIG_FILE)
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                saved_hash = json.load(f)['hash']
+            if saved_hash != self.config_hash:
+                raise ValueError(f'Checkpoint in {root} was written with a different attack configuration')
+        else:
+            os.makedirs(root, exist_ok=True)
+            self._save_atomic(config_path,
+                              lambda f: f.write(json.dumps({'hash': self.config_hash, 'config': config},
+                                                           sort_keys=True, default=str).encode()))
+
+    @staticmethod
+    def hash_config(config):
+        return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def hash_model(model):
+        """sha256 of the parameters and buffers of a model"""
+        digest = hashlib.sha256()
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        return digest.hexdigest()
+
+    def _batch_path(self, batch_idx):
+        return os.path.join(self.root, f'batch_{batch_idx}.pt')
+
+    def save_batch(self, batch_idx, batch_data):
+        self._save_atomic(self._batch_path(batch_idx), lambda f: torch.save(batch_data, f))
+
+    def load_batch(self, batch_idx, map_location='cpu'):
+        """Returns the saved entry of a finished batch, or None if the batch was not finished"""
+        path = self._batch_path(batch_idx)
+        if not os.path.exists(path):
+            return None
+        return torch.load(path, map_location=map_location)
+
+    def save_state(self, state):
+        self._save_atomic(os.path.join(self.root, self.STATE_FILE), lambda f: torch.save(state, f))
+
+    def load_state(self, batch_idx, map_location='cpu'):
+        """Returns the mid-batch state saved for `batch_idx`, or None"""
+        path = os.path.join(self.root, self.STATE_FILE)
+        if not os.path.exists(path):
+            return None
+        state = torch.load(path, map_location=map_location)
+        return state if state['batch_idx'] == batch_idx else None
+
+    def clear_state(self):
+        path = os.path.join(self.root, self.STATE_FILE)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save_store_rows(self, batch_idx, rows):
+        """Records that the results of `batch_idx` are appended after row `rows` of the store"""
+        self._save_atomic(os.path.join(self.root, self.STORE_FILE),
+                          lambda f: f.write(json.dumps({'batch_idx': batch_idx, 'rows': rows}).encode()))
+
+    def load_store_rows(self, batch_idx):
+        """Returns the store row count recorded before appending `batch_idx`, or None"""
+        path = os.path.join(self.root, self.STORE_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            record = json.load(f)
+        return record['rows'] if record['batch_idx'] == batch_idx else None
+
+    @staticmethod
+    def _save_atomic(path, write):
+        # Write-then-rename: a crash while saving leaves the previous checkpoint intact
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
@@ -17,6 +17,10 @@ from typing import Optional, Union
 
 from timeit import default_timer as timer
 
+from attacks.trace import TraceRecorder
+from attacks.store import AttackStore
+from attacks.checkpoint import AttackCheckpoint
+
 
 def linf_projection_(delta, epsilon):
     """In-place linf projection"""
@@ -31,6 +35,74 @@ def linf_mid_points(x0, x1, epsilon):
     return x0 + torch.maximum(torch.minimum(delta, epsilon, out=delta), -epsilon, out=delta).view_as(x0)
 
 
+def l0_projection_(delta, epsilon):
+    """In-place l0 projection: keeps the epsilon largest components of each row (batched top-k)"""
+    delta = delta.flatten(1)
+    delta_abs = delta.abs()
+    k = epsilon.clamp(min=0, max=delta.shape[1]).long()
+    k_max = int(k.max())
+    if k_max == 0:
+        delta.zero_()
+        return
+    thresholds = delta_abs.topk(k_max, dim=1).values.gather(1, (k - 1).clamp_(min=0).unsqueeze(1))
+    delta.mul_((delta_abs >= thresholds) & (k > 0).unsqueeze(1))
+
+
+def l0_mid_points(x0, x1, epsilon):
+    n_features = x0[0].numel()
+    delta = x1 - x0
+    l0_projection_(delta=delta, epsilon=n_features * epsilon)
+    return x0 + delta
+
+
+def l1_projection_(delta, epsilon):
+    """In-place l1 projection onto the ball of radius epsilon (batched, sort-free).
+
+    Uses Michelot's fixed-point iteration for the soft-threshold of each row, which
+    only needs masked sums and converges in a handful of iterations.
+    """
+    delta = delta.flatten(1)
+    to_project = delta.abs().sum(dim=1) > epsilon
+    if not to_project.any():
+        return
+
+    delta_to_project = delta[to_project]
+    delta_abs = delta_to_project.abs()
+    eps = epsilon[to_project].unsqueeze(1)
+
+    support = torch.ones_like(delta_abs, dtype=torch.bool)
+    while True:
+        theta = ((delta_abs * support).sum(dim=1, keepdim=True) - eps) / support.sum(dim=1, keepdim=True).clamp_(min=1)
+        new_support = delta_abs > theta
+        if torch.equal(new_support, support):
+            break
+        support = new_support
+
+    delta[to_project] = (delta_abs - theta.clamp_(min=0)).clamp_(min=0).copysign_(delta_to_project)
+
+
+def l1_mid_points(x0, x1, epsilon):
+    threshold = (1 - epsilon).unsqueeze(1)
+    delta = (x1 - x0).flatten(1)
+    delta_abs = delta.abs()
+    mask = delta_abs > threshold
+    mid_points = delta_abs.sub_(threshold).copysign_(delta)
+    mid_points.mul_(mask)
+    return x0 + mid_points.view_as(x0)
+
+
+def l2_projection_(delta, epsilon):
+    """In-place l2 projection: rescales the rows whose norm exceeds epsilon"""
+    delta = delta.flatten(1)
+    l2_norms = delta.norm(p=2, dim=1, keepdim=True).clamp_(min=1e-12)
+    delta.mul_((epsilon.unsqueeze(1) / l2_norms).clamp_(max=1))
+
+
+def l2_mid_points(x0, x1, epsilon):
+    epsilon = epsilon.unsqueeze(1)
+    return x0.flatten(1).mul(1 - epsilon).add_(epsilon * x1.flatten(1)).view_as(x0)
+
+
 def difference_of_logits(logits, labels, labels_infhot=None):
     if labels_infhot is None:
         labels_infhot = torch.zeros_like(logits).scatter_(1, labels.unsqueeze(1), float('inf'))
@@ -40,6 +112,28 @@ def difference_of_logits(logits, labels, labels_infhot=None):
     return class_logits - other_logits
 
 
+def scheduler_defaults(scheduler, scheduler_config, steps):
+    """Copy of scheduler_config with the per-attack defaults of the missing keys filled in:
+    T_max = steps, T_0 = steps // 2 and a single MultiStepLR milestone at steps // 2"""
+    config = dict(scheduler_config or {})
+    if scheduler == 'CosineAnnealingLR':
+        config.setdefault('T_max', steps)
+    elif scheduler == 'CosineAnnealingWarmRestarts':
+        config.setdefault('T_0', max(1, steps // 2))
+    elif scheduler == 'MultiStepLR':
+        config.setdefault('milestones', [steps // 2])
+    return config
+
+
+def schedule_progress(step, phase_start, phase_progress, budget):
+    """Progress in [0, 1] of the gamma and lr schedules at `step`: the schedule runs from
+    `phase_progress` at `phase_start` to 1 at `budget`, so shrinking the budget compresses the
+    remaining schedule instead of jumping ahead in it"""
+    if budget <= phase_start:
+        return 1.0
+    return phase_progress + (1 - phase_progress) * (step - phase_start) / (budget - phase_start)
+
+
 class FMNOpt:
     def __init__(self,
                  model: nn.Module,
@@ -51,6 +145,7 @@ class FMNOpt:
                  gamma_final: float = 0.001,
                  starting_points: Optional[Tensor] = None,
                  binary_search_steps: int = 10,
+                 boundary_search_points: int = 1,
                  batch_size=100,
                  batch_number=10,
                  optimizer='SGD',
@@ -58,7 +153,20 @@ class FMNOpt:
                  optimizer_config=None,
                  scheduler_config=None,
                  device=torch.device('cpu'),
-                 logit_loss=True
+                 logit_loss=True,
+                 active_set=False,
+                 active_set_patience=50,
+                 restarts=1,
+                 restart_radius=8 / 255,
+                 trace_stride=1,
+                 trace_capacity=None,
+                 trace_spill_dir=None,
+                 store: Optional[AttackStore] = None,
+                 checkpoint_dir=None,
+                 checkpoint_interval=50,
+                 stagnation_window=None,
+                 stagnation_tol=1e-3,
+                 stagnation_action='stop'
                  ):
         self.model = model
         self.norm = float('inf') if norm == 'inf' else int(norm)
@@ -68,6 +176,7 @@ class FMNOpt:
         self.gamma_final = gamma_final
         self.starting_points = starting_points
         self.binary_search_steps = binary_search_steps
+        self.boundary_search_points = boundary_search_points
         self.device = device
 
         self.batch_size = batch_size
@@ -77,21 +186,89 @@ class FMNOpt:
         self.scheduler_config = scheduler_config
         self.logit_loss = logit_loss
 
+        # Active-set mode: samples whose best_norm has not improved for
+        # `active_set_patience` steps (after an adversarial was found) are
+        # dropped from the working batch
+        self.active_set = active_set
+        self.active_set_patience = active_set_patience
+
+        # Adaptive step budget: when the median best norm of the adversarials found improves by
+        # less than `stagnation_tol` (relative) over `stagnation_window` steps, the attack either stops
+        # ('stop') or halves the remaining budget, compressing the rest of the gamma and lr
+        # schedules into it ('rescale')
+        assert stagnation_action in ('stop', 'rescale'), 'stagnation_action must be "stop" or "rescale"'
+        self.stagnation_window = stagnation_window
+        self.stagnation_tol = stagnation_tol
+        self.stagnation_action = stagnation_action
+        self.steps_used = None
+
+        # Multi-restart mode: each sample is replicated `restarts` times along
+        # the batch axis; the first copy starts from the clean input (or the
+        # starting points), the others from uniform noise of `restart_radius`
+        self.restarts = restarts
+        self.restart_radius = restart_radius
+
+        # Per-step epsilon/distance traces, see TraceRecorder
+        self.trace = TraceRecorder(keys=('epsilon', 'distance'),
+                                   stride=trace_stride,
+                                   capacity=trace_capacity,
+                                   spill_dir=trace_spill_dir)
+
+        # Columnar result store: finished batches are appended to it and released from memory
+        self.store = store
+
+        # Finished batches and, every `checkpoint_interval` steps, the state of the current
+        # batch are saved to `checkpoint_dir`; a run restarted with the same configuration
+        # skips the finished batches and resumes the interrupted one
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint = None
+        if checkpoint_dir is not None:
+            self.checkpoint = AttackCheckpoint(checkpoint_dir, config={
+                'model': AttackCheckpoint.hash_model(model),
+                'norm': self.norm,
+                'targeted': targeted,
+                'steps': steps,
+                'gamma_init': gamma_init,
+                'gamma_final': gamma_final,
+                'starting_points': None if starting_points is None else list(starting_points.shape),
+                'binary_search_steps': binary_search_steps,
+                'boundary_search_points': boundary_search_points,
+                'batch_size': batch_size,
+                'batch_number': batch_number,
+                'dataset_size': len(dataset),
+                'optimizer': optimizer,
+                'scheduler': scheduler,
+                'optimizer_config': optimizer_config,
+                'scheduler_config': scheduler_config,
+                'logit_loss': logit_loss,
+                'active_set': active_set,
+                'active_set_patience': active_set_patience,
+                'restarts': restarts,
+                'restart_radius': restart_radius,
+                'trace_stride': trace_stride,
+                'trace_capacity': trace_capacity,
+                'stagnation_window': stagnation_window,
+                'stagnation_tol': stagnation_tol,
+                'stagnation_action': stagnation_action
+            })
+
         # Create the DataLoader
         self.dl_test = torch.utils.data.DataLoader(dataset,
                                                    batch_size=self.batch_size,
                                                    shuffle=False)
 
-        # TODO: implement the attack for the other norms too
         self._dual_projection_mid_points = {
+            0: (None, l0_projection_, l0_mid_points),
+            1: (float('inf'), l1_projection_, l1_mid_points),
+            2: (2, l2_projection_, l2_mid_points),
             float('inf'): (1, linf_projection_, linf_mid_points),
         }
 
         self._optimizers = {
             "SGD": SGD,
-            'SGDNesterov': SGD,
+            'SGDNesterov': [SGD, {'nesterov': True}],
             "Adam": Adam,
-            'AdamAmsgrad': Adam
+            'AdamAmsgrad': [Adam, {'amsgrad': True}]
         }
 
         self._schedulers = {
@@ -112,34 +289,65 @@ class FMNOpt:
         self.attack_data = []
         for i in range(self.batch_number):
             self.attack_data.append({
-                'epsilon': [],
+                'epsilon': None,
                 'pred_labels': [],
-                'distance': [],
+                'distance': None,
+                'trace_steps': None,
+                'steps_used': None,
                 'inputs': [],
                 'labels': [],
                 'best_adv': [],
                 'best_distance': None
             })
 
-    def _boundary_search(self, inputs, labels):
-        _, _, mid_point = self._dual_projection_mid_points[self.norm]
+    def _boundary_search(self, batch_idx, inputs, labels):
+        """Shrinks the starting points towards the inputs, keeping them adversarial.
 
-        is_adv = self.model(self.starting_points).argmax(dim=1)
-        if not is_adv.all():
-            raise ValueError('Starting points are not all adversarial.')
-        lower_bound = torch.zeros(self.batch_size, device=self.device)
-        upper_bound = torch.ones(self.batch_size, device=self.device)
-        for _ in range(self.binary_search_steps):
-            epsilon = (lower_bound + upper_bound) / 2
-            mid_points = mid_point(x0=inputs, x1=self.starting_points, epsilon=epsilon)
-            pred_labels = self.model(mid_points).argmax(dim=1)
-            is_adv = (pred_labels == labels) if self.targeted else (pred_labels != labels)
-            lower_bound = torch.where(is_adv, lower_bound, epsilon)
-            upper_bound = torch.where(is_adv, epsilon, upper_bound)
+        Every pass evaluates `boundary_search_points` candidate epsilons per sample in
+        a single stacked forward, shrinking the [lower, upper] interval by a factor of
+        `boundary_search_points + 1`; with one point this is the usual bisection.
+        """
+        _, _, mid_point = self._dual_projection_mid_points[self.norm]
 
-        delta = mid_point(x0=inputs, x1=self.starting_points, epsilon=epsilon) - inputs
+        batch_start = batch_idx * self.batch_size
+        starting_points = self.starting_points[batch_start:batch_start + len(inputs)].to(self.device)
 
-        return epsilon, delta, is_adv
+        with torch.no_grad():
+            pred_labels = self.model(starting_points).argmax(dim=1)
+            is_adv = (pred_labels == labels) if self.targeted else (pred_labels != labels)
+            if not is_adv.all():
+                raise ValueError('Starting points are not all adversarial.')
+
+            n_points = self.boundary_search_points
+            # Same final interval width as `binary_search_steps` bisection steps
+            n_passes = math.ceil(self.binary_search_steps / math.log2(n_points + 1))
+
+            repeat = (n_points, *[1] * (inputs.ndim - 1))
+            stacked_inputs, stacked_starting_points = inputs.repeat(repeat), starting_points.repeat(repeat)
+            stacked_labels = labels.repeat(n_points)
+            fractions = torch.arange(1, n_points + 1, device=self.device).unsqueeze(1) / (n_points + 1)
+
+            lower_bound = torch.zeros(len(inputs), device=self.device)
+            upper_bound = torch.ones(len(inputs), device=self.device)
+            for _ in range(n_passes):
+                # (n_points, batch) candidates, increasing along the first axis
+                epsilons = lower_bound + (upper_bound - lower_bound) * fractions
+                mid_points = mid_point(x0=stacked_inputs, x1=stacked_starting_points, epsilon=epsilons.flatten())
+                pred_labels = self.model(mid_points).argmax(dim=1)
+                is_adv = (pred_labels == stacked_labels) if self.targeted else (pred_labels != stacked_labels)
+                is_adv = is_adv.view(n_points, -1)
+
+                # The smallest adversarial candidate is the new upper bound, the one below it the
+                # new lower bound; without adversarial candidates only the lower bound moves
+                first_adv = torch.where(is_adv.any(dim=0), is_adv.int().argmax(dim=0), n_points)
+                padded = torch.cat([lower_bound.unsqueeze(0), epsilons, upper_bound.unsqueeze(0)])
+                lower_bound = padded.gather(0, first_adv.unsqueeze(0)).squeeze(0)
+                upper_bound = padded.gather(0, (first_adv + 1).unsqueeze(0)).squeeze(0)
+
+            epsilon = upper_bound
+            delta = mid_point(x0=inputs, x1=starting_points, epsilon=epsilon) - inputs
+
+        return epsilon, delta, torch.ones_like(labels, dtype=torch.bool)
 
     def _init_optimizer(self, objective=None):
         assert objective is not None
@@ -148,7 +356,7 @@ class FMNOpt:
 
         if isinstance(optimizer, list) and len(optimizer) > 0:
             opt_params = optimizer[1]
-            optimizer = optimizer[0]([objective], **self.optimizer_config, **opt_params)
+            optimizer = optimizer[0]([objective], **dict(opt_params, **self.optimizer_config))
         else:
             optimizer = optimizer([objective], **self.optimizer_config)
 
@@ -161,22 +369,13 @@ class FMNOpt:
             self.optimizer = optimizer
 
         scheduler = self._schedulers[self.scheduler_name]
-
-        if scheduler == 'MultiStepLR':
-            milestones = len(self.scheduler_config['milestones'])
-            self.scheduler_config['milestones'] = np.linspace(0, self.steps, milestones)
-
-        if scheduler == 'CosineAnnealingLR':
-            self.scheduler_config['T_max'] = self.steps
-
-        if scheduler == 'CosineAnnealingWarmRestarts':
-            self.scheduler_config['T_0'] = self.steps // 2
+        scheduler_config = scheduler_defaults(self.scheduler_name, self.scheduler_config, self.steps)
 
         if isinstance(scheduler, list) and len(scheduler) > 0:
             sch_params = scheduler[1]
-            scheduler = scheduler[0](self.optimizer, **self.scheduler_config, **sch_params)
+            scheduler = scheduler[0](self.optimizer, **scheduler_config, **sch_params)
         else:
-            scheduler = scheduler(self.optimizer, **self.scheduler_config)
+            scheduler = scheduler(self.optimizer, **scheduler_config)
 
         self.scheduler = scheduler
 
@@ -185,154 +384,391 @@ class FMNOpt:
 
         self.scheduler.step(*step_params)
 
-    def run(self, log=False):
-        # out = display(progress(0, self.steps), display_id=True)
-        # TODO: insert a progressbar which works in the terminal
+    def _compact_optimizer(self, delta, keep):
+        """Replaces the optimized tensor with its kept rows, carrying the optimizer state along"""
+        new_delta = delta.data[keep].clone().requires_grad_(True)
 
-        dual, projection, _ = self._dual_projection_mid_points[self.norm]
+        state = self.optimizer.state.pop(delta, {})
+        self.optimizer.state[new_delta] = {
+            key: value[keep] if torch.is_tensor(value) and value.dim() > 0 else value
+            for key, value in state.items()
+        }
+        self.optimizer.param_groups[0]['params'] = [new_delta]
 
-        for batch_idx, batch in enumerate(self.dl_test):
-            if batch_idx > self.batch_number - 1:
-                break
-            inputs, labels = batch
-            inputs = inputs.to(self.device)
-            labels = labels.to(self.device)
+        return new_delta
+
+    def _attack_batch(self, batch_idx, inputs, labels, log=False):
+        dual, projection, _ = self._dual_projection_mid_points[self.norm]
 
-            # storing initial labels (clean ones)
-            self.attack_data[batch_idx]['labels'] = labels.clone()
-            self.attack_data[batch_idx]['inputs'] = inputs.clone()
+        batch_view = lambda tensor: tensor.view(-1, *[1] * (inputs.ndim - 1))
 
-            batch_view = lambda tensor: tensor.view(self.batch_size, *[1] * (inputs.ndim - 1))
+        state = self.checkpoint.load_state(batch_idx, map_location=self.device) if self.checkpoint else None
 
+        if state is None:
             delta = torch.zeros_like(inputs, device=self.device)
             is_adv = None
 
             if self.starting_points is not None:
-                epsilon, delta, is_adv = self._boundary_search(inputs, labels)
+                epsilon, delta, is_adv = self._boundary_search(batch_idx, inputs, labels)
+
+            if self.restarts > 1:
+                # Fold the restarts into the batch dimension: row r * B + j is restart r of sample j
+                repeat = (self.restarts, *[1] * (inputs.ndim - 1))
+                noise = torch.empty_like(inputs).repeat(repeat).uniform_(-self.restart_radius, self.restart_radius)
+                noise[:len(inputs)] = delta.detach()
+                inputs, labels = inputs.repeat(repeat), labels.repeat(self.restarts)
+                delta = noise.add_(inputs).clamp_(min=0, max=1).sub_(inputs)
+
+            batch_size = len(inputs)
+            self.trace.reset(batch_size // self.restarts, self.steps, self.device)
 
             if self.norm == 0:
-                epsilon = torch.ones(self.batch_size,
+                epsilon = torch.ones(batch_size,
                                      device=self.device) if self.starting_points is None else delta.flatten(1).norm(p=0,
-                                                                                                                    dim=0)
+                                                                                                                dim=1)
             else:
-                epsilon = torch.full((self.batch_size,), float('inf'), device=self.device)
+                epsilon = torch.full((batch_size,), float('inf'), device=self.device)
 
             _worst_norm = torch.maximum(inputs, 1 - inputs).flatten(1).norm(p=self.norm, dim=1).detach()
             self.init_trackers = {
                 'worst_norm': _worst_norm.to(self.device),
                 'best_norm': _worst_norm.clone().to(self.device),
                 'best_adv': inputs.clone().to(self.device),
-                'adv_found': torch.zeros(self.batch_size, dtype=torch.bool, device=self.device)
+                'adv_found': torch.zeros(batch_size, dtype=torch.bool, device=self.device)
             }
 
-            multiplier = 1 if self.targeted else -1
-
-            delta.requires_grad_(True)
-            # Initialize optimizer
-            self._init_optimizer(objective=delta)
-            self._init_scheduler()
-            # TODO: try to implement an optimizer for gamma
-
-            print("Attack on batch #{}".format(batch_idx))
-            start = timer()
-            for i in range(self.steps):
-                if log:
-                    print(f"Attack completion: {i / self.steps * 100:.2f}%")
-
-                cosine = (1 + math.cos(math.pi * i / self.steps)) / 2
-                gamma = self.gamma_final + (self.gamma_init - self.gamma_final) * cosine
-
-                delta_norm = delta.data.flatten(1).norm(p=self.norm, dim=1)
-                adv_inputs = inputs + delta
-                adv_inputs = adv_inputs.to(self.device)
-
-                logits = self.model(adv_inputs)
-                pred_labels = logits.argmax(dim=1)
-
-                _epsilon = epsilon.clone()
-                _distance = torch.linalg.norm((adv_inputs - inputs).data.flatten(1), dim=1, ord=self.norm)
-
-                if self.logit_loss:
-                    if i == 0:
-                        labels_infhot = torch.zeros_like(logits).scatter_(1, labels.unsqueeze(1), float('inf'))
-                        logit_diff_func = partial(difference_of_logits, labels=labels, labels_infhot=labels_infhot)
-
-                    logit_diffs = logit_diff_func(logits=logits)
-                    loss = -(multiplier * logit_diffs)
-
-                else:
-                    c_loss = nn.CrossEntropyLoss()
-                    loss = -c_loss(logits, labels)
-
-                loss.sum().backward()
-                delta_grad = delta.grad.data
-
-                is_adv = (pred_labels == labels) if self.targeted else (pred_labels != labels)
-                is_smaller = delta_norm < self.init_trackers['best_norm']
-                is_both = is_adv & is_smaller
-                self.init_trackers['adv_found'].logical_or_(is_adv)
-                self.init_trackers['best_norm'] = torch.where(is_both, delta_norm, self.init_trackers['best_norm'])
-                self.init_trackers['best_adv'] = torch.where(batch_view(is_both), adv_inputs.detach(),
-                                                             self.init_trackers['best_adv'])
-
-                if self.norm == 0:
-                    epsilon = torch.where(is_adv,
-                                          torch.minimum(torch.minimum(epsilon - 1,
-                                                                      (epsilon * (1 - gamma)).floor_()),
-                                                        self.init_trackers['best_norm']),
-                                          torch.maximum(epsilon + 1, (epsilon * (1 + gamma)).floor_()))
-                    epsilon.clamp_(min=0)
-                else:
-                    distance_to_boundary = loss.detach().abs() / delta_grad.flatten(1).norm(p=dual, dim=1).clamp_(
-                        min=1e-12)
-                    epsilon = torch.where(is_adv,
-                                          torch.minimum(epsilon * (1 - gamma), self.init_trackers['best_norm']),
-                                          torch.where(self.init_trackers['adv_found'],
-                                                      epsilon * (1 + gamma),
-                                                      delta_norm + distance_to_boundary)
-                                          )
-
-                # clip epsilon
-                epsilon = torch.minimum(epsilon, self.init_trackers['worst_norm'])
-
-                # normalize gradient
-                grad_l2_norms = delta_grad.flatten(1).norm(p=2, dim=1).clamp_(min=1e-12)
-                delta_grad.div_(batch_view(grad_l2_norms))
-
-                self.optimizer.step()
-                self.optimizer.zero_grad()
-
-                # project in place
-                projection(delta=delta.data, epsilon=epsilon)
-
-                # clamp
-                delta.data.add_(inputs).clamp_(min=0, max=1).sub_(inputs)
-
-                # Computing the best distance (x-x0 for the adversarial)
-                _best_distance = torch.linalg.norm((self.init_trackers['best_adv'] - inputs).data.flatten(1),
-                                                   dim=1, ord=self.norm)
-
-                if self.scheduler_name == 'ReduceLROnPlateau':
-                    self._scheduler_step(torch.median(_distance).item())
-                else:
-                    self._scheduler_step()
+            # Full-batch results, filled in as samples leave the working set
+            results = {key: self.init_trackers[key].clone() for key in ('best_norm', 'best_adv', 'adv_found')}
+
+            # Rows of the full batch still being optimized and their stall counters
+            active = torch.arange(batch_size, device=self.device)
+            stall_steps = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+
+            # Per-step traces keep the last value of dropped samples
+            _epsilon_trace = epsilon.clone()
+            _distance_trace = torch.zeros(batch_size, device=self.device)
+
+            # Step budget (shrunk by the 'rescale' stagnation action), start step and progress of
+            # the current schedule phase, and median best norm history
+            budget = self.steps
+            phase_start, phase_progress = 0, 0.0
+            median_history = []
+
+            start_step = 0
+        else:
+            # Resuming an interrupted batch: restore the working set as it was at the last checkpoint
+            inputs, labels, delta, epsilon = state['inputs'], state['labels'], state['delta'], state['epsilon']
+            batch_size, _worst_norm = state['batch_size'], state['worst_norm']
+            self.init_trackers, results = state['init_trackers'], state['results']
+            active, stall_steps = state['active'], state['stall_steps']
+            _epsilon_trace, _distance_trace = state['epsilon_trace'], state['distance_trace']
+            self.trace.load_state_dict(state['trace'])
+            budget, median_history = state['budget'], state['median_history']
+            phase_start, phase_progress = state['phase_start'], state['phase_progress']
+            start_step = state['step']
+
+        multiplier = 1 if self.targeted else -1
+
+        delta.requires_grad_(True)
+        # Initialize optimizer
+        self._init_optimizer(objective=delta)
+        self._init_scheduler()
+        if state is not None:
+            self.optimizer.load_state_dict(state['optimizer'])
+            self.scheduler.load_state_dict(state['scheduler'])
+            del state
+        # TODO: try to implement an optimizer for gamma
+
+        labels_infhot = None
+        self.steps_used = start_step
+        for i in range(start_step, self.steps):
+            if i >= budget:
+                break
+            self.steps_used = i + 1
+
+            if log:
+                print(f"Attack completion: {i / budget * 100:.2f}%")
+
+            cosine = (1 + math.cos(math.pi * schedule_progress(i, phase_start, phase_progress, budget))) / 2
+            gamma = self.gamma_final + (self.gamma_init - self.gamma_final) * cosine
+
+            delta_norm = delta.data.flatten(1).norm(p=self.norm, dim=1)
+            adv_inputs = inputs + delta
+            adv_inputs = adv_inputs.to(self.device)
+
+            logits = self.model(adv_inputs)
+            pred_labels = logits.argmax(dim=1)
+
+            _epsilon = epsilon.clone()
+            _distance = torch.linalg.norm((adv_inputs - inputs).data.flatten(1), dim=1, ord=self.norm)
+
+            if self.logit_loss:
+                if labels_infhot is None:
+                    labels_infhot = torch.zeros_like(logits).scatter_(1, labels.unsqueeze(1), float('inf'))
+
+                logit_diffs = difference_of_logits(logits=logits, labels=labels, labels_infhot=labels_infhot)
+                loss = -(multiplier * logit_diffs)
+
+            else:
+                c_loss = nn.CrossEntropyLoss()
+                loss = -c_loss(logits, labels)
+
+            loss.sum().backward()
+            delta_grad = delta.grad.data
 
-                # Saving data
-                self.attack_data[batch_idx]['epsilon'].append(_epsilon)
-                self.attack_data[batch_idx]['distance'].append(_distance)
+            is_adv = (pred_labels == labels) if self.targeted else (pred_labels != labels)
+            is_smaller = delta_norm < self.init_trackers['best_norm']
+            is_both = is_adv & is_smaller
+            self.init_trackers['adv_found'].logical_or_(is_adv)
+            self.init_trackers['best_norm'] = torch.where(is_both, delta_norm, self.init_trackers['best_norm'])
+            self.init_trackers['best_adv'] = torch.where(batch_view(is_both), adv_inputs.detach(),
+                                                         self.init_trackers['best_adv'])
+
+            if self.norm == 0:
+                epsilon = torch.where(is_adv,
+                                      torch.minimum(torch.minimum(epsilon - 1,
+                                                                  (epsilon * (1 - gamma)).floor_()),
+                                                    self.init_trackers['best_norm']),
+                                      torch.maximum(epsilon + 1, (epsilon * (1 + gamma)).floor_()))
+                epsilon.clamp_(min=0)
+            else:
+                distance_to_boundary = loss.detach().abs() / delta_grad.flatten(1).norm(p=dual, dim=1).clamp_(
+                    min=1e-12)
+                epsilon = torch.where(is_adv,
+                                      torch.minimum(epsilon * (1 - gamma), self.init_trackers['best_norm']),
+                                      torch.where(self.init_trackers['adv_found'],
+                                                  epsilon * (1 + gamma),
+                                                  delta_norm + distance_to_boundary)
+                                      )
+
+            # clip epsilon
+            epsilon = torch.minimum(epsilon, self.init_trackers['worst_norm'])
+
+            # normalize gradient
+            grad_l2_norms = delta_grad.flatten(1).norm(p=2, dim=1).clamp_(min=1e-12)
+            delta_grad.div_(batch_view(grad_l2_norms))
+
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+
+            # project in place
+            projection(delta=delta.data, epsilon=epsilon)
+
+            # clamp
+            delta.data.add_(inputs).clamp_(min=0, max=1).sub_(inputs)
+
+            if self.scheduler_name == 'ReduceLROnPlateau':
+                self._scheduler_step(torch.median(_distance).item())
+            else:
+                # One scheduler epoch per step, more once the budget has been shrunk: the lr
+                # schedule (over self.steps epochs) ends with the budget
+                target = round(schedule_progress(i + 1, phase_start, phase_progress, budget) * self.steps)
+                while self.scheduler.last_epoch < target:
+                    self._scheduler_step()
 
-                del _epsilon, _distance
+            # Saving data
+            _epsilon_trace[active] = _epsilon
+            _distance_trace[active] = _distance
+            self.trace.record(i,
+                              epsilon=_epsilon_trace.view(self.restarts, -1).amin(dim=0),
+                              distance=_distance_trace.view(self.restarts, -1).amin(dim=0))
+
+            del _epsilon, _distance
+
+            if self.active_set:
+                stall_steps = torch.where(is_both, torch.zeros_like(stall_steps), stall_steps + 1)
+                keep = ~(self.init_trackers['adv_found'] & (stall_steps >= self.active_set_patience))
+
+                if not keep.all():
+                    # Write back the converged samples, then shrink every working tensor
+                    dropped = active[~keep]
+                    for key in results:
+                        results[key][dropped] = self.init_trackers[key][~keep]
+
+                    active = active[keep]
+                    self.init_trackers = {key: value[keep] for key, value in self.init_trackers.items()}
+                    if len(active) == 0:
+                        break
+
+                    delta = self._compact_optimizer(delta, keep)
+                    inputs, labels, epsilon, stall_steps = inputs[keep], labels[keep], epsilon[keep], stall_steps[keep]
+                    if labels_infhot is not None:
+                        labels_infhot = labels_infhot[keep]
+
+            if self.stagnation_window is not None:
+                # Median best norm of the samples with an adversarial (the others hold their worst
+                # norm), tracked once at least half of the batch has one
+                full_best_norm = results['best_norm'].index_copy(0, active, self.init_trackers['best_norm'])
+                full_adv_found = results['adv_found'].index_copy(0, active, self.init_trackers['adv_found'])
+                if 2 * int(full_adv_found.sum()) >= batch_size:
+                    median_history.append(torch.median(full_best_norm[full_adv_found]).item())
+
+                if len(median_history) > self.stagnation_window:
+                    previous = median_history[-self.stagnation_window - 1]
+                    improvement = (previous - median_history[-1]) / max(previous, 1e-12)
+                    if improvement < self.stagnation_tol:
+                        if self.stagnation_action == 'stop':
+                            break
+                        phase_progress = schedule_progress(i + 1, phase_start, phase_progress, budget)
+                        phase_start = i + 1
+                        budget = i + 1 + (budget - i - 1) // 2
+                        median_history = []
+                        if log:
+                            print(f"Progress stalled, step budget reduced to {budget}")
+                    else:
+                        median_history = median_history[-self.stagnation_window:]
+
+            if self.checkpoint is not None and (i + 1) % self.checkpoint_interval == 0 and i + 1 < self.steps:
+                self.checkpoint.save_state({
+                    'batch_idx': batch_idx,
+                    'step': i + 1,
+                    'inputs': inputs,
+                    'labels': labels,
+                    'delta': delta.detach(),
+                    'epsilon': epsilon,
+                    'batch_size': batch_size,
+                    'worst_norm': _worst_norm,
+                    'init_trackers': self.init_trackers,
+                    'results': results,
+                    'active': active,
+                    'stall_steps': stall_steps,
+                    'epsilon_trace': _epsilon_trace,
+                    'distance_trace': _distance_trace,
+                    'trace': self.trace.state_dict(),
+                    'budget': budget,
+                    'phase_start': phase_start,
+                    'phase_progress': phase_progress,
+                    'median_history': median_history,
+                    'optimizer': self.optimizer.state_dict(),
+                    'scheduler': self.scheduler.state_dict()
+                })
+
+        for key in results:
+            results[key][active] = self.init_trackers[key]
+        best_norm, best_adv, adv_found = results['best_norm'], results['best_adv'], results['adv_found']
+
+        if self.restarts > 1:
+            # Keep the minimum-norm adversarial across the restarts of each sample
+            best_norm = best_norm.view(self.restarts, -1)
+            best_restart = best_norm.argmin(dim=0)
+            samples = torch.arange(best_norm.shape[1], device=self.device)
+            best_adv = best_adv.view(self.restarts, -1, *best_adv.shape[1:])[best_restart, samples]
+            best_norm = best_norm[best_restart, samples]
+            adv_found = adv_found.view(self.restarts, -1).any(dim=0)
+            _worst_norm = _worst_norm[:len(samples)]
+
+        self.init_trackers = {
+            'worst_norm': _worst_norm,
+            'best_norm': best_norm,
+            'best_adv': best_adv,
+            'adv_found': adv_found
+        }
 
-                # out.update(progress(i, self.steps))
+    def _finish_batch(self, batch_idx, batch_data):
+        """Places a finished batch in attack_data, the result store or the spill directory"""
+        # Computing the best distance (x-x0 for the adversarial)
+        _best_distance = torch.linalg.norm((batch_data['best_adv'] - batch_data['inputs']).data.flatten(1),
+                                           dim=1, ord=self.norm)
+        #print("Best distance: {}".format(torch.median(_best_distance).item()))
+        batch_data['best_distance'] = torch.median(_best_distance).item()
+
+        if self.store is not None:
+            if self.checkpoint is not None:
+                # Drop the rows a previous run appended for this batch before crashing, then
+                # record where this batch starts
+                rows = self.checkpoint.load_store_rows(batch_idx)
+                if rows is not None:
+                    self.store.truncate(rows)
+                self.checkpoint.save_store_rows(batch_idx, len(self.store))
+            batch_data = self._append_to_store(batch_data, _best_distance)
+        elif self.trace.spill_dir is not None:
+            batch_data = self.trace.spill(batch_idx, batch_data)
+
+        self.attack_data[batch_idx] = batch_data
+
+        if self.checkpoint is not None:
+            self.checkpoint.save_batch(batch_idx, batch_data)
+            self.checkpoint.clear_state()
+
+    def _resume_batch(self, batch_idx):
+        """Restores a batch finished by a previous run from the checkpoint, returns whether it was found"""
+        if self.checkpoint is None:
+            return False
+
+        batch_data = self.checkpoint.load_batch(batch_idx, map_location=self.device)
+        if batch_data is None:
+            return False
+
+        self.attack_data[batch_idx] = batch_data
+        return True
+
+    def _append_to_store(self, batch_data, distances):
+        """Appends a finished batch to the store and returns the lightweight entry kept in memory"""
+        batch_data = self.trace.pad(batch_data, self.trace.num_slots(self.steps))
+        rows = self.store.append(
+            inputs=batch_data['inputs'],
+            labels=batch_data['labels'],
+            best_adv=batch_data['best_adv'],
+            distances=distances,
+            # traces are stored per sample: (batch, recorded_steps)
+            epsilon=batch_data['epsilon'].t(),
+            distance=batch_data['distance'].t(),
+            trace_steps=batch_data['trace_steps'].unsqueeze(0).expand(len(distances), -1),
+            steps_used=torch.full((len(distances),), batch_data['steps_used'], dtype=torch.long)
+        )
+        return {'rows': list(rows), 'best_distance': batch_data['best_distance']}
+
+    def load_batch(self, batch_idx):
+        """Returns the attack data of a batch, reading it back from the store or disk if needed"""
+        batch_data = self.attack_data[batch_idx]
+        if 'rows' not in batch_data:
+            return TraceRecorder.load(batch_data, map_location=self.device)
+
+        start, stop = batch_data['rows']
+        loaded = {column: self.store.read_tensor(column, start, stop, device=self.device)
+                  for column in ('inputs', 'labels', 'best_adv', 'epsilon', 'distance')}
+        loaded['epsilon'], loaded['distance'] = loaded['epsilon'].t(), loaded['distance'].t()
+        loaded['trace_steps'] = self.store.read_tensor('trace_steps', start, start + 1)[0]
+        loaded['steps_used'] = int(self.store.read('steps_used', start, start + 1)[0])
+        loaded['best_distance'] = batch_data['best_distance']
+        return loaded
+
+    def run_batch(self, batch_idx, inputs, labels, log=False):
+        """Attacks one batch already on the device and stores its results"""
+        # storing initial labels (clean ones)
+        self.attack_data[batch_idx]['labels'] = labels.clone()
+        self.attack_data[batch_idx]['inputs'] = inputs.clone()
+
+        print("Attack on batch #{}".format(batch_idx))
+        start = timer()
+        self._attack_batch(batch_idx, inputs, labels, log=log)
+        end = timer()
+
+        elapsed = end - start
+        print("Elapsed time: {}".format(elapsed))
+
+        self.attack_data[batch_idx].update(self.trace.data())
+        self.attack_data[batch_idx]['steps_used'] = self.steps_used
+        if log or self.stagnation_window is not None:
+            print("Steps used: {}/{}".format(self.steps_used, self.steps))
+        self.attack_data[batch_idx]['best_adv'] = self.init_trackers['best_adv'].clone()
+        self._finish_batch(batch_idx, self.attack_data[batch_idx])
 
-            end = timer()
+    def run(self, log=False):
+        # out = display(progress(0, self.steps), display_id=True)
+        # TODO: insert a progressbar which works in the terminal
 
-            elapsed = end - start
-            print("Elapsed time: {}".format(elapsed))
-            #print("Best distance: {}".format(torch.median(_best_distance).item()))
+        for batch_idx, batch in enumerate(self.dl_test):
+            if batch_idx > self.batch_number - 1:
+                break
+            if self._resume_batch(batch_idx):
+                print("Batch #{} restored from checkpoint".format(batch_idx))
+                continue
+            inputs, labels = batch
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
 
-            self.attack_data[batch_idx]['best_adv'] = self.init_trackers['best_adv'].clone()
-            self.attack_data[batch_idx]['best_distance'] = torch.median(_best_distance).item()
+            self.run_batch(batch_idx, inputs, labels, log=log)
 
         if log:
             print("Attack completed!\n")
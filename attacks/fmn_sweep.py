@@ -0,0 +1,259 @@
+import math
+import itertools
+
+import torch
+from torch import nn
+
+from timeit import default_timer as timer
+
+from attacks.fmn_opt import \
+    difference_of_logits, \
+    l0_projection_, \
+    l1_projection_, \
+    l2_projection_, \
+    linf_projection_, \
+    scheduler_defaults
+
+_dual_projection = {
+    0: (None, l0_projection_),
+    1: (float('inf'), l1_projection_),
+    2: (2, l2_projection_),
+    float('inf'): (1, linf_projection_),
+}
+
+_default_config = {
+    'optimizer': 'SGD',
+    'lr': 1.0,
+    'momentum': 0.0,
+    'betas': (0.9, 0.999),
+    'eps': 1e-8,
+    'scheduler': 'CosineAnnealingLR',
+    'scheduler_config': {},
+    'gamma_init': 0.05,
+    'gamma_final': 0.001
+}
+
+
+def grid(**axes):
+    """Cartesian product of the given config axes, e.g. grid(optimizer=['SGD', 'Adam'], lr=[1, 10])"""
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def lr_factor(scheduler, scheduler_config, step, steps):
+    """Learning rate multiplier of a scheduler at `step`, matching the torch.optim.lr_scheduler
+    closed forms with the missing keys filled in by fmn_opt.scheduler_defaults, as in FMNOpt"""
+    scheduler_config = scheduler_defaults(scheduler, scheduler_config, steps)
+
+    if scheduler == 'CosineAnnealingLR':
+        t_max = scheduler_config['T_max']
+        return (1 + math.cos(math.pi * step / t_max)) / 2
+
+    if scheduler == 'CosineAnnealingWarmRestarts':
+        t_0 = scheduler_config['T_0']
+        t_mult = scheduler_config.get('T_mult', 1)
+        t_cur, t_i = step, t_0
+        while t_cur >= t_i:
+            t_cur, t_i = t_cur - t_i, t_i * t_mult
+        return (1 + math.cos(math.pi * t_cur / t_i)) / 2
+
+    if scheduler == 'MultiStepLR':
+        milestones = scheduler_config['milestones']
+        return scheduler_config.get('gamma', 0.1) ** sum(step >= m for m in milestones)
+
+    if scheduler is None:
+        return 1.0
+
+    raise ValueError(f'Scheduler "{scheduler}" is not supported by the sweep '
+                     f'(ReduceLROnPlateau depends on the per-config loss history)')
+
+
+class FMNSweep:
+    """Runs many FMN optimizer/scheduler/gamma configurations on the same batches at once.
+
+    The configurations are stacked along the batch axis (row c * B + j is config c on
+    sample j) and optimized in a single tensor program: SGD (with momentum/Nesterov) and
+    Adam (with AMSGrad) are applied as functional per-row updates, and the schedulers as
+    closed-form learning rate multipliers. Each config is a dict with the keys of
+    `_default_config`; missing keys take the defaults.
+    """
+
+    def __init__(self,
+                 model: nn.Module,
+                 dataset,
+                 norm,
+                 configs,
+                 targeted: bool = False,
+                 steps: int = 10,
+                 batch_size=100,
+                 batch_number=1,
+                 device=torch.device('cpu'),
+                 logit_loss=True):
+        self.model = model
+        self.norm = float('inf') if norm == 'inf' else int(norm)
+        self.configs = [dict(_default_config, **config) for config in configs]
+        self.targeted = targeted
+        self.steps = steps
+        self.batch_number = batch_number
+        self.device = device
+        self.logit_loss = logit_loss
+
+        for config in self.configs:
+            if config['optimizer'] not in ('SGD', 'SGDNesterov', 'Adam', 'AdamAmsgrad'):
+                raise ValueError(f'Optimizer "{config["optimizer"]}" is not supported by the sweep')
+            lr_factor(config['scheduler'], config['scheduler_config'], 0, steps)
+
+        self.dl_test = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+        self.results = None
+
+    def _config_tensor(self, key, batch_size, transform=float):
+        values = torch.tensor([transform(config[key]) for config in self.configs], device=self.device)
+        return values.repeat_interleave(batch_size)
+
+    def _lr_factors(self, step, batch_size):
+        factors = [lr_factor(config['scheduler'], config['scheduler_config'], step, self.steps)
+                   for config in self.configs]
+        return torch.tensor(factors, device=self.device).repeat_interleave(batch_size)
+
+    def _attack_batch(self, inputs, labels):
+        dual, projection = _dual_projection[self.norm]
+        n_configs, batch_size = len(self.configs), len(inputs)
+
+        repeat = (n_configs, *[1] * (inputs.ndim - 1))
+        inputs, labels = inputs.repeat(repeat), labels.repeat(n_configs)
+        batch_view = lambda tensor: tensor.view(-1, *[1] * (inputs.ndim - 1))
+
+        # Per-row hyperparameters
+        lr = self._config_tensor('lr', batch_size)
+        momentum = self._config_tensor('momentum', batch_size)
+        beta1 = self._config_tensor('betas', batch_size, transform=lambda betas: betas[0])
+        beta2 = self._config_tensor('betas', batch_size, transform=lambda betas: betas[1])
+        adam_eps = self._config_tensor('eps', batch_size)
+        gamma_init = self._config_tensor('gamma_init', batch_size)
+        gamma_final = self._config_tensor('gamma_final', batch_size)
+        nesterov = self._config_tensor('optimizer', batch_size, transform=lambda name: name == 'SGDNesterov').bool()
+        adam = self._config_tensor('optimizer', batch_size, transform=lambda name: name.startswith('Adam')).bool()
+        amsgrad = self._config_tensor('optimizer', batch_size, transform=lambda name: name == 'AdamAmsgrad').bool()
+
+        # Functional optimizer state
+        delta = torch.zeros_like(inputs)
+        momentum_buffer = torch.zeros_like(inputs)
+        exp_avg = torch.zeros_like(inputs)
+        exp_avg_sq = torch.zeros_like(inputs)
+        max_exp_avg_sq = torch.zeros_like(inputs)
+
+        if self.norm == 0:
+            epsilon = torch.ones(len(inputs), device=self.device)
+        else:
+            epsilon = torch.full((len(inputs),), float('inf'), device=self.device)
+
+        worst_norm = torch.maximum(inputs, 1 - inputs).flatten(1).norm(p=self.norm, dim=1)
+        best_norm = worst_norm.clone()
+        best_adv = inputs.clone()
+        adv_found = torch.zeros(len(inputs), dtype=torch.bool, device=self.device)
+
+        multiplier = 1 if self.targeted else -1
+        labels_infhot = None
+
+        for i in range(self.steps):
+            cosine = (1 + math.cos(math.pi * i / self.steps)) / 2
+            gamma = gamma_final + (gamma_init - gamma_final) * cosine
+
+            delta.requires_grad_(True)
+            delta_norm = delta.data.flatten(1).norm(p=self.norm, dim=1)
+            adv_inputs = inputs + delta
+
+            logits = self.model(adv_inputs)
+            pred_labels = logits.argmax(dim=1)
+
+            if self.logit_loss:
+                if labels_infhot is None:
+                    labels_infhot = torch.zeros_like(logits).scatter_(1, labels.unsqueeze(1), float('inf'))
+                loss = -(multiplier * difference_of_logits(logits, labels, labels_infhot=labels_infhot))
+            else:
+                loss = -nn.functional.cross_entropy(logits, labels, reduction='none')
+
+            delta_grad, = torch.autograd.grad(loss.sum(), delta)
+            delta = delta.detach()
+
+            is_adv = (pred_labels == labels) if self.targeted else (pred_labels != labels)
+            is_both = is_adv & (delta_norm < best_norm)
+            adv_found.logical_or_(is_adv)
+            best_norm = torch.where(is_both, delta_norm, best_norm)
+            best_adv = torch.where(batch_view(is_both), adv_inputs.detach(), best_adv)
+
+            if self.norm == 0:
+                epsilon = torch.where(is_adv,
+                                      torch.minimum(torch.minimum(epsilon - 1, (epsilon * (1 - gamma)).floor_()),
+                                                    best_norm),
+                                      torch.maximum(epsilon + 1, (epsilon * (1 + gamma)).floor_()))
+                epsilon.clamp_(min=0)
+            else:
+                distance_to_boundary = loss.detach().abs() / delta_grad.flatten(1).norm(p=dual, dim=1).clamp_(
+                    min=1e-12)
+                epsilon = torch.where(is_adv,
+                                      torch.minimum(epsilon * (1 - gamma), best_norm),
+                                      torch.where(adv_found, epsilon * (1 + gamma), delta_norm + distance_to_boundary))
+            epsilon = torch.minimum(epsilon, worst_norm)
+
+            # normalize gradient
+            delta_grad.div_(batch_view(delta_grad.flatten(1).norm(p=2, dim=1).clamp_(min=1e-12)))
+
+            # SGD: buf = momentum * buf + grad, with the Nesterov look-ahead where requested
+            momentum_buffer.mul_(batch_view(momentum)).add_(delta_grad)
+            sgd_step = torch.where(batch_view(nesterov),
+                                   delta_grad + batch_view(momentum) * momentum_buffer,
+                                   momentum_buffer)
+
+            # Adam with bias correction, optionally AMSGrad
+            exp_avg.mul_(batch_view(beta1)).add_(batch_view(1 - beta1) * delta_grad)
+            exp_avg_sq.mul_(batch_view(beta2)).add_(batch_view(1 - beta2) * delta_grad * delta_grad)
+            torch.maximum(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+            second_moment = torch.where(batch_view(amsgrad), max_exp_avg_sq, exp_avg_sq)
+            bias_correction1 = batch_view(1 - beta1 ** (i + 1))
+            bias_correction2 = batch_view(1 - beta2 ** (i + 1))
+            adam_step = (exp_avg / bias_correction1) / \
+                ((second_moment / bias_correction2).sqrt_() + batch_view(adam_eps))
+
+            step_lr = batch_view(lr * self._lr_factors(i, batch_size))
+            delta.sub_(step_lr * torch.where(batch_view(adam), adam_step, sgd_step))
+
+            # project in place and clamp
+            projection(delta=delta, epsilon=epsilon)
+            delta.add_(inputs).clamp_(min=0, max=1).sub_(inputs)
+
+        distances = torch.linalg.norm((best_adv - inputs).flatten(1), dim=1, ord=self.norm)
+        return distances.view(n_configs, batch_size), adv_found.view(n_configs, batch_size)
+
+    def run(self, log=False):
+        """Returns, for every config, the median best distance and the success rate over the attacked samples"""
+        self.model.eval()
+
+        distances, successes = [], []
+        for batch_idx, (inputs, labels) in enumerate(self.dl_test):
+            if batch_idx > self.batch_number - 1:
+                break
+
+            print(f"Sweep of {len(self.configs)} configs on batch #{batch_idx}")
+            start = timer()
+            batch_distances, batch_successes = self._attack_batch(inputs.to(self.device), labels.to(self.device))
+            print("Elapsed time: {}".format(timer() - start))
+
+            distances.append(batch_distances)
+            successes.append(batch_successes)
+
+        distances, successes = torch.cat(distances, dim=1), torch.cat(successes, dim=1)
+
+        self.results = []
+        for config, config_distances, config_successes in zip(self.configs, distances, successes):
+            self.results.append({
+                'config': config,
+                'best_distance': torch.median(config_distances).item(),
+                'success_rate': config_successes.float().mean().item()
+            })
+            if log:
+                print(f"{config} -> best distance {self.results[-1]['best_distance']:.5f}, "
+                      f"success rate {self.results[-1]['success_rate']:.3f}")
+
+        return self.results
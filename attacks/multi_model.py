@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer as timer
+
+from attacks.fmn_opt import FMNOpt
+
+
+class ConcurrentFMN:
+    """Runs the same FMN attack on several models (e.g. the sparsity checkpoints of one
+    architecture) over shared test batches.
+
+    Each batch is read and moved to the device once, then every model attacks it in its
+    own worker thread with its own FMNOpt, so the models overlap their forward/backward
+    passes. `stores` optionally maps a model name to its AttackStore.
+    """
+
+    def __init__(self, models, dataset, stores=None, **fmn_kwargs):
+        stores = stores or {}
+        self.models = models
+        self.fmn = {name: FMNOpt(model=model, dataset=dataset, store=stores.get(name), **fmn_kwargs)
+                    for name, model in models.items()}
+
+        first = next(iter(self.fmn.values()))
+        self.dl_test = first.dl_test
+        self.batch_number = first.batch_number
+        self.device = first.device
+
+    def load_batch(self, name, batch_idx):
+        return self.fmn[name].load_batch(batch_idx)
+
+    def run(self, log=False):
+        for model in self.models.values():
+            model.eval()
+
+        start = timer()
+        with ThreadPoolExecutor(max_workers=len(self.fmn)) as pool:
+            for batch_idx, (inputs, labels) in enumerate(self.dl_test):
+                if batch_idx > self.batch_number - 1:
+                    break
+
+                pending = {name: fmn for name, fmn in self.fmn.items() if not fmn._resume_batch(batch_idx)}
+                if not pending:
+                    continue
+
+                inputs = inputs.to(self.device)
+                labels = labels.to(self.device)
+
+                futures = [pool.submit(fmn.run_batch, batch_idx, inputs, labels, log) for fmn in pending.values()]
+                for future in futures:
+                    future.result()
+
+        print("Elapsed time on {} models: {}".format(len(self.fmn), timer() - start))
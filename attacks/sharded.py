@@ -0,0 +1,88 @@
+import os
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import Subset
+
+from timeit import default_timer as timer
+
+from attacks.fmn_opt import FMNOpt
+
+# Per-process state of the pool workers, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(model, dataset, fmn_kwargs, threads):
+    torch.set_num_threads(threads)
+    _worker.update(model=model, dataset=dataset, fmn_kwargs=fmn_kwargs)
+
+
+def _attack_shard(batch_idx):
+    dataset, fmn_kwargs = _worker['dataset'], _worker['fmn_kwargs']
+
+    batch_size = fmn_kwargs['batch_size']
+    indices = range(batch_idx * batch_size, min((batch_idx + 1) * batch_size, len(dataset)))
+
+    if fmn_kwargs.get('starting_points') is not None:
+        fmn_kwargs = dict(fmn_kwargs, starting_points=fmn_kwargs['starting_points'][indices.start:indices.stop])
+
+    fmn_opt = FMNOpt(model=_worker['model'], dataset=Subset(dataset, indices), batch_number=1, **fmn_kwargs)
+    fmn_opt.run()
+
+    batch_data = fmn_opt.load_batch(0)
+    return batch_idx, {key: value.cpu() if torch.is_tensor(value) else value for key, value in batch_data.items()}
+
+
+class ShardedFMN:
+    """Runs FMNOpt with the `batch_number` batches spread over a pool of worker processes.
+
+    Every worker gets a copy-on-write, shared-memory view of the model and runs one batch
+    at a time with `threads_per_worker` intra-op threads. Finished batches are merged back,
+    in order, into `attack_data` (or the store/spill directory) of a regular FMNOpt, so
+    `load_batch` and the rest of the FMNOpt interface work unchanged.
+    """
+
+    def __init__(self, model, dataset, num_workers=None, threads_per_worker=None, **fmn_kwargs):
+        self.num_workers = num_workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(1, os.cpu_count() // self.num_workers)
+
+        assert 'device' not in fmn_kwargs or torch.device(fmn_kwargs['device']).type == 'cpu', \
+            'Sharded FMN only runs on CPU'
+
+        self.fmn = FMNOpt(model=model, dataset=dataset, **fmn_kwargs)
+        self.model = model
+        self.dataset = dataset
+
+        # Workers never touch the shared outputs: storing, spilling and checkpointing happen in the parent
+        self.worker_kwargs = {key: value for key, value in fmn_kwargs.items()
+                              if key not in ('batch_number', 'store', 'trace_spill_dir', 'checkpoint_dir')}
+        self.worker_kwargs.setdefault('batch_size', self.fmn.batch_size)
+
+    @property
+    def attack_data(self):
+        return self.fmn.attack_data
+
+    def load_batch(self, batch_idx):
+        return self.fmn.load_batch(batch_idx)
+
+    def run(self, log=False):
+        n_batches = min(self.fmn.batch_number, len(self.fmn.dl_test))
+        pending = [batch_idx for batch_idx in range(n_batches) if not self.fmn._resume_batch(batch_idx)]
+
+        self.model.eval()
+        self.model.share_memory()
+
+        print(f"Attack on {len(pending)} of {n_batches} batches with {self.num_workers} workers "
+              f"x {self.threads_per_worker} threads")
+        start = timer()
+
+        ctx = mp.get_context('fork')
+        with ctx.Pool(self.num_workers,
+                      initializer=_init_worker,
+                      initargs=(self.model, self.dataset, self.worker_kwargs, self.threads_per_worker)) as pool:
+            for batch_idx, batch_data in pool.imap(_attack_shard, pending):
+                if log:
+                    print("Merged batch #{}".format(batch_idx))
+                self.fmn._finish_batch(batch_idx, batch_data)
+
+        print("Elapsed time: {}".format(timer() - start))
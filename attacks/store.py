@@ -0,0 +1,145 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+
+class AttackStore:
+    """Append-only, memory-mapped columnar store for attack results.
+
+    A run lives in one directory holding a single data file (`data.bin`) and a JSON
+    manifest (`manifest.json`). Every `append` writes one raw chunk per column at the
+    end of the data file; the manifest records, for each column, its dtype, the
+    per-sample shape and the (offset, first row, rows) of its chunks. Readers memory-map
+    only the chunks overlapping the requested sample range.
+    """
+
+    DATA_FILE = 'data.bin'
+    MANIFEST_FILE = 'manifest.json'
+
+    def __init__(self, root, mode='r'):
+        assert mode in ('r', 'a'), 'AttackStore mode must be "r" or "a"'
+
+        self.root = root
+        self.mode = mode
+        self.data_path = os.path.join(root, self.DATA_FILE)
+        self.manifest_path = os.path.join(root, self.MANIFEST_FILE)
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        elif mode == 'a':
+            os.makedirs(root, exist_ok=True)
+            self.manifest = {'rows': 0, 'columns': {}, 'meta': {}}
+        else:
+            raise FileNotFoundError(f'No attack store found at {root}')
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    @property
+    def columns(self):
+        return tuple(self.manifest['columns'])
+
+    @property
+    def meta(self):
+        return self.manifest['meta']
+
+    def set_meta(self, **meta):
+        assert self.mode == 'a', 'AttackStore is read-only'
+        self.manifest['meta'].update(meta)
+        self._write_manifest()
+
+    def append(self, **columns):
+        """Appends one chunk of rows; every column must have the same number of rows"""
+        assert self.mode == 'a', 'AttackStore is read-only'
+
+        arrays = {name: self._to_numpy(value) for name, value in columns.items()}
+        rows = {len(array) for array in arrays.values()}
+        if len(rows) != 1:
+            raise ValueError(f'All columns must have the same number of rows, got {rows}')
+        rows = rows.pop()
+
+        missing = set(self.manifest['columns']) - set(arrays)
+        if self.manifest['rows'] > 0 and missing:
+            raise ValueError(f'Missing columns in append: {sorted(missing)}')
+
+        with open(self.data_path, 'ab') as f:
+            for name, array in arrays.items():
+                column = self.manifest['columns'].setdefault(name, {
+                    'dtype': array.dtype.str,
+                    'shape': list(array.shape[1:]),
+                    'chunks': []
+                })
+                if self.manifest['rows'] > 0 and not column['chunks']:
+                    raise ValueError(f'Column "{name}" was not present in earlier appends')
+                if list(array.shape[1:]) != column['shape'] or array.dtype.str != column['dtype']:
+                    raise ValueError(f'Column "{name}" expects {column["dtype"]}{column["shape"]}, '
+                                     f'got {array.dtype.str}{list(array.shape[1:])}')
+
+                offset = f.tell()
+                f.write(np.ascontiguousarray(array).tobytes())
+                column['chunks'].append([offset, self.manifest['rows'], rows])
+
+        self.manifest['rows'] += rows
+        self._write_manifest()
+
+        return self.manifest['rows'] - rows, self.manifest['rows']
+
+    def truncate(self, rows):
+        """Drops the rows from `rows` on, e.g. the partial results of an interrupted run"""
+        assert self.mode == 'a', 'AttackStore is read-only'
+        if rows >= len(self):
+            return
+
+        end = None
+        for column in self.manifest['columns'].values():
+            kept = []
+            for offset, first, chunk_rows in column['chunks']:
+                if first >= rows:
+                    end = offset if end is None else min(end, offset)
+                else:
+                    kept.append([offset, first, min(chunk_rows, rows - first)])
+            column['chunks'] = kept
+        self.manifest['rows'] = rows
+        self._write_manifest()
+
+        # The dropped chunks are the last ones written: cut them from the data file
+        if end is not None:
+            with open(self.data_path, 'r+b') as f:
+                f.truncate(end)
+
+    def read(self, column, start=0, stop=None):
+        """Returns the rows [start, stop) of a column without loading the other samples"""
+        info = self.manifest['columns'][column]
+        stop = len(self) if stop is None else min(stop, len(self))
+        dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+
+        parts = []
+        for offset, first, rows in info['chunks']:
+            lo, hi = max(start, first), min(stop, first + rows)
+            if lo >= hi:
+                continue
+            chunk = np.memmap(self.data_path, dtype=dtype, mode='r', offset=offset, shape=(rows,) + shape)
+            parts.append(chunk[lo - first:hi - first])
+
+        if not parts:
+            return np.empty((0,) + shape, dtype=dtype)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def read_tensor(self, column, start=0, stop=None, device='cpu'):
+        return torch.from_numpy(np.array(self.read(column, start, stop))).to(device)
+
+    def _write_manifest(self):
+        # Write-then-rename keeps the manifest consistent with the data if the process dies mid-append
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _to_numpy(value):
+        if torch.is_tensor(value):
+            return value.detach().cpu().numpy()
+        return np.asarray(value)
@@ -0,0 +1,101 @@
+import os
+import math
+
+import torch
+
+
+class TraceRecorder:
+    """Records per-step attack tensors (e.g. epsilon and distance) with bounded memory.
+
+    Only one step every `stride` is kept, and at most `capacity` recorded steps are
+    stored in a preallocated ring buffer (the most recent ones win). With `spill_dir`
+    set, every finished batch is written to `<spill_dir>/<batch_idx>.pt` and dropped
+    from memory, so the footprint does not grow with the number of attacked samples.
+    """
+
+    def __init__(self, keys=('epsilon', 'distance'), stride=1, capacity=None, spill_dir=None):
+        assert stride >= 1, 'Trace stride must be a positive integer'
+        assert capacity is None or capacity >= 1, 'Trace capacity must be a positive integer'
+
+        self.keys = tuple(keys)
+        self.stride = stride
+        self.capacity = capacity
+        self.spill_dir = spill_dir
+
+        self.buffers = None
+        self.steps = None
+        self.count = 0
+
+        if self.spill_dir is not None and not os.path.exists(self.spill_dir):
+            os.makedirs(self.spill_dir)
+
+    def num_slots(self, steps):
+        slots = math.ceil(steps / self.stride)
+        if self.capacity is not None:
+            slots = min(slots, self.capacity)
+        return slots
+
+    def reset(self, batch_size, steps, device):
+        slots = self.num_slots(steps)
+
+        # Reuse the buffers across batches of the same shape
+        shape = (slots, batch_size)
+        if self.buffers is None or self.buffers[self.keys[0]].shape != shape \
+                or self.buffers[self.keys[0]].device != torch.device(device):
+            self.buffers = {key: torch.empty(shape, device=device) for key in self.keys}
+            self.steps = torch.empty(slots, dtype=torch.long)
+
+        self.count = 0
+
+    def record(self, step, **values):
+        if step % self.stride != 0:
+            return
+
+        slot = self.count % len(self.steps)
+        for key, value in values.items():
+            self.buffers[key][slot].copy_(value)
+        self.steps[slot] = step
+        self.count += 1
+
+    def data(self):
+        """Returns the recorded traces in chronological order, shaped (recorded_steps, batch_size)"""
+        slots = len(self.steps)
+        if self.count <= slots:
+            order = torch.arange(self.count)
+        else:
+            order = (torch.arange(slots) + self.count) % slots
+
+        traces = {key: self.buffers[key][order.to(self.buffers[key].device)].clone() for key in self.keys}
+        traces['trace_steps'] = self.steps[order].clone()
+        return traces
+
+    def state_dict(self):
+        return {'buffers': self.buffers, 'steps': self.steps, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.buffers, self.steps, self.count = state['buffers'], state['steps'].cpu(), state['count']
+
+    def pad(self, traces, slots):
+        """Pads traces to `slots` rows: missing steps (e.g. an attack that stopped early)
+        are filled with NaN and marked with a trace step of -1"""
+        traces = dict(traces)
+        missing = slots - len(traces['trace_steps'])
+        if missing > 0:
+            for key in self.keys:
+                filler = traces[key].new_full((missing, traces[key].shape[1]), float('nan'))
+                traces[key] = torch.cat([traces[key], filler])
+            traces['trace_steps'] = torch.cat([traces['trace_steps'],
+                                               torch.full((missing,), -1, dtype=torch.long)])
+        return traces
+
+    def spill(self, batch_idx, batch_data):
+        """Saves a finished batch to disk and returns the lightweight entry kept in memory"""
+        path = os.path.join(self.spill_dir, f'{batch_idx}.pt')
+        torch.save(batch_data, path)
+        return {'path': path, 'best_distance': batch_data['best_distance']}
+
+    @staticmethod
+    def load(batch_data, map_location='cpu'):
+        if 'path' in batch_data:
+            return torch.load(batch_data['path'], map_location=map_location)
+        return batch_data
@@ -0,0 +1,114 @@
+"""
+Linf white-box attack kernel (PGD, CW, FGSM) shared by the HARP and HYDRA evaluations.
+
+The adversarial batch and the perturbation live in two buffers allocated once per attack; every
+step is an autograd.grad w.r.t. the input followed by an in-place sign step, projection and
+clamp, on CPU or CUDA alike.
+
+    python -m attacks.whitebox --steps 20 --batch-size 128
+"""
+import argparse
+from timeit import default_timer as timer
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def ce_loss(logits, y):
+    return F.cross_entropy(logits, y)
+
+
+def cw_loss(logits, y, confidence=50):
+    """CW margin loss as in CAT (https://github.com/sunblaze-ucb/curriculum-adversarial-training-CAT)"""
+    real = logits.gather(1, y.unsqueeze(1)).squeeze(1)
+    other = logits.scatter(1, y.unsqueeze(1), float('-inf')).max(1)[0]
+    return -torch.clamp(real - other + confidence, min=0.).sum()
+
+
+def linf_attack(model, x, y, epsilon, num_steps, step_size, clip_min=0., clip_max=1., loss_fn=ce_loss,
+                is_random=True):
+    """Sign-gradient ascent of loss_fn in the epsilon Linf ball around x, returns the adversarial batch"""
+    x = x.detach()
+    delta = torch.empty_like(x)
+    if is_random:
+        delta.uniform_(-epsilon, epsilon)
+    else:
+        delta.zero_()
+    x_adv = x + delta
+
+    for _ in range(num_steps):
+        x_adv.requires_grad_(True)
+        with torch.enable_grad():
+            loss = loss_fn(model(x_adv), y)
+        grad, = torch.autograd.grad(loss, [x_adv])
+        x_adv.requires_grad_(False)
+
+        with torch.no_grad():
+            x_adv.add_(grad.sign_(), alpha=step_size)
+            torch.sub(x_adv, x, out=delta).clamp_(-epsilon, epsilon)
+            torch.add(x, delta, out=x_adv).clamp_(clip_min, clip_max)
+
+    return x_adv
+
+
+def pgd(model, x, y, epsilon, num_steps, step_size, clip_min=0., clip_max=1., is_random=True):
+    return linf_attack(model, x, y, epsilon, num_steps, step_size, clip_min, clip_max, ce_loss, is_random)
+
+
+def cw(model, x, y, epsilon, num_steps, step_size, clip_min=0., clip_max=1., is_random=True):
+    return linf_attack(model, x, y, epsilon, num_steps, step_size, clip_min, clip_max, cw_loss, is_random)
+
+
+def fgsm(model, x, y, epsilon, clip_min=0., clip_max=1.):
+    return linf_attack(model, x, y, epsilon, 1, epsilon, clip_min, clip_max, ce_loss, is_random=False)
+
+
+def _legacy_pgd(model, x, y, epsilon, num_steps, step_size, clip_min, clip_max):
+    """The previous HARP pgd_whitebox step: an SGD optimizer and Variable wrappers per step"""
+    from torch.autograd import Variable
+
+    x_adv = Variable(x.data + torch.empty_like(x).uniform_(-epsilon, epsilon), requires_grad=True)
+    for _ in range(num_steps):
+        opt = torch.optim.SGD([x_adv], lr=1e-3)
+        opt.zero_grad()
+        with torch.enable_grad():
+            loss = nn.CrossEntropyLoss()(model(x_adv), y)
+        loss.backward()
+        eta = step_size * x_adv.grad.data.sign()
+        x_adv = Variable(x_adv.data + eta, requires_grad=True)
+        eta = torch.clamp(x_adv.data - x.data, -epsilon, epsilon)
+        x_adv = Variable(x.data + eta, requires_grad=True)
+        x_adv = Variable(torch.clamp(x_adv, clip_min, clip_max), requires_grad=True)
+    return x_adv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-step time of the white-box attack kernel")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--steps", type=int, default=20)
+    cli_args = parser.parse_args()
+
+    device = torch.device(cli_args.device)
+    # Small CIFAR-sized CNN: the attack overhead is most visible when the forward is cheap
+    model = nn.Sequential(nn.Conv2d(3, 32, 3, padding=1), nn.ReLU(), nn.MaxPool2d(2),
+                          nn.Conv2d(32, 64, 3, padding=1), nn.ReLU(), nn.AdaptiveAvgPool2d(1),
+                          nn.Flatten(), nn.Linear(64, 10)).to(device).eval()
+    x = torch.rand(cli_args.batch_size, 3, 32, 32, device=device)
+    y = torch.randint(0, 10, (cli_args.batch_size,), device=device)
+    kwargs = dict(epsilon=8 / 255, num_steps=cli_args.steps, step_size=2 / 255, clip_min=0., clip_max=1.)
+
+    for name, attack in (('legacy', _legacy_pgd), ('kernel', pgd)):
+        attack(model, x, y, **kwargs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = timer()
+        attack(model, x, y, **kwargs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        print(f"{name:8s} {(timer() - start) / cli_args.steps * 1000:8.3f} ms/step")
+
+
+if __name__ == '__main__':
+    main()
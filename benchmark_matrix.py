@@ -0,0 +1,236 @@
+"""
+Runs a model x sparsity x attack benchmark grid described by a YAML/JSON matrix file.
+
+Every cell (checkpoint, attack) is cached in `cache_dir` under the sha256 of the
+checkpoint content hash, the dataset slice and the attack config, so re-running the
+matrix after adding a model or an attack only computes the missing cells.
+
+    python benchmark_matrix.py --matrix benchmark_matrix.yml
+"""
+import os
+import json
+import hashlib
+import argparse
+from argparse import Namespace
+
+import yaml
+import torch
+from torch.utils.data import DataLoader, Subset
+import pandas as pd
+
+from attacks.fmn_opt import FMNOpt
+from sparse_checkpoint import load_checkpoint
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+CHECKPOINT_HASHES_FILE = 'checkpoint_hashes.json'
+
+
+def load_matrix(path):
+    with open(path) as f:
+        if path.endswith('.json'):
+            return json.load(f)
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def file_hash(path, hashes):
+    """sha256 of a checkpoint file, memoized on (size, mtime) in `hashes`"""
+    stat = os.stat(path)
+    memo_key = os.path.abspath(path)
+    memo = hashes.get(memo_key)
+    if memo is not None and memo['size'] == stat.st_size and memo['mtime'] == stat.st_mtime:
+        return memo['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+
+    hashes[memo_key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256.hexdigest()}
+    return sha256.hexdigest()
+
+
+def cell_key(checkpoint_hash, dataset_slice, attack):
+    payload = json.dumps({'checkpoint': checkpoint_hash, 'dataset': dataset_slice, 'attack': attack},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_testset(family, name, data_dir):
+    data_args = Namespace(data_dir=data_dir, data_fraction=1.0, batch_size=128, test_batch_size=128)
+
+    if family == 'harp':
+        from HARP.data.cifar import CIFAR10
+        from HARP.data.svhn import SVHN
+    else:
+        from HYDRA.data.cifar import CIFAR10
+        from HYDRA.data.svhn import SVHN
+
+    datasets = {'cifar10': CIFAR10, 'svhn': SVHN}
+    _, _, testset = datasets[name](args=data_args).data_loaders()
+    return testset
+
+
+def build_model(family, arch, sparsity, harp_args=None):
+    if family == 'harp':
+        from HARP.models.vgg_cifar import vgg16_bn
+        from HARP.models.wrn_cifar import wrn_28_4
+        from HARP.models.layers import SubnetConv, SubnetLinear
+        from HARP.utils.model import prepare_model
+
+        # Only the fields prepare_model reads, with the values used by harp_model_benchmark.py
+        args = Namespace(exp_mode='pretrain' if sparsity == 0 else 'harp_finetune', k=1.0, alpha=0.1,
+                         freeze_bn=False, scores_init_type='kaiming_normal', prune_reg='weight')
+        args.__dict__.update(harp_args or {})
+
+        model = {'vgg16_bn': vgg16_bn, 'wrn_28_4': wrn_28_4}[arch](
+            SubnetConv, SubnetLinear, init_type='kaiming_normal',
+            mean=torch.Tensor([0.4914, 0.4822, 0.4465]),
+            std=torch.Tensor([0.2471, 0.2435, 0.2616]), prune_reg=args.prune_reg,
+            task_mode=args.exp_mode, normalize=False)
+        prepare_model(model, args, device)
+    else:
+        from torch.nn import Conv2d, Linear
+        from HYDRA.models import vgg16_bn, wrn_28_4
+
+        model = {'vgg16_bn': vgg16_bn, 'wrn_28_4': wrn_28_4}[arch](
+            conv_layer=Conv2d, linear_layer=Linear, init_type='kaiming_normal', num_classes=10)
+
+    return model
+
+
+def accuracy(model, samples, labels):
+    with torch.no_grad():
+        return (model(samples).argmax(dim=1) == labels).float().mean().item()
+
+
+def run_attack(model, dataset, attack):
+    """Runs one attack cell and returns its metrics"""
+    attack = dict(attack)
+    attack_type = attack.pop('type')
+    batch_size = attack.pop('batch_size', 100)
+
+    if attack_type == 'clean':
+        correct = 0
+        for images, labels in DataLoader(dataset, batch_size=batch_size, shuffle=False):
+            images, labels = images.to(device), labels.to(device)
+            correct += accuracy(model, images, labels) * len(labels)
+        return {'clean acc': correct / len(dataset)}
+
+    if attack_type == 'fmn':
+        fmn_opt = FMNOpt(model=model, dataset=dataset, batch_size=batch_size,
+                         batch_number=-(-len(dataset) // batch_size), device=device, **attack)
+        fmn_opt.run()
+
+        correct, distances = 0, []
+        for batch_idx in range(len(fmn_opt.attack_data)):
+            batch_data = fmn_opt.load_batch(batch_idx)
+            correct += accuracy(model, batch_data['best_adv'], batch_data['labels']) * len(batch_data['labels'])
+            distances.append(torch.linalg.norm((batch_data['best_adv'] - batch_data['inputs']).flatten(1),
+                                               dim=1, ord=fmn_opt.norm))
+        return {'robust acc': correct / len(dataset),
+                'median distance': torch.median(torch.cat(distances)).item()}
+
+    if attack_type == 'autoattack':
+        from autoattack import AutoAttack as AA
+
+        attacks_to_run = attack.pop('attacks_to_run', None)
+        model_adv = AA(model, device=device, **attack)
+        if attacks_to_run is not None:
+            model_adv.attacks_to_run = attacks_to_run
+
+        images, labels = next(iter(DataLoader(dataset, batch_size=len(dataset), shuffle=False)))
+        x_adv = model_adv.run_standard_evaluation(images, labels, bs=batch_size)
+        return {'robust acc': accuracy(model, x_adv.to(device), labels.to(device))}
+
+    raise ValueError(f'Unknown attack type "{attack_type}"')
+
+
+def plan_jobs(matrix, hashes):
+    """Expands the matrix into cells, grouped by checkpoint so every model is loaded once"""
+    jobs = []
+    for model_cfg in matrix['models']:
+        family = model_cfg.get('family', 'harp')
+        dataset_name = model_cfg.get('dataset', 'cifar10')
+
+        for sparsity, chk_path in model_cfg['checkpoints'].items():
+            checkpoint_hash = file_hash(chk_path, hashes)
+
+            cells = []
+            for attack_cfg in matrix['attacks']:
+                attack = {key: value for key, value in attack_cfg.items() if key not in ('name', 'samples', 'start')}
+                dataset_slice = {'family': family, 'name': dataset_name,
+                                 'start': attack_cfg.get('start', 0), 'samples': attack_cfg['samples']}
+                cells.append({
+                    'attack_name': attack_cfg['name'],
+                    'attack': attack,
+                    'dataset_slice': dataset_slice,
+                    'key': cell_key(checkpoint_hash, dataset_slice, attack)
+                })
+
+            jobs.append({'model': model_cfg['name'], 'family': family, 'arch': model_cfg['arch'],
+                         'harp_args': model_cfg.get('harp_args'), 'dataset': dataset_name,
+                         'sparsity': int(sparsity), 'checkpoint': chk_path, 'cells': cells})
+    return jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark matrix runner")
+    parser.add_argument("--matrix", type=str, default="benchmark_matrix.yml", help="YAML/JSON matrix file")
+    parser.add_argument("--force", action="store_true", default=False, help="ignore cached cells")
+    cli_args = parser.parse_args()
+
+    matrix = load_matrix(cli_args.matrix)
+    cache_dir = matrix.get('cache_dir', 'benchmark_cache')
+    data_dir = matrix.get('data_dir', './datasets')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    hashes_path = os.path.join(cache_dir, CHECKPOINT_HASHES_FILE)
+    hashes = {}
+    if os.path.exists(hashes_path):
+        with open(hashes_path) as f:
+            hashes = json.load(f)
+    jobs = plan_jobs(matrix, hashes)
+    with open(hashes_path, 'w') as f:
+        json.dump(hashes, f)
+
+    testsets = {}
+    rows = []
+    for job in jobs:
+        missing = [cell for cell in job['cells']
+                   if cli_args.force or not os.path.exists(os.path.join(cache_dir, f"{cell['key']}.json"))]
+        print(f"\n->{job['model']}/{job['sparsity']}: {len(job['cells']) - len(missing)} cached, "
+              f"{len(missing)} to run")
+
+        if missing:
+            model = build_model(job['family'], job['arch'], job['sparsity'], job['harp_args'])
+            checkpoint = load_checkpoint(job['checkpoint'], map_location=device)
+            model.load_state_dict(checkpoint['state_dict'], strict=True)
+            model.eval().to(device)
+
+            for cell in missing:
+                dataset_slice = cell['dataset_slice']
+                testset_key = (dataset_slice['family'], dataset_slice['name'])
+                if testset_key not in testsets:
+                    testsets[testset_key] = load_testset(*testset_key, data_dir)
+                start = dataset_slice['start']
+                dataset = Subset(testsets[testset_key], range(start, start + dataset_slice['samples']))
+
+                print(f"->Running {cell['attack_name']}...")
+                result = run_attack(model, dataset, cell['attack'])
+                with open(os.path.join(cache_dir, f"{cell['key']}.json"), 'w') as f:
+                    json.dump(result, f)
+
+        for cell in job['cells']:
+            with open(os.path.join(cache_dir, f"{cell['key']}.json")) as f:
+                result = json.load(f)
+            rows.append({'model': job['model'], 'sparsity': job['sparsity'], 'attack': cell['attack_name'],
+                         **result})
+
+    results_df = pd.DataFrame(rows)
+    results_df.to_csv(matrix.get('output', 'benchmark_matrix_results.csv'), index=False)
+    print(results_df)
+
+
+if __name__ == '__main__':
+    main()
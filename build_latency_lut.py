@@ -0,0 +1,64 @@
+"""
+Measures the CPU latency of every conv/linear layer of a HARP architecture at a grid of kept
+input/output channel rates and saves the lookup table used by `--latency_lut` in HARP training.
+
+    python build_latency_lut.py --arch resnet18 --output resnet18_cifar_lut.json --threads 1
+"""
+import argparse
+from argparse import Namespace
+
+import torch
+
+from HARP.models.vgg_cifar import vgg16_bn
+from HARP.models.resnet_cifar import resnet18, resnet34, resnet50
+from HARP.models.wrn_cifar import wrn_28_4, wrn_28_10
+from HARP.models.layers import SubnetConv, SubnetLinear
+from HARP.utils.model import prepare_model
+from HARP.utils.profiler import dummy_input_size
+from HARP.utils.latency import build_latency_lut, save_latency_lut
+
+model_to_net = {
+    'vgg16_bn': vgg16_bn,
+    'resnet18': resnet18,
+    'resnet34': resnet34,
+    'resnet50': resnet50,
+    'wrn_28_4': wrn_28_4,
+    'wrn_28_10': wrn_28_10
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HARP layer latency LUT builder")
+    parser.add_argument("--arch", type=str, default="vgg16_bn", choices=tuple(model_to_net))
+    parser.add_argument("--dataset", type=str, default="CIFAR10")
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--output", type=str, required=True, help="where to save the LUT (json)")
+    parser.add_argument("--points", type=int, default=10, help="grid points per channel rate")
+    parser.add_argument("--min-rate", type=float, default=0.05, help="smallest kept-channel rate of the grid")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads (0 = torch default)")
+    cli_args = parser.parse_args()
+
+    if cli_args.threads > 0:
+        torch.set_num_threads(cli_args.threads)
+
+    # Only the layer shapes matter: a dense pretrain model of the architecture
+    model = model_to_net[cli_args.arch](SubnetConv, SubnetLinear, init_type='kaiming_normal',
+                                        num_classes=cli_args.num_classes,
+                                        mean=torch.Tensor([0.4914, 0.4822, 0.4465]),
+                                        std=torch.Tensor([0.2471, 0.2435, 0.2616]), prune_reg='weight',
+                                        task_mode='pretrain', normalize=False)
+    prepare_model(model, Namespace(exp_mode='pretrain', k=1.0, alpha=0.1, freeze_bn=False,
+                                   scores_init_type='kaiming_normal', prune_reg='weight'))
+
+    input_size = dummy_input_size(Namespace(dataset=cli_args.dataset))
+    lut = build_latency_lut(model, input_size, cli_args.arch, cli_args.points, cli_args.min_rate, cli_args.repeats)
+    save_latency_lut(lut, cli_args.output)
+
+    full = sum(table[-1][-1] for table in lut['layers'].values())
+    print(f"{len(lut['layers'])} layers x {cli_args.points}x{cli_args.points} rates, "
+          f"full model {full:.2f} ms -> {cli_args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Exports a channel-pruned HARP checkpoint (prune_reg='channel') to a physically smaller dense
+network, checks that both produce the same logits and reports CPU latency before and after.
+
+    python export_channel_pruned.py --arch vgg16_bn --checkpoint <model_best.pth.tar> --k 0.1
+"""
+import argparse
+from argparse import Namespace
+
+import torch
+
+from HARP.models.vgg_cifar import vgg16_bn
+from HARP.models.resnet_cifar import resnet18, resnet34, resnet50
+from HARP.models.wrn_cifar import wrn_28_4, wrn_28_10
+from HARP.models.layers import SubnetConv, SubnetLinear
+from HARP.utils.model import prepare_model, freeze_masks
+from HARP.utils.export import export_channel_pruned, measure_latency
+
+model_to_net = {
+    'vgg16_bn': vgg16_bn,
+    'resnet18': resnet18,
+    'resnet34': resnet34,
+    'resnet50': resnet50,
+    'wrn_28_4': wrn_28_4,
+    'wrn_28_10': wrn_28_10
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Channel-pruned HARP model exporter")
+    parser.add_argument("--arch", type=str, default="vgg16_bn", choices=tuple(model_to_net))
+    parser.add_argument("--checkpoint", type=str, required=True, help="channel-pruned HARP checkpoint")
+    parser.add_argument("--output", type=str, default="", help="where to save the exported model")
+    parser.add_argument("--k", type=float, default=0.1, help="global pruning rate used in training")
+    parser.add_argument("--alpha", type=float, default=0.1)
+    parser.add_argument("--num-classes", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1, help="batch size of the latency measure")
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads (0 = torch default)")
+    cli_args = parser.parse_args()
+
+    if cli_args.threads > 0:
+        torch.set_num_threads(cli_args.threads)
+
+    model = model_to_net[cli_args.arch](SubnetConv, SubnetLinear, init_type='kaiming_normal',
+                                        num_classes=cli_args.num_classes,
+                                        mean=torch.Tensor([0.4914, 0.4822, 0.4465]),
+                                        std=torch.Tensor([0.2471, 0.2435, 0.2616]), prune_reg='channel',
+                                        task_mode='harp_finetune', normalize=False)
+    prepare_model(model, Namespace(exp_mode='harp_finetune', k=cli_args.k, alpha=cli_args.alpha, freeze_bn=False,
+                                   scores_init_type='kaiming_normal', prune_reg='channel'))
+
+    checkpoint = torch.load(cli_args.checkpoint, map_location='cpu')
+    model.load_state_dict(checkpoint['state_dict'], strict=True)
+    model.eval()
+    # Masked baseline without the per-forward mask computation
+    freeze_masks(model)
+
+    exported = export_channel_pruned(model)
+
+    x = torch.rand(8, 3, 32, 32)
+    with torch.no_grad():
+        max_diff = (model(x) - exported(x)).abs().max().item()
+    print(f"Max logit difference after export: {max_diff:.2e}")
+
+    params = sum(p.numel() for n, p in model.named_parameters() if n.endswith('weight') or n.endswith('bias'))
+    exported_params = sum(p.numel() for p in exported.parameters())
+    print(f"Parameters: {params} -> {exported_params}")
+
+    input_size = (cli_args.batch_size, 3, 32, 32)
+    before = measure_latency(model, input_size)
+    after = measure_latency(exported, input_size)
+    print(f"CPU latency (batch {cli_args.batch_size}): {before:.2f} ms -> {after:.2f} ms, "
+          f"speed-up x{before / after:.2f}")
+
+    if cli_args.output:
+        torch.save(exported, cli_args.output)
+        print(f"Exported model saved to {cli_args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -9,13 +9,18 @@ import numpy as np
 
 from HARP.models.vgg_cifar import vgg16_bn
 from HARP.models.layers import SubnetConv, SubnetLinear
-from HARP.utils.model import prepare_model
+from HARP.utils.model import prepare_model, freeze_masks
 
 from HARP.data.cifar import CIFAR10
 # from HYDRA.data.svhn import SVHN
 # from HYDRA.data.imagenet import imagenet
 
+from sparse_checkpoint import load_checkpoint
 from attacks.fmn_opt import FMNOpt
+from attacks.store import AttackStore
+from attacks.sharded import ShardedFMN
+from attacks.fmn_sweep import FMNSweep, grid
+from attacks.multi_model import ConcurrentFMN
 
 args = parse_args()
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -69,6 +74,12 @@ def main():
 
     args.batch_size = args.test_batch_size = 10
     args.test_fmn = True
+    # >1 shards the FMN batches over that many CPU worker processes
+    args.fmn_workers = 1
+    # Runs a grid of FMN optimizer/scheduler configs on one batch, in a single stacked run
+    args.fmn_sweep = False
+    # Attacks all the checkpoints of an architecture together, on shared test batches
+    args.concurrent_checkpoints = False
 
     test_images = 1000
     attack_samples = 1000
@@ -91,6 +102,9 @@ def main():
         if model_name not in test_data:
             test_data[model_name] = {}
 
+        # Checkpoints (and their stores) held for the concurrent FMN evaluation
+        concurrent_models, concurrent_stores = {}, {}
+
         # iterate through chechkpoints
         for i, chk_path in enumerate(pretrained[model_name]):
             if sparsities[i] == 0:
@@ -108,9 +122,11 @@ def main():
             print(f"\n->Loading the {model_name}/{sparsities[i]} model...")
             test_data[model_name][sparsities[i]] = {}
 
-            checkpoint = torch.load(chk_path, map_location=device)
+            checkpoint = load_checkpoint(chk_path, map_location=device)
             model.load_state_dict(checkpoint['state_dict'], strict=True)
             model.eval().to(device)
+            # The masks are fixed during evaluation: build the masked weights once
+            freeze_masks(model)
 
             # Clean-acc evaluation
             print(f"->Evaluating clean accuracy on {test_images} test images...")
@@ -140,9 +156,16 @@ def main():
                 if scheduler == 'CosineAnnealingWarmRestarts':
                     scheduler_config['T_0'] = steps // 2
 
-                fmn_opt = FMNOpt(
-                    model=model.eval().to(device),
-                    dataset=testset,
+                # Get the current date and time
+                current_datetime = datetime.datetime.now()
+                formatted_datetime = current_datetime.strftime("%Y%m%d_%H%M")
+                data_path = os.path.join('harp_fmn_attack_data', f'{model_name}_{sparsities[i]}_{formatted_datetime}')
+
+                # FMN data is appended batch by batch to a columnar store in data_path
+                print(f'-> Saving FMN data to {data_path}...')
+                store = AttackStore(data_path, mode='a')
+
+                fmn_kwargs = dict(
                     norm='inf',
                     steps=steps,
                     batch_size=attack_batch_size,
@@ -151,28 +174,50 @@ def main():
                     scheduler=scheduler,
                     optimizer_config=optimizer_config,
                     scheduler_config=scheduler_config,
-                    device=device
+                    device=device,
+                    store=store
                 )
 
-                fmn_opt.run()
-                robust_acc = accuracy(model, fmn_opt.attack_data[-1]['best_adv'], fmn_opt.attack_data[-1]['labels'])
-                print(f"->FMN robust accuracy: {robust_acc * 100:.2f}")
-                test_data[model_name][sparsities[i]]['AA robust'] = robust_acc
-
-                # Get the current date and time
-                current_datetime = datetime.datetime.now()
-                formatted_datetime = current_datetime.strftime("%Y%m%d_%H%M")
-                data_path = os.path.join('harp_fmn_attack_data', f'{model_name}_{sparsities[i]}_{formatted_datetime}')
-
-                print('-> Saving FMN data...')
-                if not os.path.exists(data_path):
-                    os.makedirs(data_path)
-                # Save the data
-                for j in range(fmn_opt.batch_number):
-                    if not os.path.exists(f'{data_path}/{j}'):
-                        os.mkdir(f'{data_path}/{j}')
-                    for data in fmn_opt.attack_data[j]:
-                        torch.save(fmn_opt.attack_data[j][data], f'{data_path}/{j}/{data}.pt')
+                if args.concurrent_checkpoints:
+                    concurrent_models[sparsities[i]] = model
+                    concurrent_stores[sparsities[i]] = fmn_kwargs.pop('store')
+                elif args.fmn_workers > 1 and device.type == 'cpu':
+                    fmn_opt = ShardedFMN(model=model.eval(), dataset=testset, num_workers=args.fmn_workers,
+                                         **fmn_kwargs)
+                else:
+                    fmn_opt = FMNOpt(model=model.eval().to(device), dataset=testset, **fmn_kwargs)
+
+                if not args.concurrent_checkpoints:
+                    fmn_opt.run()
+                    last_batch = fmn_opt.load_batch(-1)
+                    robust_acc = accuracy(model, last_batch['best_adv'], last_batch['labels'])
+                    print(f"->FMN robust accuracy: {robust_acc * 100:.2f}")
+                    test_data[model_name][sparsities[i]]['AA robust'] = robust_acc
+
+            if args.fmn_sweep:
+                print("->Sweeping FMN optimizer/scheduler configs...")
+                configs = grid(optimizer=['SGD', 'SGDNesterov', 'Adam'],
+                               lr=[0.1, 1, 10],
+                               momentum=[0.9],
+                               scheduler=['CosineAnnealingLR', 'MultiStepLR'])
+                fmn_sweep = FMNSweep(model=model.eval().to(device), dataset=testset, norm='inf', configs=configs,
+                                     steps=100, batch_size=attack_batch_size, batch_number=1, device=device)
+                sweep_df = pd.DataFrame([dict(result['config'], best_distance=result['best_distance'],
+                                              success_rate=result['success_rate'])
+                                         for result in fmn_sweep.run()])
+                os.makedirs('harp_fmn_attack_data', exist_ok=True)
+                sweep_df.to_csv(os.path.join('harp_fmn_attack_data', f'{model_name}_{sparsities[i]}_sweep.csv'))
+
+        if concurrent_models:
+            print(f"\n->Evaluating robustness of {len(concurrent_models)} {model_name} checkpoints with FMN...")
+            fmn_opt = ConcurrentFMN(models=concurrent_models, dataset=testset, stores=concurrent_stores,
+                                    **fmn_kwargs)
+            fmn_opt.run()
+            for sparsity, sparse_model in concurrent_models.items():
+                last_batch = fmn_opt.load_batch(sparsity, -1)
+                robust_acc = accuracy(sparse_model, last_batch['best_adv'], last_batch['labels'])
+                print(f"->FMN robust accuracy of {model_name}/{sparsity}: {robust_acc * 100:.2f}")
+                test_data[model_name][sparsity]['AA robust'] = robust_acc
 
     flat_data = {}
     for outer_key, inner_dict in test_data.items():
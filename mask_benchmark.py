@@ -0,0 +1,104 @@
+"""
+Micro-benchmark of the GetSubnet mask engines (full sort vs kthvalue selection vs histogram
+threshold): per-layer mask time on WRN-28-4 / ResNet50 layer shapes, and the step time of a
+harp_prune training step on a HARP WRN-28-4.
+
+    python mask_benchmark.py --device cuda
+"""
+import argparse
+from timeit import default_timer as timer
+
+import torch
+import torch.nn as nn
+
+from HARP.models.layers import SubnetConv, SubnetLinear, GetSubnet, set_mask_engine
+from HARP.models.wrn_cifar import wrn_28_4
+
+ENGINES = ('sort', 'kthvalue', 'histogram')
+
+# Largest conv weights of WRN-28-4 and ResNet50
+LAYER_SHAPES = {
+    'wrn28-4 block3 conv (256x256x3x3)': (256, 256, 3, 3),
+    'resnet50 layer4 conv2 (512x512x3x3)': (512, 512, 3, 3),
+    'resnet50 layer4 conv3 (2048x512x1x1)': (2048, 512, 1, 1),
+}
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_it(fn, device, repeats):
+    fn()
+    synchronize(device)
+    start = timer()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return (timer() - start) / repeats * 1000
+
+
+def bench_layers(device, k, repeats):
+    print(f"\nGetSubnet forward+backward, k={k} (ms)")
+    for name, shape in LAYER_SHAPES.items():
+        scores = torch.randn(shape, device=device, requires_grad=True)
+        # HARP layers train their pruning rate: GetSubnet returns a gradient for k
+        k_score = torch.tensor(k, device=device, requires_grad=True)
+
+        def step():
+            GetSubnet.apply(scores.abs(), k_score).sum().backward()
+
+        timings = []
+        for engine in ENGINES:
+            set_mask_engine(engine, histogram_numel=0)
+            timings.append(f"{engine}: {time_it(step, device, repeats):8.3f}")
+        print(f"{name:40s} " + "  ".join(timings))
+
+
+def bench_training_step(device, k, batch_size, repeats, histogram_numel):
+    model = wrn_28_4(SubnetConv, SubnetLinear, init_type='kaiming_normal',
+                     mean=torch.Tensor([0.4914, 0.4822, 0.4465]), std=torch.Tensor([0.2471, 0.2435, 0.2616]),
+                     prune_reg='weight', task_mode='harp_prune', normalize=False).to(device)
+    for m in model.modules():
+        if hasattr(m, "set_prune_rate"):
+            m.set_prune_rate(k, k, 0.1, device)
+    # harp_prune: only the scores and the pruning rates are trained
+    for name, p in model.named_parameters():
+        p.requires_grad = 'popup_scores' in name or 'k_score' in name
+
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=0.1, momentum=0.9)
+    criterion = nn.CrossEntropyLoss()
+    images = torch.rand(batch_size, 3, 32, 32, device=device)
+    target = torch.randint(0, 10, (batch_size,), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        criterion(model(images), target).backward()
+        optimizer.step()
+
+    print(f"\nharp_prune training step on WRN-28-4, batch {batch_size}, k={k} (ms)")
+    for engine in ENGINES:
+        set_mask_engine(engine, histogram_numel=histogram_numel)
+        print(f"{engine:10s} {time_it(step, device, repeats):8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GetSubnet mask engine micro-benchmark")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--k", type=float, default=0.1, help="fraction of weights kept")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--histogram-numel", type=int, default=0,
+                        help="smallest layer using the histogram engine in the training step "
+                             "(the largest WRN-28-4 conv has 589824 scores)")
+    cli_args = parser.parse_args()
+
+    device = torch.device(cli_args.device)
+    bench_layers(device, cli_args.k, cli_args.repeats)
+    bench_training_step(device, cli_args.k, cli_args.batch_size, cli_args.repeats, cli_args.histogram_numel)
+    set_mask_engine()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ import numpy as np
 import scienceplots
 import argparse
 
+from attacks.store import AttackStore
+
 # plt.style.use(['science','ieee'])
 
 parser = argparse.ArgumentParser()
@@ -23,16 +25,23 @@ else:
 
 for idx, model in enumerate(models):
     model_dir = list(data_dir.glob(f'{model}*'))[0]
-    batches = [f for f in model_dir.glob('*')]
-
-    best_advs = None
-    inputs = None
-    for batch in batches[:len(batches)]:
-        _best_advs = torch.load(batch / 'best_adv.pt', map_location='cpu')
-        _inputs = torch.load(batch / 'inputs.pt', map_location='cpu')
 
-        best_advs = _best_advs if best_advs is None else torch.cat([best_advs, _best_advs])
-        inputs = _inputs if inputs is None else torch.cat([inputs, _inputs])
+    if (model_dir / AttackStore.MANIFEST_FILE).exists():
+        store = AttackStore(str(model_dir))
+        best_advs = store.read_tensor('best_adv')
+        inputs = store.read_tensor('inputs')
+    else:
+        # Legacy layout: one directory per batch with one .pt file per key
+        batches = [f for f in model_dir.glob('*')]
+
+        best_advs = None
+        inputs = None
+        for batch in batches[:len(batches)]:
+            _best_advs = torch.load(batch / 'best_adv.pt', map_location='cpu')
+            _inputs = torch.load(batch / 'inputs.pt', map_location='cpu')
+
+            best_advs = _best_advs if best_advs is None else torch.cat([best_advs, _best_advs])
+            inputs = _inputs if inputs is None else torch.cat([inputs, _inputs])
 
     n_samples = best_advs.shape[0]
     norms = (best_advs - inputs).flatten(1).norm(torch.inf, dim=1)
@@ -0,0 +1,150 @@
+"""
+Compressed checkpoint format for highly pruned HARP/HYDRA models.
+
+Pruned weight tensors are stored as a bitpacked nonzero mask plus the packed nonzero values,
+subnet scores as a bitpacked mask only (the effective top-k mask they select), and every other
+tensor as is. `load_checkpoint` reads both this format and regular checkpoints, rebuilding the
+subnet state dict (or, with dense=True, the dense one).
+
+    python sparse_checkpoint.py --input model_best.pth.tar --output model_best.sparse.pth.tar \
+        --family harp --k 0.01
+"""
+import os
+import argparse
+
+import numpy as np
+import torch
+
+FORMAT = 'sparse-v1'
+
+# State dict entries that only exist in subnet layers
+SUBNET_KEYS = ('popup_scores', 'k_score')
+
+
+def pack_mask(mask):
+    return torch.from_numpy(np.packbits(mask.flatten().cpu().numpy().astype(np.uint8)))
+
+
+def unpack_mask(packed, shape):
+    count = int(np.prod(shape))
+    bits = np.unpackbits(packed.cpu().numpy(), count=count).astype(bool)
+    return torch.from_numpy(bits).view(shape)
+
+
+def subnet_masks(state_dict, family, k, alpha=0.1):
+    """Effective masks selected by the scores of every subnet layer (score-shaped), keyed by the layer prefix"""
+    masks = {}
+    for key, scores in state_dict.items():
+        if not key.endswith('popup_scores'):
+            continue
+        prefix = key[:-len('popup_scores')]
+        weight = state_dict[prefix + 'weight']
+
+        if family == 'harp':
+            from HARP.models.layers import GetSubnet
+            from HARP.utils.utils import rate_act_func
+            layer_k = rate_act_func(state_dict[prefix + 'k_score'].float(), k * alpha)
+            prune_reg = 'weight' if scores.shape == weight.shape else 'channel'
+            mask = GetSubnet.apply(scores.abs().float(), layer_k, prune_reg)
+        else:
+            from HYDRA.models.layers import GetSubnet
+            mask = GetSubnet.apply(scores.abs().float(), k)
+
+        masks[prefix] = mask != 0
+    return masks
+
+
+def encode_state_dict(state_dict, family=None, k=None, alpha=0.1, max_density=0.5):
+    """
+        Sparse encoding of a state dict. With `k` set, subnet scores are replaced by the mask they
+        select (scores are only ever used through it) and weights are masked accordingly; weights
+        of dense checkpoints are encoded from their zeros.
+    """
+    masks = subnet_masks(state_dict, family, k, alpha) if k is not None else {}
+
+    tensors = {}
+    for key, value in state_dict.items():
+        value = value.detach().cpu()
+        prefix = key.rsplit('.', 1)[0] + '.' if '.' in key else ''
+
+        if key.endswith('popup_scores') and prefix in masks:
+            # 0/1 scores select the same top-k mask as the original ones
+            tensors[key] = {'kind': 'mask', 'shape': list(value.shape), 'dtype': str(value.dtype),
+                            'mask': pack_mask(masks[prefix])}
+            continue
+
+        if key.endswith('weight') and value.dim() >= 2:
+            if prefix in masks:
+                value = value * masks[prefix].expand_as(value)
+            nonzero = value != 0
+            if nonzero.float().mean() <= max_density:
+                tensors[key] = {'kind': 'sparse', 'shape': list(value.shape), 'dtype': str(value.dtype),
+                                'mask': pack_mask(nonzero), 'values': value[nonzero].clone()}
+                continue
+
+        tensors[key] = {'kind': 'dense', 'value': value}
+    return tensors
+
+
+def decode_state_dict(tensors, dense=False):
+    """
+        Rebuilds a state dict; with dense=True the subnet-only entries (scores, pruning rates) are
+        dropped and the weights stay masked, for a strict load into Conv2d/Linear layers
+    """
+    state_dict = {}
+    for key, entry in tensors.items():
+        if dense and key.endswith(SUBNET_KEYS):
+            continue
+        if entry['kind'] == 'dense':
+            state_dict[key] = entry['value']
+            continue
+
+        dtype = getattr(torch, entry['dtype'].replace('torch.', ''))
+        mask = unpack_mask(entry['mask'], entry['shape'])
+        if entry['kind'] == 'mask':
+            state_dict[key] = mask.to(dtype)
+        else:
+            value = torch.zeros(entry['shape'], dtype=dtype)
+            value[mask] = entry['values'].cpu()
+            state_dict[key] = value
+    return state_dict
+
+
+def save_sparse_checkpoint(checkpoint, path, family=None, k=None, alpha=0.1):
+    sparse = {key: value for key, value in checkpoint.items() if key not in ('state_dict', 'optimizer')}
+    sparse['format'] = FORMAT
+    sparse['tensors'] = encode_state_dict(checkpoint['state_dict'], family, k, alpha)
+    torch.save(sparse, path)
+
+
+def load_checkpoint(path, map_location='cpu', dense=False):
+    """Loads a regular or sparse checkpoint, always returning a dict with a 'state_dict'"""
+    checkpoint = torch.load(path, map_location=map_location)
+    if checkpoint.get('format') != FORMAT:
+        return checkpoint
+
+    state_dict = decode_state_dict(checkpoint.pop('tensors'), dense=dense)
+    checkpoint.pop('format')
+    checkpoint['state_dict'] = {key: value.to(map_location) for key, value in state_dict.items()}
+    return checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a HARP/HYDRA checkpoint to the sparse format")
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--family", type=str, default="harp", choices=("harp", "hydra"))
+    parser.add_argument("--k", type=float, default=None,
+                        help="pruning rate of subnet checkpoints (omit for dense checkpoints)")
+    parser.add_argument("--alpha", type=float, default=0.1, help="HARP k_min = k * alpha")
+    cli_args = parser.parse_args()
+
+    checkpoint = torch.load(cli_args.input, map_location='cpu')
+    save_sparse_checkpoint(checkpoint, cli_args.output, cli_args.family, cli_args.k, cli_args.alpha)
+
+    before, after = os.path.getsize(cli_args.input), os.path.getsize(cli_args.output)
+    print(f"{cli_args.input}: {before / 2 ** 20:.2f} MB -> {after / 2 ** 20:.2f} MB (x{before / after:.1f})")
+
+
+if __name__ == '__main__':
+    main()
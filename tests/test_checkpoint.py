@@ -0,0 +1,100 @@
+import pytest
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset
+
+from attacks.checkpoint import AttackCheckpoint
+from attacks.fmn_opt import FMNOpt
+from attacks.store import AttackStore
+
+
+class Interrupted(Exception):
+    pass
+
+
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    return nn.Sequential(nn.Flatten(), nn.Linear(12, 3)).eval()
+
+
+def make_dataset(model):
+    torch.manual_seed(1)
+    x = torch.rand(8, 3, 2, 2)
+    return TensorDataset(x, model(x).argmax(1).detach())
+
+
+def make_attack(model, dataset, tmp_path, **kwargs):
+    return FMNOpt(model=model, dataset=dataset, norm='inf', steps=20, batch_size=4, batch_number=2,
+                  optimizer_config={'lr': 1.0}, checkpoint_dir=str(tmp_path / 'checkpoint'),
+                  checkpoint_interval=5, **kwargs)
+
+
+def best_advs(attack):
+    return torch.cat([attack.load_batch(i)['best_adv'] for i in range(2)])
+
+
+def test_resume_after_store_append(tmp_path, monkeypatch):
+    model = make_model()
+    dataset = make_dataset(model)
+    reference = make_attack(model, dataset, tmp_path / 'reference', store=AttackStore(str(tmp_path / 'ref'), 'a'))
+    reference.run()
+
+    # Crash between the store append of batch 1 and its checkpoint marker
+    def save_batch(self, batch_idx, batch_data):
+        if batch_idx == 1:
+            raise Interrupted
+        original_save_batch(self, batch_idx, batch_data)
+
+    original_save_batch = AttackCheckpoint.save_batch
+    monkeypatch.setattr(AttackCheckpoint, 'save_batch', save_batch)
+    with pytest.raises(Interrupted):
+        make_attack(model, dataset, tmp_path, store=AttackStore(str(tmp_path / 'store'), 'a')).run()
+    assert len(AttackStore(str(tmp_path / 'store'))) == 8
+    monkeypatch.setattr(AttackCheckpoint, 'save_batch', original_save_batch)
+
+    resumed = make_attack(model, dataset, tmp_path, store=AttackStore(str(tmp_path / 'store'), 'a'))
+    resumed.run()
+    assert len(resumed.store) == 8
+    assert torch.equal(best_advs(resumed), best_advs(reference))
+
+
+def test_resume_mid_batch(tmp_path, monkeypatch):
+    model = make_model()
+    dataset = make_dataset(model)
+    reference = make_attack(model, dataset, tmp_path / 'reference')
+    reference.run()
+
+    # Crash right after the first mid-batch state of batch 1 is saved
+    def save_state(self, state):
+        original_save_state(self, state)
+        if state['batch_idx'] == 1:
+            raise Interrupted
+
+    original_save_state = AttackCheckpoint.save_state
+    monkeypatch.setattr(AttackCheckpoint, 'save_state', save_state)
+    with pytest.raises(Interrupted):
+        make_attack(model, dataset, tmp_path).run()
+    monkeypatch.setattr(AttackCheckpoint, 'save_state', original_save_state)
+
+    resumed = make_attack(model, dataset, tmp_path)
+    resumed.run()
+    assert torch.allclose(best_advs(resumed), best_advs(reference))
+
+
+def test_other_model_weights_are_rejected(tmp_path):
+    dataset = make_dataset(make_model())
+    make_attack(make_model(seed=0), dataset, tmp_path)
+    with pytest.raises(ValueError):
+        make_attack(make_model(seed=1), dataset, tmp_path)
+
+
+def test_store_truncate(tmp_path):
+    store = AttackStore(str(tmp_path), 'a')
+    store.append(a=torch.arange(4), b=torch.ones(4, 2))
+    store.append(a=torch.arange(4, 7), b=torch.zeros(3, 2))
+    store.truncate(5)
+    store.append(a=torch.tensor([9]), b=torch.full((1, 2), 2.))
+
+    store = AttackStore(str(tmp_path))
+    assert store.read('a').tolist() == [0, 1, 2, 3, 4, 9]
+    assert store.read('b')[-2:].tolist() == [[0., 0.], [2., 2.]]
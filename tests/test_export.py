@@ -0,0 +1,47 @@
+from argparse import Namespace
+
+import pytest
+import torch
+import torch.nn as nn
+
+from HARP.models.layers import SubnetConv, SubnetLinear
+from HARP.models.resnet_cifar import resnet18
+from HARP.models.vgg_cifar import vgg16_bn
+from HARP.models.wrn_cifar import wrn_28_4
+from HARP.utils.export import export_channel_pruned
+from HARP.utils.model import prepare_model
+
+
+def channel_pruned(net):
+    torch.manual_seed(0)
+    model = net(SubnetConv, SubnetLinear, init_type='kaiming_normal', num_classes=10,
+                mean=torch.Tensor([0.4914, 0.4822, 0.4465]), std=torch.Tensor([0.2471, 0.2435, 0.2616]),
+                prune_reg='channel', task_mode='harp_finetune', normalize=False)
+    prepare_model(model, Namespace(exp_mode='harp_finetune', k=0.3, alpha=0.1, freeze_bn=False,
+                                   scores_init_type='kaiming_normal', prune_reg='channel'))
+    with torch.no_grad():
+        for m in model.modules():
+            if hasattr(m, 'k_score'):
+                m.popup_scores.normal_()
+                m.k_score.uniform_(-2, 2)
+            elif isinstance(m, nn.BatchNorm2d):
+                m.running_mean.normal_(0, 0.1)
+                m.running_var.uniform_(0.5, 2)
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.normal_(0, 0.1)
+    return model.eval()
+
+
+@pytest.mark.parametrize('net', [vgg16_bn, resnet18, wrn_28_4])
+def test_exported_logits_match_masked_model(net):
+    model = channel_pruned(net)
+    exported = export_channel_pruned(model)
+    assert not any(m.training for m in exported.modules())
+    assert sum(p.numel() for p in exported.parameters()) < sum(p.numel() for p in model.parameters())
+
+    x = torch.rand(4, 3, 32, 32)
+    state = {k: v.clone() for k, v in exported.state_dict().items()}
+    with torch.no_grad():
+        assert torch.allclose(exported(x), model(x), atol=1e-4)
+    # Running a forward pass leaves the exported batch norm statistics untouched
+    assert all(torch.equal(v, exported.state_dict()[k]) for k, v in state.items())
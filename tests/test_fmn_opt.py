@@ -0,0 +1,115 @@
+import pytest
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset
+
+from attacks.checkpoint import AttackCheckpoint
+from attacks.fmn_opt import FMNOpt, schedule_progress
+
+
+@pytest.fixture(autouse=True)
+def float64():
+    # Samples sitting on the decision boundary flip with the float32 rounding of another batch size
+    default = torch.get_default_dtype()
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(default)
+
+
+def make_problem(n=16):
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(12, 3)).eval()
+    x = torch.rand(n, 3, 2, 2)
+    return model, TensorDataset(x, model(x).argmax(1).detach())
+
+
+def attack(model, dataset, norm='inf', optimizer='SGD', **kwargs):
+    optimizer_config = {'lr': 1.0, 'momentum': 0.9} if optimizer == 'SGD' else {'lr': 0.1}
+    fmn = FMNOpt(model=model, dataset=dataset, norm=norm, steps=30, batch_size=len(dataset), batch_number=1,
+                 optimizer=optimizer, optimizer_config=optimizer_config, **kwargs)
+    fmn.run()
+    batch = fmn.load_batch(0)
+    norms = (batch['best_adv'] - batch['inputs']).flatten(1).norm(p=fmn.norm, dim=1)
+    with torch.no_grad():
+        is_adv = model(batch['best_adv']).argmax(1) != batch['labels']
+    return batch['best_adv'], norms, is_adv
+
+
+@pytest.mark.parametrize('optimizer', ['SGD', 'Adam'])
+def test_active_set_without_drops_matches_full_batch(optimizer):
+    model, dataset = make_problem()
+    full_adv, _, is_adv = attack(model, dataset, optimizer=optimizer)
+    active_adv, _, _ = attack(model, dataset, optimizer=optimizer, active_set=True, active_set_patience=100)
+    assert is_adv.any()
+    assert torch.allclose(active_adv, full_adv, atol=1e-6)
+
+
+@pytest.mark.parametrize('optimizer', ['SGD', 'Adam'])
+def test_active_set_keeps_the_best_adversarial_of_dropped_samples(optimizer):
+    model, dataset = make_problem()
+    _, full_norms, full_is_adv = attack(model, dataset, optimizer=optimizer)
+    _, norms, is_adv = attack(model, dataset, optimizer=optimizer, active_set=True, active_set_patience=2)
+    # A dropped sample stops at a prefix of its full-batch trajectory
+    assert full_is_adv.any() and torch.equal(is_adv, full_is_adv)
+    assert torch.all(norms[is_adv] >= full_norms[is_adv] - 1e-6)
+
+
+def test_restarts_never_do_worse_than_a_single_run():
+    model, dataset = make_problem()
+    _, single_norms, single_is_adv = attack(model, dataset)
+    best_adv, norms, is_adv = attack(model, dataset, restarts=3, restart_radius=0.1)
+    # The first restart is the single run, the others can only lower the minimum
+    assert best_adv.shape == dataset.tensors[0].shape
+    assert torch.all(is_adv >= single_is_adv)
+    assert torch.all(norms[single_is_adv] <= single_norms[single_is_adv] + 1e-9)
+
+
+def test_schedule_progress_compresses_the_remaining_schedule():
+    # Budget shrunk from 60 to 34 after step 7: the schedule continues from where it was
+    before = schedule_progress(8, 0, 0.0, 60)
+    assert schedule_progress(8, 8, before, 34) == pytest.approx(before)
+    assert schedule_progress(34, 8, before, 34) == pytest.approx(1.0)
+    assert schedule_progress(9, 8, before, 34) - before == pytest.approx((1 - before) / 26)
+
+
+def rescaled_attack(model, dataset, **kwargs):
+    fmn = FMNOpt(model=model, dataset=dataset, norm='inf', steps=60, batch_size=len(dataset), batch_number=1,
+                 optimizer_config={'lr': 1.0, 'momentum': 0.9}, stagnation_window=5, stagnation_tol=1e-3,
+                 stagnation_action='rescale', **kwargs)
+    fmn.run()
+    return fmn
+
+
+def test_rescale_compresses_the_lr_schedule():
+    model, dataset = make_problem()
+    fmn = rescaled_attack(model, dataset)
+    assert fmn.steps_used < fmn.steps
+    # The cosine lr schedule over `steps` epochs ends with the shrunk budget
+    assert fmn.scheduler.last_epoch == fmn.steps
+    assert fmn.optimizer.param_groups[0]['lr'] == pytest.approx(0.0, abs=1e-12)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_rescale_resumes_from_checkpoint(tmp_path, monkeypatch):
+    model, dataset = make_problem()
+    reference = rescaled_attack(model, dataset)
+
+    # Crash at the checkpoint of step 20, after the budget was shrunk
+    def save_state(self, state):
+        original_save_state(self, state)
+        if state['step'] == 20:
+            assert state['budget'] < 60 and state['phase_start'] > 0
+            raise Interrupted
+
+    original_save_state = AttackCheckpoint.save_state
+    monkeypatch.setattr(AttackCheckpoint, 'save_state', save_state)
+    with pytest.raises(Interrupted):
+        rescaled_attack(model, dataset, checkpoint_dir=str(tmp_path), checkpoint_interval=10)
+    monkeypatch.setattr(AttackCheckpoint, 'save_state', original_save_state)
+
+    resumed = rescaled_attack(model, dataset, checkpoint_dir=str(tmp_path), checkpoint_interval=10)
+    assert resumed.steps_used == reference.steps_used
+    assert torch.allclose(resumed.load_batch(0)['best_adv'], reference.load_batch(0)['best_adv'])
@@ -0,0 +1,75 @@
+import pytest
+import torch
+import torch.nn as nn
+from torch.utils.data import TensorDataset
+from torch.optim.lr_scheduler import CosineAnnealingLR, CosineAnnealingWarmRestarts, MultiStepLR
+
+from attacks.fmn_opt import FMNOpt, scheduler_defaults
+from attacks.fmn_sweep import FMNSweep, lr_factor
+
+
+@pytest.mark.parametrize('scheduler, config', [
+    (CosineAnnealingLR, {}),
+    (CosineAnnealingLR, {'T_max': 7}),
+    (CosineAnnealingWarmRestarts, {}),
+    (CosineAnnealingWarmRestarts, {'T_0': 3, 'T_mult': 2}),
+    (MultiStepLR, {}),
+    (MultiStepLR, {'milestones': [2, 5], 'gamma': 0.5}),
+])
+def test_lr_factor_matches_torch_schedulers(scheduler, config):
+    steps = 12
+    name = scheduler.__name__
+    optimizer = torch.optim.SGD([torch.zeros(1, requires_grad=True)], lr=1.0)
+    torch_scheduler = scheduler(optimizer, **scheduler_defaults(name, config, steps))
+    for step in range(steps):
+        assert lr_factor(name, config, step, steps) == pytest.approx(optimizer.param_groups[0]['lr'])
+        optimizer.step()
+        torch_scheduler.step()
+
+
+def test_scheduler_defaults_does_not_mutate_config():
+    config = {}
+    assert scheduler_defaults('CosineAnnealingLR', config, 10) == {'T_max': 10}
+    assert config == {}
+
+
+@pytest.fixture
+def float64():
+    default = torch.get_default_dtype()
+    torch.set_default_dtype(torch.float64)
+    yield
+    torch.set_default_dtype(default)
+
+
+@pytest.mark.parametrize('optimizer, optimizer_config', [
+    ('SGD', {'lr': 1.0, 'momentum': 0.9}),
+    ('SGDNesterov', {'lr': 1.0, 'momentum': 0.9}),
+    ('Adam', {'lr': 0.1, 'betas': (0.8, 0.5), 'eps': 1e-8}),
+    ('AdamAmsgrad', {'lr': 0.1, 'betas': (0.8, 0.5), 'eps': 1e-8}),
+])
+@pytest.mark.parametrize('scheduler', ['CosineAnnealingLR', 'MultiStepLR'])
+def test_single_config_sweep_matches_fmn_opt(float64, optimizer, optimizer_config, scheduler):
+    # Nonlinear model: the second moment of the normalized gradient must be able to decrease for
+    # AMSGrad to differ from Adam
+    torch.manual_seed(2)
+    model = nn.Sequential(nn.Flatten(), nn.Linear(12, 32), nn.Tanh(), nn.Linear(32, 3)).eval()
+    with torch.no_grad():
+        model[1].weight.mul_(4)
+    x = torch.rand(16, 3, 2, 2)
+    dataset = TensorDataset(x, model(x).argmax(1).detach())
+    steps, gamma = 30, {'gamma_init': 0.1, 'gamma_final': 0.01}
+
+    serial = FMNOpt(model=model, dataset=dataset, norm='inf', steps=steps, batch_size=16, batch_number=1,
+                    optimizer=optimizer, optimizer_config=optimizer_config, scheduler=scheduler,
+                    scheduler_config={}, **gamma)
+    serial.run()
+    batch = serial.load_batch(0)
+    serial_distances = (batch['best_adv'] - batch['inputs']).flatten(1).norm(p=float('inf'), dim=1)
+
+    sweep = FMNSweep(model, dataset, 'inf', [dict(optimizer=optimizer, scheduler=scheduler, **optimizer_config, **gamma)],
+                     steps=steps, batch_size=16)
+    distances, adv_found = sweep._attack_batch(x, dataset.tensors[1])
+
+    assert adv_found[0].any()
+    assert torch.equal(adv_found[0], serial.init_trackers['adv_found'])
+    assert torch.allclose(distances[0], serial_distances, atol=1e-8)
@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from HARP.models import layers as harp_layers
+from HYDRA.models import layers as hydra_layers
+
+
+@pytest.fixture(params=['harp', 'hydra'])
+def layer(request):
+    torch.manual_seed(0)
+    if request.param == 'harp':
+        layer = harp_layers.SubnetConv(3, 8, 3)
+        layer.set_prune_rate(0.3, 0.3, 0.1, 'cpu')
+    else:
+        layer = hydra_layers.SubnetConv(3, 8, 3)
+        layer.set_prune_rate(0.3)
+    layer.popup_scores.data.normal_()
+    return layer.eval()
+
+
+def test_frozen_mask_matches_unfrozen(layer):
+    x = torch.rand(2, 3, 8, 8)
+    with torch.no_grad():
+        expected = layer(x)
+        layer.freeze_mask()
+        assert torch.equal(layer(x), expected)
+
+
+def assert_cache_follows_new_mask(layer, stale):
+    fresh = layer._masked_weight()
+    assert not torch.equal(fresh != 0, stale != 0), "the update should change the top-k set"
+    assert torch.equal(layer._frozen_weight(), fresh)
+
+
+def test_frozen_mask_tracks_in_place_writes(layer):
+    layer.freeze_mask()
+    with torch.no_grad():
+        stale = layer._frozen_weight().clone()
+        layer.popup_scores.mul_(torch.rand_like(layer.popup_scores))
+        assert_cache_follows_new_mask(layer, stale)
+
+
+def test_frozen_mask_reset_after_data_writes(layer):
+    layer.freeze_mask()
+    with torch.no_grad():
+        stale = layer._frozen_weight().clone()
+        # Writes through .data are invisible to the version counter
+        scores = layer.popup_scores.data
+        scores.copy_(scores.flatten()[torch.randperm(scores.numel())].view_as(scores))
+        assert torch.equal(layer._frozen_weight(), stale)
+        layer.reset_frozen_mask()
+        assert_cache_follows_new_mask(layer, stale)
@@ -0,0 +1,104 @@
+from argparse import Namespace
+
+import pytest
+import torch
+
+from HARP.models.layers import SubnetConv, SubnetLinear
+from HARP.models.resnet_cifar import resnet18
+from HARP.models.vgg_cifar import vgg16_bn
+from HARP.utils.hw import HWCost, count_flops_conv, count_flops_dense
+from HARP.utils.profiler import profile
+from HARP.utils.utils import rate_act_func
+
+
+ARCHS = {'vgg16_bn': vgg16_bn, 'resnet18': resnet18}
+
+# Input feature map size of every subnet layer, from the per-arch formula hw_flops_loss used before the profiler
+FMAPS = {
+    'vgg16_bn': [32, 32, 16, 16, 8, 8, 8, 4, 4, 4, 2, 2, 2, 1, 1, 1],
+    'resnet18': [32, 32, 32, 32, 32, 32, 16, 32, 16, 16, 16, 8, 16, 8, 8, 8, 4, 8, 4, 4, 1]
+}
+
+
+def pruned_model(prune_reg, arch='resnet18'):
+    torch.manual_seed(0)
+    model = ARCHS[arch](SubnetConv, SubnetLinear, init_type='kaiming_normal', num_classes=10,
+                     mean=torch.Tensor([0.4914, 0.4822, 0.4465]), std=torch.Tensor([0.2471, 0.2435, 0.2616]),
+                     prune_reg=prune_reg, task_mode='harp_prune', normalize=False)
+    for m in model.modules():
+        if hasattr(m, 'k_score'):
+            m.set_prune_rate(0.5, 0.5, 0.1, 'cpu')
+            m.k_score.data.uniform_(-2, 2)
+    return model
+
+
+def test_flops_rate_matches_profile():
+    model = pruned_model('channel')
+    args = Namespace(prune_reg='channel', dataset='CIFAR10', arch='resnet18', k=0.5)
+    cost = HWCost(model, args)
+
+    with torch.no_grad():
+        dense = profile(model, (1, 3, 32, 32), 'resnet18', rates={})['flops']
+        pruned = profile(model, (1, 3, 32, 32), 'resnet18')['flops']
+        assert cost.total_flops == pytest.approx(float(dense), rel=1e-5)
+        assert cost.flops_rate().item() * cost.total_flops == pytest.approx(float(pruned), rel=1e-5)
+
+    rate = cost.flops_rate()
+    rate.backward()
+    assert all(m.k_score.grad is not None for m in model.modules() if hasattr(m, 'k_score'))
+
+
+def test_param_rate_matches_layer_rates():
+    model = pruned_model('weight')
+    cost = HWCost(model, Namespace(prune_reg='weight', dataset='CIFAR10', arch='resnet18', k=0.5))
+    layers = [m for m in model.modules() if hasattr(m, 'k_score')]
+    with torch.no_grad():
+        kept = sum(m.weight.numel() * rate_act_func(m.k_score, m.k_min) for m in layers)
+        expected = kept / sum(m.weight.numel() for m in layers)
+        assert cost.param_rate().item() == pytest.approx(expected.item(), rel=1e-6)
+
+
+def baseline_flops(model, args):
+    """Total, target and surviving FLOPs of the subnet layers as the per-arch hw_flops_loss counted them"""
+    fmaps = FMAPS[args.arch]
+    layers = [m for m in model.modules() if hasattr(m, 'k_score')]
+
+    def flops(idx, m, in_channels, out_channels):
+        if isinstance(m, SubnetConv):
+            return count_flops_conv(fmaps[idx], fmaps[idx], in_channels, out_channels,
+                                    kernel_size=m.kernel_size, stride=m.stride[0], padding=m.padding[0])
+        return count_flops_dense(in_channels, out_channels)
+
+    total = sum(flops(idx, m, m.weight.shape[1], m.weight.shape[0]) for idx, m in enumerate(layers))
+    target = sum(flops(idx, m, round(m.weight.shape[1] * args.k), round(m.weight.shape[0] * args.k))
+                 for idx, m in enumerate(layers))
+
+    surv = 0
+    for idx, (m_pre, m) in enumerate(zip(layers, layers[1:])):
+        k_in = rate_act_func(m.k_score, m.k_min)
+        surv = surv + flops(idx, m_pre, m_pre.weight.shape[1] * rate_act_func(m_pre.k_score, m_pre.k_min),
+                            m_pre.weight.shape[0] * k_in)
+        if m.weight.shape[0] == args.num_classes:
+            surv = surv + count_flops_dense(m.weight.shape[1] * k_in, m.weight.shape[0])
+    return total, target, surv
+
+
+@pytest.mark.parametrize('arch', ['vgg16_bn', 'resnet18'])
+def test_flops_match_baseline_formula(arch):
+    # Pools were not counted by the per-arch formula: compare the conv/linear layers only
+    model = pruned_model('channel', arch)
+    args = Namespace(prune_reg='channel', dataset='CIFAR10', arch=arch, k=0.5, num_classes=10)
+    cost = HWCost(model, args)
+    total, target, surv = baseline_flops(model, args)
+
+    with torch.no_grad():
+        layer = cost.a > 0
+        r = torch.cat([cost.rates(), torch.ones(1)])
+        r_out = r[cost.rows_out]
+        flops = cost.a * r[cost.rows_in] * r[cost.rows_dens] * r_out + cost.b * r_out
+        assert (cost.a + cost.b)[layer].sum().item() == pytest.approx(total, rel=1e-6)
+        assert flops[layer].sum().item() == pytest.approx(surv.item(), rel=1e-5)
+
+        rates = {name: args.k for name, m in model.named_modules() if hasattr(m, 'k_score')}
+        layers = profile(model, (1, 3, 32, 32), arch, rates=rates, out_rates=rates, round_channels=True)['layers']
+        assert sum(float(l['flops']) for l in layers if l['type'] != 'pool') == pytest.approx(target, rel=1e-6)
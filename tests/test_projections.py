@@ -0,0 +1,56 @@
+import torch
+
+from attacks.fmn_opt import l0_projection_, l1_projection_, l2_projection_, linf_projection_
+
+
+def duchi_l1_projection(v, epsilon):
+    """Reference sort-based projection of one row onto the l1 ball (Duchi et al., 2008)"""
+    if v.abs().sum() <= epsilon:
+        return v.clone()
+    u = v.abs().sort(descending=True).values
+    cumsum = u.cumsum(0)
+    ks = torch.arange(1, len(u) + 1, dtype=v.dtype)
+    rho = torch.nonzero(u * ks > cumsum - epsilon).max()
+    theta = (cumsum[rho] - epsilon) / (rho + 1)
+    return (v.abs() - theta).clamp(min=0) * v.sign()
+
+
+def random_batch():
+    torch.manual_seed(0)
+    delta = torch.randn(32, 3, 4, 4, dtype=torch.float64)
+    epsilon = torch.rand(32, dtype=torch.float64) * 10
+    epsilon[:4] = 1e3  # rows already inside the ball
+    return delta, epsilon
+
+
+def test_l1_projection_matches_sort_reference():
+    delta, epsilon = random_batch()
+    projected = delta.clone()
+    l1_projection_(projected, epsilon)
+    for row, original, eps in zip(projected.flatten(1), delta.flatten(1), epsilon):
+        assert torch.allclose(row, duchi_l1_projection(original, eps), atol=1e-10)
+
+
+def test_l0_projection_keeps_largest_components():
+    delta, _ = random_batch()
+    k = torch.randint(0, delta[0].numel() + 1, (len(delta),)).double()
+    projected = delta.clone()
+    l0_projection_(projected, k)
+    for row, original, row_k in zip(projected.flatten(1), delta.flatten(1), k.long()):
+        expected = torch.zeros_like(original)
+        idx = original.abs().topk(int(row_k)).indices
+        expected[idx] = original[idx]
+        assert torch.equal(row, expected)
+
+
+def test_l2_and_linf_projections():
+    delta, epsilon = random_batch()
+    l2 = delta.clone()
+    l2_projection_(l2, epsilon)
+    norms = delta.flatten(1).norm(dim=1)
+    expected = delta.flatten(1) * (epsilon / norms).clamp(max=1).unsqueeze(1)
+    assert torch.allclose(l2.flatten(1), expected)
+
+    linf = delta.clone()
+    linf_projection_(linf, epsilon)
+    assert torch.equal(linf.flatten(1), delta.flatten(1).clamp(-epsilon.unsqueeze(1), epsilon.unsqueeze(1)))
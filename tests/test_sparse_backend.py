@@ -0,0 +1,44 @@
+import torch
+import torch.nn as nn
+
+from HYDRA.utils.sparse import SparseConv2d, SparseLinear, sparsify
+
+
+def pruned(layer, density=0.05):
+    torch.manual_seed(0)
+    with torch.no_grad():
+        layer.weight.mul_(torch.rand_like(layer.weight) < density)
+    return layer
+
+
+def assert_same_forward_backward(dense, sparse, x):
+    x_dense = x.clone().requires_grad_()
+    x_sparse = x.clone().requires_grad_()
+    out_dense, out_sparse = dense(x_dense), sparse(x_sparse)
+    assert torch.allclose(out_sparse, out_dense, atol=1e-5)
+
+    grad = torch.randn_like(out_dense)
+    out_dense.backward(grad)
+    out_sparse.backward(grad)
+    assert torch.allclose(x_sparse.grad, x_dense.grad, atol=1e-5)
+
+
+def test_sparse_linear_matches_dense():
+    dense = pruned(nn.Linear(64, 32))
+    assert_same_forward_backward(dense, SparseLinear(dense), torch.randn(8, 64))
+
+
+def test_sparse_conv_matches_dense():
+    for kwargs in ({'padding': 1}, {'stride': 2, 'padding': 2, 'dilation': 2}, {'bias': False}):
+        dense = pruned(nn.Conv2d(8, 16, 3, **kwargs))
+        assert_same_forward_backward(dense, SparseConv2d(dense), torch.randn(4, 8, 11, 9))
+
+
+def test_sparsify_keeps_the_outputs():
+    model = nn.Sequential(pruned(nn.Conv2d(3, 16, 3, padding=1)), nn.ReLU(), nn.Flatten(),
+                          pruned(nn.Linear(16 * 8 * 8, 10))).eval()
+    x = torch.rand(2, 3, 8, 8)
+    sparse_model, report = sparsify(model, input_size=(1, 3, 8, 8), threshold=0.9, repeats=1, verbose=False)
+    assert len(report) == 2
+    with torch.no_grad():
+        assert torch.allclose(sparse_model(x), model(x), atol=1e-5)
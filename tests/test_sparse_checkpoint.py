@@ -0,0 +1,70 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from HARP.models import layers as harp_layers
+from HYDRA.models import layers as hydra_layers
+from sparse_checkpoint import pack_mask, unpack_mask, encode_state_dict, decode_state_dict
+
+K = 0.05
+
+
+class Net(nn.Module):
+    def __init__(self, conv_layer, linear_layer):
+        super(Net, self).__init__()
+        self.conv = conv_layer(3, 16, 3, padding=1)
+        self.linear = linear_layer(16 * 8 * 8, 10)
+
+    def forward(self, x):
+        return self.linear(torch.relu(self.conv(x)).flatten(1))
+
+
+def subnet(family):
+    torch.manual_seed(0)
+    if family == 'harp':
+        model = Net(harp_layers.SubnetConv, harp_layers.SubnetLinear)
+        for m in model.modules():
+            if hasattr(m, 'set_prune_rate'):
+                m.set_prune_rate(K, K, 0.1, 'cpu')
+    else:
+        model = Net(hydra_layers.SubnetConv, hydra_layers.SubnetLinear)
+        for m in model.modules():
+            if hasattr(m, 'set_prune_rate'):
+                m.set_prune_rate(K)
+    for name, p in model.named_parameters():
+        if 'popup_scores' in name:
+            p.data.normal_()
+    return model.eval()
+
+
+def test_pack_mask_round_trip():
+    mask = torch.rand(5, 7, 3) > 0.8
+    assert torch.equal(unpack_mask(pack_mask(mask), mask.shape), mask)
+
+
+@pytest.mark.parametrize('family', ['harp', 'hydra'])
+def test_subnet_round_trip(family):
+    model = subnet(family)
+    x = torch.rand(4, 3, 8, 8)
+    decoded = decode_state_dict(encode_state_dict(model.state_dict(), family, K))
+    assert set(decoded) == set(model.state_dict())
+
+    restored = subnet(family)
+    for p in restored.parameters():
+        p.data.zero_()
+    restored.load_state_dict(decoded)
+    with torch.no_grad():
+        assert torch.allclose(restored(x), model(x))
+
+
+@pytest.mark.parametrize('family', ['harp', 'hydra'])
+def test_dense_round_trip(family):
+    model = subnet(family)
+    x = torch.rand(4, 3, 8, 8)
+    decoded = decode_state_dict(encode_state_dict(model.state_dict(), family, K), dense=True)
+
+    dense = Net(nn.Conv2d, nn.Linear).eval()
+    dense.load_state_dict(decoded, strict=True)
+    with torch.no_grad():
+        assert torch.allclose(dense(x), model(x), atol=1e-6)
+        assert torch.equal(dense.linear.weight, model.linear._masked_weight())
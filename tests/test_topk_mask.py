@@ -0,0 +1,51 @@
+import pytest
+import torch
+
+from HARP.models import layers as harp_layers
+from HYDRA.models import layers as hydra_layers
+
+
+def stable_sort_mask(scores, k):
+    """Reference: zero the j smallest scores of a stable ascending sort"""
+    j = int((1 - k) * scores.numel())
+    idx = scores.flatten().sort(stable=True).indices
+    mask = torch.ones(scores.numel())
+    mask[idx[:j]] = 0
+    return mask.view_as(scores)
+
+
+@pytest.fixture(params=[harp_layers, hydra_layers], ids=['HARP', 'HYDRA'])
+def layers(request):
+    yield request.param
+    request.param.set_mask_engine()
+
+
+@pytest.mark.parametrize('k', [0.0, 0.01, 0.3, 0.5, 0.99, 1.0])
+def test_kthvalue_matches_sort(layers, k):
+    torch.manual_seed(0)
+    scores = torch.randn(64, 32, 3, 3)
+    layers.set_mask_engine('kthvalue')
+    kth = layers.topk_mask(scores, k)
+    layers.set_mask_engine('sort')
+    assert torch.equal(kth, layers.topk_mask(scores, k))
+
+
+@pytest.mark.parametrize('k', [0.3, 0.5, 0.7])
+def test_kthvalue_breaks_ties_like_a_stable_sort(layers, k):
+    scores = torch.tensor([0., 1., 1., 1., 1., 1., 1., 2., 1., 3.]).repeat(10).view(10, 10)
+    layers.set_mask_engine('kthvalue')
+    mask = layers.topk_mask(scores, k)
+    assert mask.sum() == scores.numel() - int((1 - k) * scores.numel())
+    assert torch.equal(mask, stable_sort_mask(scores, k))
+
+
+def test_histogram_keeps_at_most_top_k(layers):
+    torch.manual_seed(0)
+    scores = torch.randn(256, 128, 3, 3)
+    k = 0.1
+    layers.set_mask_engine('histogram', histogram_numel=0, bins=4096)
+    mask = layers.topk_mask(scores, k)
+    exact = scores.numel() - int((1 - k) * scores.numel())
+    # Everything kept is in the exact top k, and at most one bin of it is missed
+    assert torch.all(stable_sort_mask(scores, k)[mask.bool()] == 1)
+    assert exact - mask.sum() <= scores.numel() * 0.01